@@ -62,6 +62,8 @@ M                       = 'http://rest.kegg.jp/list/module'
 m_result                = 'module_descriptions.%s.pickle' % date
 R2RCLASS                = 'http://rest.kegg.jp/list/module'
 r2rclass_result         = 'reaction_to_rpair.%s.pickle' % date
+k2r_result              = 'ko_to_reaction.%s.pickle' % date
+k2m_result              = 'ko_to_module.%s.pickle' % date
 
 def build_name_dict(url):
     output_dictionary = {}
@@ -82,6 +84,27 @@ def build_dict(url):
             output_dictionary[key] = [item]
     return output_dictionary
 
+def invert_dict(input_dictionary):
+    output_dictionary = {}
+    for key, items in input_dictionary.items():
+        for item in items:
+            if item in output_dictionary:
+                output_dictionary[item].append(key)
+            else:
+                output_dictionary[item] = [key]
+    return output_dictionary
+
+def join_dict(key_to_link, link_to_item):
+    output_dictionary = {}
+    for key, links in key_to_link.items():
+        for link in links:
+            for item in link_to_item.get(link, []):
+                if key not in output_dictionary:
+                    output_dictionary[key] = [item]
+                elif item not in output_dictionary[key]:
+                    output_dictionary[key].append(item)
+    return output_dictionary
+
 def build_pfam_dict(url):
 
     pfam2clan           = {}
@@ -150,6 +173,18 @@ print("Done")
 print(("Pickling results: %s" % m2r_result))
 pickle.dump(m2r, open(m2r_result, "wb"))
 
+print("Deriving orthology to reaction information")
+k2r = invert_dict(r2k)
+print("Done")
+print(("Pickling results: %s" % k2r_result))
+pickle.dump(k2r, open(k2r_result, "wb"))
+
+print("Deriving orthology to module information")
+k2m = join_dict(k2r, r2m)
+print("Done")
+print(("Pickling results: %s" % k2m_result))
+pickle.dump(k2m, open(k2m_result, "wb"))
+
 print("Downloading reaction to compound information from KEGG")
 r2c = build_dict(R2C)
 print("Done")
@@ -27,12 +27,21 @@ import shutil
 import tempfile
 import logging
 import subprocess
+import threading
 import multiprocessing as mp
+from contextlib import contextmanager
 from os import path, close, mkdir, listdir
 from enrichm.genome import Genome, AnnotationParser
 from enrichm.databases import Databases
+from enrichm.checkpoint import Checkpoint
+from enrichm.events import Events
+from enrichm.scheduler import Scheduler, Threads, ParallelJobs, plan_cpus
+from enrichm.workers import WorkerPool
+from enrichm.profiler import Profiler
 from enrichm.sequence_io import SequenceIO
 from enrichm.writer import Writer, MatrixGenerator
+from enrichm.gtdb import GtdbMatrix
+from enrichm.matrix import AnnotationMatrix, SparseAnnotationMatrix
 from enrichm.toolbox import list_splitter, run_command
 
 def parse_genomes(params):
@@ -74,12 +83,33 @@ class Annotate:
     PROTEINS_SUFFIX = '.faa'
     ANNOTATION_SUFFIX = '.tsv'
     PICKLE_SUFFIX = '.pickle'
+    MATRIX_OUTPUTS = {'cluster':OUTPUT_CLUSTER,
+                      'ortholog':OUTPUT_ORTHOLOG,
+                      'ko':OUTPUT_KO,
+                      'ko_hmm':OUTPUT_KO_HMM,
+                      'ec':OUTPUT_EC,
+                      'pfam':OUTPUT_PFAM,
+                      'tigrfam':OUTPUT_TIGRFAM,
+                      'cazy':OUTPUT_CAZY}
+    # Binary copies of the matrices kept in memory only, for resuming a run
+    CHECKPOINT_MATRICES = 'stage_matrices'
+    STAGE_INPUTS = 'inputs'
+    STAGE_CLUSTER = 'clusters'
+    STAGE_KO = 'ko'
+    STAGE_KO_HMM = 'ko_hmm'
+    STAGE_EC = 'ec'
+    STAGE_PFAM = 'pfam'
+    STAGE_TIGRFAM = 'tigrfam'
+    STAGE_CAZY = 'cazy'
+    STAGE_GFF = 'gff'
+    STAGE_RENAME = 'rename_fasta'
+    STAGE_PICKLE = 'pickle_objects'
 
     def __init__(self, output_directory, annotate_ko, annotate_ko_hmm, annotate_pfam,
                  annotate_tigrfam, annoatate_cluster, annotate_ortholog, annotate_cazy, annotate_ec,
                  evalue, bit, percent_id_cutoff, aln_query, aln_reference, fraction_aligned, cut_ga,
                  cut_nc, cut_tc, cut_hmm, inflation, chunk_number, chunk_max, count_domains,
-                 threads, parallel, suffix, light):
+                 threads, parallel, suffix, light, resume=False, cpus=None):
 
         # Define inputs and outputs
         self.output_directory = output_directory
@@ -115,13 +145,32 @@ class Annotate:
         self.parallel = parallel
         self.suffix = suffix
         self.light = light
+        self.resume = resume
 
-        # Set up multiprocesses pool
-        self.pool = mp.Pool(processes=int(self.parallel))
+        # Annotation stages run concurrently, sharing a budget of CPUs. If a
+        # budget is given, it is split between jobs and threads for each tool
+        # instead of using threads and parallel.
+        self.cpu_budget = cpus
+        self.cpus = int(cpus) if cpus else mp.cpu_count()
+
+        # Number of processes used to parse genomes
+        self.processes = self.cpus if cpus else int(self.parallel)
 
         # Load databases
         self.databases = Databases()
 
+        # Frequency matrices produced by annotate_pipeline
+        self.matrices = dict()
+        self.write_matrices = True
+
+        # Progress through the annotation stages, reported in events
+        self.stages_done = 0
+        self.stages_total = 0
+
+        # Results of concurrent stages are merged into the Genome objects one
+        # stage at a time.
+        self.merge_lock = threading.Lock()
+
     def prep_genome(self, genome_file_list, genome_directory):
         '''
         Do any preparation specific to the genome annotation pipeline.
@@ -158,6 +207,7 @@ class Annotate:
 
         return genome_directory
 
+    @Profiler.profile('call_proteins')
     def call_proteins(self, genome_directory):
         '''
         Use prodigal to call proteins within the genomes
@@ -184,6 +234,7 @@ class Annotate:
                 genome_paths.append(path.splitext(genome)[0])
 
         logging.info("    - Calling proteins for %i genomes", len(genome_paths))
+        jobs, _ = self._plan(self.STAGE_INPUTS, 'prodigal', len(genome_paths), self.cpus)
         cmd = "ls %s/*%s | \
                     sed 's/%s//g' | \
                     grep -o '[^/]*$' | \
@@ -196,7 +247,7 @@ class Annotate:
                             -a %s/{}%s \
                             -i %s/{}%s \
                             > /dev/null 2>&1" \
-                % (genome_directory, self.suffix, self.suffix, self.parallel, gene_directory_path,
+                % (genome_directory, self.suffix, self.suffix, jobs, gene_directory_path,
                    self.suffix, protein_directory_path, self.PROTEINS_SUFFIX, genome_directory,
                    self.suffix)
 
@@ -232,12 +283,28 @@ class Annotate:
         returns a directory containing the search results for each of the input population genomes,
         and a frequency matrix contining with the KOs as rows, and the genomes as columns.
         '''
+        output_annotation_path = self.diamond_annotation_search(genomes_list, database,
+                                                                output_subdirectory)
+        self.add_diamond_annotations(genomes_list, output_annotation_path, parser_type, ids_type)
+
+    def diamond_annotation_search(self, genomes_list, database, output_subdirectory, threads=None):
+        '''
+        Search the proteins encoded by each genome against a DIAMOND database.
 
+        Parameters
+        ----------
+        genomes_list        - list. list of Genome objects
+        database            - string. Path to the DIAMOND database
+        output_subdirectory - string. Subdirectory of the output directory to write results to
+        threads             - int. Number of threads to give DIAMOND (default: --threads)
+
+        Outputs
+        -------
+        returns the path to the DIAMOND results
+        '''
         output_directory_path = path.join(self.output_directory,
                                           output_subdirectory)
-        genome_dict = {genome.name:genome for genome in genomes_list}
         mkdir(output_directory_path)
-        specific_cutoffs = None
 
         with tempfile.NamedTemporaryFile() as temp:
 
@@ -251,14 +318,38 @@ class Annotate:
             output_annotation_path = path.join(output_directory_path, self.OUTPUT_DIAMOND) + \
                                         self.ANNOTATION_SUFFIX
             logging.info('    - BLASTing genomes')
-            self.diamond_search(temp.name, output_annotation_path, database)
+            self.diamond_search(temp.name, output_annotation_path, database, threads)
+
+        return output_annotation_path
+
+    def add_diamond_annotations(self, genomes_list, output_annotation_path, parser_type, ids_type,
+                                stage=None):
+        '''
+        Add the annotations found by a DIAMOND search to each genome.
+
+        Parameters
+        ----------
+        genomes_list            - list. list of Genome objects
+        output_annotation_path  - string. Path to the DIAMOND results
+        parser_type             - string. AnnotationParser type used to parse the results
+        ids_type                - string. Type of annotation id
+        stage                   - string. Name of the stage, reported in events
+        '''
+        genome_dict = {genome.name:genome for genome in genomes_list}
+        specific_cutoffs = None
+        done = 0
 
-            for genome_name, batch in self.get_batches(output_annotation_path):
+        for genome_name, batch in self.get_batches(output_annotation_path):
 
-                if batch:
-                    genome = genome_dict[genome_name]
-                    genome.add(batch, self.evalue, self.bit, self.aln_query, self.aln_reference,
-                               specific_cutoffs, parser_type, ids_type)
+            if batch:
+                genome = genome_dict[genome_name]
+                genome.add(batch, self.evalue, self.bit, self.aln_query, self.aln_reference,
+                           specific_cutoffs, parser_type, ids_type)
+                done += 1
+                logging.debug('    - Added %i %s hits to %s', len(batch), stage, genome_name,
+                              extra=Events.event(Events.FINISHED, stage=stage, genome=genome_name,
+                                                 proteins=len(genome.sequences), hits=len(batch),
+                                                 done=done, total=len(genomes_list)))
 
     def get_batches(self, input_file):
         '''
@@ -294,7 +385,8 @@ class Annotate:
         else:
             yield last, batch
 
-    def diamond_search(self, tmp_name, output_path, database):
+    @Profiler.profile('diamond_search')
+    def diamond_search(self, tmp_name, output_path, database, threads=None):
         '''
         Carry out a diamond blastp search.
 
@@ -303,7 +395,10 @@ class Annotate:
         input_genome_path - string. Path to file containing .faa file for an input genome
         output_path - string. Path to file to output results into
         databases - string. Path to HMM to use for searching
+        threads - int. Number of threads to use (default: --threads)
         '''
+        if threads is None:
+            threads = self.threads
 
         cmd = f'bash {tmp_name} | diamond blastp \
                                     --quiet \
@@ -312,7 +407,7 @@ class Annotate:
                                     --query /dev/stdin \
                                     --out {output_path} \
                                     --db {database} \
-                                    --threads {self.threads} '
+                                    --threads {threads} '
         if self.evalue:
             cmd += f'--evalue {self.evalue} '
 
@@ -340,23 +435,41 @@ class Annotate:
 
         '''
         mkdir(output_directory_path)
-        genome_dict = {genome.name: genome for genome in genomes_list}
-
         hmmcutoff = (ids_type in (AnnotationParser.TIGRFAM, AnnotationParser.PFAM))
+        self.hmm_search(output_directory_path, database, hmmcutoff)
+        self.add_hmmsearch_annotations(genomes_list, output_directory_path, ids_type, parser)
+
+    def add_hmmsearch_annotations(self, genomes_list, output_directory_path, ids_type, parser,
+                                  stage=None):
+        '''
+        Add the annotations found by hmmsearch to each genome.
+
+        Parameters
+        ----------
+        genomes_list            - list. list of Genome objects
+        output_directory_path   - string. Directory containing the hmmsearch results
+        ids_type                - string. Type of annotation id
+        parser                  - string. AnnotationParser type used to parse the results
+        stage                   - string. Name of the stage, reported in events
+        '''
+        genome_dict = {genome.name: genome for genome in genomes_list}
 
         if ids_type == AnnotationParser.KO_HMM:
             specific_cutoffs = self.databases.parse_ko_cutoffs()
         else:
             specific_cutoffs = None
 
-        self.hmm_search(output_directory_path, database, hmmcutoff)
-
-        for genome_annotation in listdir(output_directory_path):
+        for done, genome_annotation in enumerate(listdir(output_directory_path), 1):
             genome_id = path.splitext(genome_annotation)[0]
             genome = genome_dict[genome_id]
             output_annotation_path = path.join(output_directory_path, genome_annotation)
-            genome.add(output_annotation_path, self.evalue, self.bit, self.aln_query,
-                       self.aln_reference, specific_cutoffs, parser, ids_type)
+            hits = genome.add(output_annotation_path, self.evalue, self.bit, self.aln_query,
+                              self.aln_reference, specific_cutoffs, parser, ids_type)
+            logging.debug('    - Added %i %s hits to %s', hits, stage, genome_id,
+                          extra=Events.event(Events.FINISHED, stage=stage, genome=genome_id,
+                                             proteins=len(genome.sequences), hits=hits,
+                                             bytes=Events.output_size(output_annotation_path),
+                                             done=done, total=len(genomes_list)))
 
     def annotate_hypothetical(self, genomes_list):
         '''
@@ -367,6 +480,30 @@ class Annotate:
         genomes_list - list. list of Genome objects
 
         '''
+        clu_tsv_path, ortholog_dict, output_directory_path = self.cluster_proteins(genomes_list)
+        ortholog_ids = ortholog_dict.keys()
+        cluster_ids = self.parse_cluster_results(clu_tsv_path, genomes_list,
+                                                 ortholog_dict, output_directory_path)
+        return cluster_ids, ortholog_ids
+
+    def cluster_proteins(self, genomes_list, threads=None):
+        '''
+        Cluster the proteins coded by each genome using MMSeqs2, and find
+        orthologs within the clusters using mcl.
+
+        Inputs
+        ------
+        genomes_list - list. list of Genome objects
+        threads      - int. Number of threads to use (default: --threads)
+
+        Outputs
+        -------
+        returns the path to the clusters, a dictionary of orthologs and the
+        directory the results were written to
+        '''
+        if threads is None:
+            threads = self.threads
+
         output_directory_path = path.join(self.output_directory, self.GENOME_HYPOTHETICAL)
         mkdir(output_directory_path)
 
@@ -400,7 +537,7 @@ class Annotate:
                         {clu_path} \
                         {tmp_dir} \
                         --max-seqs 1000 \
-                        --threads {self.threads} \
+                        --threads {threads} \
                         --min-seq-id {self.percent_id_cutoff} \
                         -e {self.evalue} \
                         -c {self.fraction_aligned} \
@@ -432,13 +569,10 @@ class Annotate:
             run_command(cmd)
 
         ortholog_dict = self.run_mcl(formatted_blast_output_path,
-                                     output_directory_path)
-        ortholog_ids = ortholog_dict.keys()
-        cluster_ids = self.parse_cluster_results(clu_tsv_path, genomes_list,
-                                                 ortholog_dict, output_directory_path)
-        return cluster_ids, ortholog_ids
+                                     output_directory_path, threads)
+        return clu_tsv_path, ortholog_dict, output_directory_path
 
-    def run_mcl(self, blast_abc, output_directory_path):
+    def run_mcl(self, blast_abc, output_directory_path, threads=None):
         '''
         Parse the protein clusters producedf from Mmseqs2 using mcl
 
@@ -447,7 +581,10 @@ class Annotate:
         blast_abc - string. an abc file for mcl to run on. More information on the format of abc
                     files can be found at https://micans.org/mcl/man/clmprotocols.html
         output_directory_path - string. Path to write the results of mcl parsing to.
+        threads - int. Number of threads to use (default: --threads)
         '''
+        if threads is None:
+            threads = self.threads
 
         dict_path = path.join(output_directory_path, "alignDb.dict")
         mci_path = path.join(output_directory_path, "alignDb.mci")
@@ -469,7 +606,7 @@ class Annotate:
         ortholog_dict = dict()
         cmd = f'mcl \
                     {mci_path} \
-                    -te {self.threads} \
+                    -te {threads} \
                     -I {self.inflation} \
                     -o {cluster_path} \
                     > /dev/null 2>&1'
@@ -553,7 +690,8 @@ class Annotate:
 
         return cmd
 
-    def hmm_search(self, output_path, database, hmmcutoff):
+    @Profiler.profile('hmm_search')
+    def hmm_search(self, output_path, database, hmmcutoff, jobs=None, threads=None):
         '''
         Carry out a hmmsearch.
 
@@ -563,7 +701,15 @@ class Annotate:
                                 an input genome
         output_path           - string. Path to file to output results into
         databases             - string. Path to HMM to use for searching
+        jobs                  - int. Number of genomes to search at once, or a file
+                                containing it (default: --parallel)
+        threads               - int. Number of threads for each search (default: --threads)
         '''
+        if jobs is None:
+            jobs = self.parallel
+
+        if threads is None:
+            threads = self.threads
 
         input_genome_path = path.join(self.output_directory, self.GENOME_PROTEINS)
         cmd = "ls %s | sed 's/%s//g' | parallel -j %s\
@@ -572,8 +718,8 @@ class Annotate:
                                                     -o /dev/null \
                                                     --noali \
                                                     --domtblout %s/{}%s " \
-                          % (input_genome_path, self.PROTEINS_SUFFIX, self.parallel,
-                             self.threads, output_path, self.ANNOTATION_SUFFIX)
+                          % (input_genome_path, self.PROTEINS_SUFFIX, jobs,
+                             threads, output_path, self.ANNOTATION_SUFFIX)
         if hmmcutoff:
             if(self.cut_ga or self.cut_nc or self.cut_tc):
 
@@ -603,10 +749,15 @@ class Annotate:
         output_directory_path = path.join(self.output_directory,
                                           self.GENOME_GFF)
         mkdir(output_directory_path)
-        for genome in genomes_list:
-            logging.info('    - Generating .gff file for %s', genome.name)
+        for done, genome in enumerate(genomes_list, 1):
+            logging.info('    - Generating .gff file for %s', genome.name,
+                         extra=Events.event(Events.STARTED, stage=self.STAGE_GFF, genome=genome.name))
             gff_output = path.join(output_directory_path, genome.name + self.GFF_SUFFIX)
             Writer.write_gff(genome, gff_output)
+            logging.debug('    - Wrote %s', gff_output,
+                          extra=Events.event(Events.FINISHED, stage=self.STAGE_GFF, genome=genome.name,
+                                             bytes=Events.output_size(gff_output), done=done,
+                                             total=len(genomes_list)))
 
     def rename_fasta(self, genomes_list):
         '''
@@ -626,7 +777,7 @@ class Annotate:
 
                 with open(fname_gene, 'w') as out_gene_io:
 
-                    for description, sequence in seqio.each(open(genome.gene)):
+                    for description, sequence in seqio.each(genome.gene):
                         name = description.partition(' ')[0]
                         annotations = ' '.join(genome.sequences[name].all_annotations())
                         out_gene_io.write(">%s %s\n" % (name, annotations))
@@ -638,7 +789,7 @@ class Annotate:
 
             with open(fname, 'w') as out_io:
 
-                for description, sequence in seqio.each(open(genome.path)):
+                for description, sequence in seqio.each(genome.path):
                     name = description.partition(' ')[0]
                     annotations = ' '.join(genome.sequences[name].all_annotations())
                     out_io.write(">%s %s\n" % (name, annotations))
@@ -716,12 +867,354 @@ class Annotate:
                                          path.join(self.output_directory, self.GENOME_BIN))
             prep_genomes_list = self.call_proteins(directory)
 
+        # list_splitter empties prep_genomes_list as it goes
+        genome_count = len(prep_genomes_list)
+
         for chunk in list_splitter(prep_genomes_list, self.chunk_number, self.chunk_max):
-            genomes_list += self.pool.map(parse_genomes, chunk)
+
+            for genome in WorkerPool.map(parse_genomes, chunk, self.processes):
+                genomes_list.append(genome)
+                logging.debug('    - Loaded %i proteins from %s', len(genome.sequences), genome.name,
+                              extra=Events.event(Events.FINISHED, stage=self.STAGE_INPUTS,
+                                                 genome=genome.name, proteins=len(genome.sequences),
+                                                 bytes=Events.output_size(genome.path),
+                                                 done=len(genomes_list), total=genome_count))
 
         return genomes_list
 
-    def annotate_pipeline(self, genome_directory, protein_directory, genome_files, protein_files):
+    def _parameters(self):
+        '''
+        The parameters that determine the results of the annotate pipeline,
+        recorded in the stage manifest so that a resumed run is consistent
+        with the stages that have already been completed.
+        '''
+        return {'ko':self.annotate_ko, 'ko_hmm':self.annotate_ko_hmm, 'pfam':self.annotate_pfam,
+                'tigrfam':self.annotate_tigrfam, 'cluster':self.annotate_cluster,
+                'ortholog':self.annotate_ortholog, 'cazy':self.annotate_cazy,
+                'ec':self.annotate_ec, 'evalue':self.evalue, 'bit':self.bit,
+                'id':self.percent_id_cutoff, 'aln_query':self.aln_query,
+                'aln_reference':self.aln_reference, 'c':self.fraction_aligned,
+                'cut_ga':self.cut_ga, 'cut_nc':self.cut_nc, 'cut_tc':self.cut_tc,
+                'cut_ko':self.cut_hmm, 'inflation':self.inflation,
+                'count_domains':self.count_domains, 'suffix':self.suffix, 'light':self.light,
+                'database':self.databases.DB_VERSION}
+
+    def _store_matrix(self, annotation_type, matrix_generator, genomes_list):
+        '''
+        Keep the frequency matrix for an annotation type, writing it to the
+        output directory unless matrices are only wanted in memory.
+
+        Parameters
+        ----------
+        annotation_type     - String. Key in MATRIX_OUTPUTS for the annotation type
+        matrix_generator    - MatrixGenerator. Generator for the annotation type
+        genomes_list        - List. List of Genome objects
+        '''
+        if self.write_matrices:
+            output_path = path.join(self.output_directory, self.MATRIX_OUTPUTS[annotation_type])
+            matrix = matrix_generator.write_matrix(genomes_list, self.count_domains, output_path)
+        else:
+            matrix = matrix_generator.generate_matrix(genomes_list, self.count_domains)
+            # Saved before the stage is recorded, so a resumed run that skips
+            # the stage can read the matrix back in
+            checkpoint_directory = path.join(self.output_directory, self.CHECKPOINT_MATRICES)
+
+            if not path.isdir(checkpoint_directory):
+                mkdir(checkpoint_directory)
+
+            matrix.write_binary(path.join(checkpoint_directory, self.MATRIX_OUTPUTS[annotation_type]))
+
+        self.matrices[annotation_type] = matrix
+
+    def _load_matrices(self):
+        '''
+        Read in the matrices of stages that were skipped when resuming, from
+        the output directory or, if they were only kept in memory, from the
+        copies saved with the checkpoint.
+        '''
+        for annotation_type, output in self.MATRIX_OUTPUTS.items():
+
+            if annotation_type in self.matrices:
+                continue
+
+            output_path = path.join(self.output_directory, output)
+            checkpoint_path = path.join(self.output_directory, self.CHECKPOINT_MATRICES, output)
+
+            for matrix_path in (output_path, SparseAnnotationMatrix.npz_path(checkpoint_path),
+                                GtdbMatrix.paths(checkpoint_path)[0]):
+
+                if path.isfile(matrix_path):
+                    self.matrices[annotation_type] = AnnotationMatrix.load(matrix_path)
+                    break
+
+    def _plan(self, stage, tool, task_count, cpus):
+        '''
+        Choose the number of concurrent jobs and threads per job to run a
+        tool with, using all the CPUs available. Without a --cpus budget,
+        jobs use --threads threads, and hmmsearch and prodigal run up to
+        --parallel jobs.
+
+        Parameters
+        ----------
+        stage       - String. Name of the stage, for logging
+        tool        - String. Name of the tool being run
+        task_count  - Integer. Number of independent tasks (e.g. genomes)
+        cpus        - Integer. Number of CPUs available to the stage
+
+        Output
+        ------
+        The number of concurrent jobs, and the number of threads for each job
+        '''
+        if self.cpu_budget is None:
+
+            if tool == 'prodigal':
+                return int(self.parallel), 1
+
+            if tool == 'hmmsearch':
+                return max(1, min(int(self.parallel), task_count)), int(self.threads)
+
+            return 1, int(self.threads)
+
+        jobs, threads = plan_cpus(cpus, task_count, tool)
+        logging.info('    - CPU plan for %s: %i %s job(s) x %i thread(s) (%i of %i cpus)',
+                     stage, jobs, tool, threads, jobs * threads, self.cpus)
+
+        return jobs, threads
+
+    def _threads(self, stage, tool, budget):
+        '''
+        Plan the threads of a single job stage (e.g. DIAMOND), fixed when the
+        Scheduler starts the stage.
+
+        Parameters
+        ----------
+        stage   - String. Name of the stage
+        tool    - String. Name of the tool being run
+        budget  - Integer. Number of CPUs shared by the stages
+        '''
+        _, threads = self._plan(stage, tool, 1, budget)
+
+        return Threads(threads)
+
+    def _jobs(self, stage, genome_count, budget):
+        '''
+        Plan the hmmsearch jobs of a stage, which the Scheduler adds to as
+        other stages finish.
+
+        Parameters
+        ----------
+        stage           - String. Name of the stage
+        genome_count    - Integer. Number of genomes searched
+        budget          - Integer. Number of CPUs shared by the stages
+        '''
+        jobs, threads = self._plan(stage, 'hmmsearch', genome_count, budget)
+
+        return ParallelJobs(path.join(self.output_directory, '.%s.jobs' % stage), jobs, threads)
+
+    def _stage_started(self, stage, genomes_list):
+        '''
+        Report that an annotation stage has started.
+
+        Parameters
+        ----------
+        stage           - String. Name of the stage
+        genomes_list    - List. List of Genome objects
+        '''
+        logging.debug('    - Started %s stage', stage,
+                      extra=Events.event(Events.STARTED, stage=stage, genomes=len(genomes_list),
+                                         proteins=sum(len(genome.sequences) for genome in genomes_list)))
+
+    def _stage_finished(self, stage, output_paths):
+        '''
+        Report that an annotation stage has finished, and the progress of
+        the pipeline as a whole. Called while holding merge_lock.
+
+        Parameters
+        ----------
+        stage           - String. Name of the stage
+        output_paths    - List. Files and directories written by the stage
+        '''
+        self.stages_done += 1
+        logging.debug('    - Finished %s stage', stage,
+                      extra=Events.event(Events.FINISHED, stage=stage,
+                                         bytes=Events.output_size(*output_paths)))
+        logging.debug('    - Finished %i of %i annotation stages', self.stages_done, self.stages_total,
+                      extra=Events.event(Events.PROGRESS, stage='annotate', done=self.stages_done,
+                                         total=self.stages_total))
+
+    @contextmanager
+    def _merging(self, genomes_list):
+        '''
+        Hold merge_lock while a stage adds its results to the genomes. If the
+        stage fails part way through, the genomes are put back as they were
+        before the lock is released, so the other stages never record a
+        checkpoint with the partial results of the failed stage.
+
+        Parameters
+        ----------
+        genomes_list    - List. List of Genome objects
+        '''
+        with self.merge_lock:
+            states = [genome.snapshot() for genome in genomes_list]
+
+            try:
+                yield
+            except BaseException:
+                logging.debug('    - Removing partial results from the genomes')
+
+                for genome, state in zip(genomes_list, states):
+                    genome.restore(state)
+
+                raise
+
+    def _matrix_paths(self, *annotation_types):
+        '''
+        Paths of the matrix files written for the given annotation types.
+        '''
+        if not self.write_matrices:
+            return list()
+
+        return [path.join(self.output_directory, self.MATRIX_OUTPUTS[annotation_type])
+                for annotation_type in annotation_types]
+
+    def _hypothetical_stage(self, genomes_list, checkpoint, threads):
+        '''
+        Cluster proteins, then add the clusters and orthologs to each genome.
+        Run by the Scheduler, so results are merged while holding merge_lock.
+
+        Parameters
+        ----------
+        genomes_list    - List. List of Genome objects
+        checkpoint      - Checkpoint. Records that the stage has finished
+        threads         - Threads. Number of threads for mmseqs and mcl
+        '''
+        logging.info('    - Annotating genomes with hypothetical clusters')
+        self._stage_started(self.STAGE_CLUSTER, genomes_list)
+        clu_tsv_path, ortholog_dict, output_directory_path = self.cluster_proteins(genomes_list,
+                                                                                   threads.threads)
+
+        with self._merging(genomes_list):
+            cluster_ids = self.parse_cluster_results(clu_tsv_path, genomes_list,
+                                                     ortholog_dict, output_directory_path)
+
+            logging.info('    - Generating hypotheticals frequency table')
+            matrix_generator = MatrixGenerator(MatrixGenerator.HYPOTHETICAL, cluster_ids)
+            self._store_matrix('cluster', matrix_generator, genomes_list)
+
+            if self.annotate_ortholog:
+                matrix_generator = MatrixGenerator(MatrixGenerator.ORTHOLOG, ortholog_dict.keys())
+                self._store_matrix('ortholog', matrix_generator, genomes_list)
+
+            checkpoint.record(self.STAGE_CLUSTER, genomes_list)
+            self._stage_finished(self.STAGE_CLUSTER,
+                                 [output_directory_path] + self._matrix_paths('cluster', 'ortholog'))
+
+    def _diamond_stage(self, genomes_list, checkpoint, stage, database, ids_type,
+                       output_subdirectory, matrix_type, threads):
+        '''
+        Annotate genomes using DIAMOND. Run by the Scheduler, so results are
+        merged while holding merge_lock.
+
+        Parameters
+        ----------
+        genomes_list        - List. List of Genome objects
+        checkpoint          - Checkpoint. Records that the stage has finished
+        stage               - String. Name of the stage
+        database            - String. Path to the DIAMOND database
+        ids_type            - String. Type of annotation id
+        output_subdirectory - String. Subdirectory of the output directory to write results to
+        matrix_type         - String. MatrixGenerator type for the frequency table
+        threads             - Threads. Number of threads for DIAMOND
+        '''
+        logging.info('    - Annotating genomes with %s ids using DIAMOND', stage)
+        self._stage_started(stage, genomes_list)
+        output_annotation_path = self.diamond_annotation_search(genomes_list, database,
+                                                                output_subdirectory, threads.threads)
+
+        with self._merging(genomes_list):
+            self.add_diamond_annotations(genomes_list, output_annotation_path,
+                                         AnnotationParser.BLASTPARSER, ids_type, stage)
+
+            logging.info('    - Generating %s frequency table', stage)
+            self._store_matrix(stage, MatrixGenerator(matrix_type), genomes_list)
+            checkpoint.record(stage, genomes_list)
+            self._stage_finished(stage, [output_annotation_path] + self._matrix_paths(stage))
+
+    def _hmmsearch_stage(self, genomes_list, checkpoint, stage, database, ids_type,
+                         output_subdirectory, matrix_type, jobs):
+        '''
+        Annotate genomes using hmmsearch. Run by the Scheduler, so results are
+        merged while holding merge_lock.
+
+        Parameters
+        ----------
+        genomes_list        - List. List of Genome objects
+        checkpoint          - Checkpoint. Records that the stage has finished
+        stage               - String. Name of the stage
+        database            - String. Path to the HMM database
+        ids_type            - String. Type of annotation id
+        output_subdirectory - String. Subdirectory of the output directory to write results to
+        matrix_type         - String. MatrixGenerator type for the frequency table
+        jobs                - ParallelJobs. Number of genomes to search at once, and threads for each
+        '''
+        self._hmmsearch_search(genomes_list, stage, database, ids_type, output_subdirectory, jobs)
+        self._hmmsearch_merge(genomes_list, checkpoint, stage, ids_type, output_subdirectory,
+                              matrix_type)
+
+    def _hmmsearch_search(self, genomes_list, stage, database, ids_type, output_subdirectory, jobs):
+        '''
+        Search genomes using hmmsearch, without adding the hits to them.
+
+        Parameters
+        ----------
+        genomes_list        - List. List of Genome objects
+        stage               - String. Name of the stage
+        database            - String. Path to the HMM database
+        ids_type            - String. Type of annotation id
+        output_subdirectory - String. Subdirectory of the output directory to write results to
+        jobs                - ParallelJobs. Number of genomes to search at once, and threads for each
+        '''
+        logging.info('    - Annotating genomes with %s ids using HMMs', stage)
+        self._stage_started(stage, genomes_list)
+        output_directory_path = path.join(self.output_directory, output_subdirectory)
+        mkdir(output_directory_path)
+        hmmcutoff = (ids_type in (AnnotationParser.TIGRFAM, AnnotationParser.PFAM))
+
+        try:
+            # parallel reads the number of jobs from the file, which grows
+            # as other stages finish
+            self.hmm_search(output_directory_path, database, hmmcutoff, jobs.path, jobs.threads)
+        finally:
+            jobs.remove()
+
+    def _hmmsearch_merge(self, genomes_list, checkpoint, stage, ids_type, output_subdirectory,
+                         matrix_type):
+        '''
+        Add the hits found by _hmmsearch_search to each genome, and generate
+        the frequency table. Results are merged while holding merge_lock.
+
+        Parameters
+        ----------
+        genomes_list        - List. List of Genome objects
+        checkpoint          - Checkpoint. Records that the stage has finished
+        stage               - String. Name of the stage
+        ids_type            - String. Type of annotation id
+        output_subdirectory - String. Subdirectory of the output directory the results were written to
+        matrix_type         - String. MatrixGenerator type for the frequency table
+        '''
+        output_directory_path = path.join(self.output_directory, output_subdirectory)
+
+        with self._merging(genomes_list):
+            self.add_hmmsearch_annotations(genomes_list, output_directory_path, ids_type,
+                                           AnnotationParser.HMMPARSER, stage)
+
+            logging.info('    - Generating %s frequency table', stage)
+            self._store_matrix(stage, MatrixGenerator(matrix_type), genomes_list)
+            checkpoint.record(stage, genomes_list)
+            self._stage_finished(stage, [output_directory_path] + self._matrix_paths(stage))
+
+    def annotate_pipeline(self, genome_directory, protein_directory, genome_files, protein_files,
+                          write_matrices=True):
         '''
         Run Annotate pipeline for enrichM
 
@@ -731,124 +1224,156 @@ class Annotate:
         protein_directory   - String. Path to directory containing proteins (.faa files) for genomes
         genome_files        - List. List of strings, each to a .fna genome file.
         protein_files       - List. List of strings, each to a .faa proteins file.
+        write_matrices      - Boolean. Write the frequency matrices to the output directory
+
+        Output
+        ------
+        A dictionary of annotation type (e.g. 'ko', 'pfam') to an AnnotationMatrix,
+        which can be passed directly to Classify.classify_pipeline and
+        Enrichment.enrichment_pipeline.
         '''
 
-        logging.info("Running pipeline: annotate")
-        logging.info("Setting up for genome annotation")
-        genomes_list = self.parse_genome_inputs(genome_directory, protein_directory,
-                                                genome_files, protein_files)
+        logging.info("Running pipeline: annotate",
+                     extra=Events.event(Events.STARTED, stage='annotate'))
+        self.matrices = dict()
+        self.write_matrices = write_matrices
+        input_paths = [input_path for input_path in [genome_directory, protein_directory]
+                       if input_path] + list(genome_files or []) + list(protein_files or [])
+        checkpoint = Checkpoint(self.output_directory, input_paths, self._parameters(), self.resume)
+
+        if checkpoint.finished:
+            logging.info('All annotate stages have already been completed')
+            self._load_matrices()
+            return self.matrices
+
+        if checkpoint.start(self.STAGE_INPUTS, [self.GENOME_BIN, self.GENOME_PROTEINS, self.GENOME_GENES]):
+            logging.info("Setting up for genome annotation",
+                         extra=Events.event(Events.STARTED, stage=self.STAGE_INPUTS))
+            genomes_list = self.parse_genome_inputs(genome_directory, protein_directory,
+                                                    genome_files, protein_files)
+            checkpoint.record(self.STAGE_INPUTS, genomes_list)
+            logging.debug('    - Loaded %i genomes', len(genomes_list),
+                          extra=Events.event(Events.FINISHED, stage=self.STAGE_INPUTS,
+                                             genomes=len(genomes_list)))
+        else:
+            logging.info("Loading genomes from checkpoint")
+            genomes_list = checkpoint.load()
 
         if genomes_list:
             logging.info("Starting annotation:")
-
-            if (self.annotate_cluster or self.annotate_ortholog):
-                logging.info('    - Annotating genomes with hypothetical clusters')
-                cluster_ids, ortholog_ids = self.annotate_hypothetical(genomes_list)
-
-                logging.info('    - Generating hypotheticals frequency table')
-                matrix_generator = MatrixGenerator(MatrixGenerator.HYPOTHETICAL, cluster_ids)
-                freq_table = path.join(self.output_directory, self.OUTPUT_CLUSTER)
-                matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
-
-                if self.annotate_ortholog:
-                    matrix_generator = MatrixGenerator(MatrixGenerator.ORTHOLOG, ortholog_ids)
-                    freq_table = path.join(self.output_directory, self.OUTPUT_ORTHOLOG)
-                    matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
-
-
-            if self.annotate_ko:
-                annotation_type = AnnotationParser.BLASTPARSER
-                logging.info('    - Annotating genomes with ko ids using DIAMOND')
-                self.annotate_diamond(genomes_list, self.databases.KO_DB,
-                                      annotation_type, AnnotationParser.KO,
-                                      self.GENOME_KO)
-
-                logging.info('    - Generating ko frequency table')
-                matrix_generator = MatrixGenerator(MatrixGenerator.KO)
-                freq_table = path.join(self.output_directory, self.OUTPUT_KO)
-                matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
-
-            if self.annotate_ko_hmm:
-                annotation_type = AnnotationParser.HMMPARSER
-                logging.info('    - Annotating genomes with ko ids using HMMs')
-                self.hmmsearch_annotation(genomes_list,
-                                          path.join(
-                                              self.output_directory, self.GENOME_KO_HMM),
-                                          self.databases.KO_HMM_DB,
-                                          AnnotationParser.KO,
-                                          annotation_type)
-
-                logging.info('    - Generating ko frequency table')
-                matrix_generator = MatrixGenerator(MatrixGenerator.KO)
-                freq_table = path.join(
-                    self.output_directory, self.OUTPUT_KO_HMM)
-                matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
-
-            if self.annotate_ec:
-                annotation_type = AnnotationParser.BLASTPARSER
-                logging.info('    - Annotating genomes with ec ids')
-                self.annotate_diamond(genomes_list, self.databases.EC_DB, annotation_type,
-                                      AnnotationParser.EC, self.GENOME_EC)
-
-                logging.info('    - Generating ec frequency table')
-                matrix_generator = MatrixGenerator(MatrixGenerator.EC)
-                freq_table = path.join(self.output_directory, self.OUTPUT_EC)
-                matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
-
-            if self.annotate_pfam:
-                annotation_type = AnnotationParser.HMMPARSER
-                logging.info('    - Annotating genomes with pfam ids')
-                self.hmmsearch_annotation(genomes_list,
-                                          path.join(self.output_directory, self.GENOME_PFAM),
-                                          self.databases.PFAM_DB,
-                                          AnnotationParser.PFAM,
-                                          annotation_type)
-
-                logging.info('    - Generating pfam frequency table')
-                matrix_generator = MatrixGenerator(MatrixGenerator.PFAM)
-                freq_table = path.join(self.output_directory, self.OUTPUT_PFAM)
-                matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
-
-            if self.annotate_tigrfam:
-                annotation_type = AnnotationParser.HMMPARSER
-                logging.info('    - Annotating genomes with tigrfam ids')
-                self.hmmsearch_annotation(genomes_list,
-                                          path.join(self.output_directory, self.GENOME_TIGRFAM),
-                                          self.databases.TIGRFAM_DB,
-                                          AnnotationParser.TIGRFAM,
-                                          annotation_type)
-
-                logging.info('    - Generating tigrfam frequency table')
-                matrix_generator = MatrixGenerator(MatrixGenerator.TIGRFAM)
-                freq_table = path.join(self.output_directory, self.OUTPUT_TIGRFAM)
-                matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
-
-            if self.annotate_cazy:
-                annotation_type = AnnotationParser.HMMPARSER
-                logging.info('    - Annotating genomes with CAZY ids')
-                self.hmmsearch_annotation(genomes_list,
-                                          path.join(self.output_directory, self.GENOME_CAZY),
-                                          self.databases.CAZY_DB,
-                                          AnnotationParser.CAZY,
-                                          annotation_type)
-
-                logging.info('    - Generating CAZY frequency table')
-                matrix_generator = MatrixGenerator(MatrixGenerator.CAZY)
-                freq_table = path.join(self.output_directory, self.OUTPUT_CAZY)
-                matrix_generator.write_matrix(genomes_list, self.count_domains, freq_table)
+            genome_count = len(genomes_list)
+            requested = [stage for stage, flag in
+                         [(self.STAGE_CLUSTER, self.annotate_cluster or self.annotate_ortholog),
+                          (self.STAGE_KO, self.annotate_ko), (self.STAGE_KO_HMM, self.annotate_ko_hmm),
+                          (self.STAGE_EC, self.annotate_ec), (self.STAGE_PFAM, self.annotate_pfam),
+                          (self.STAGE_TIGRFAM, self.annotate_tigrfam), (self.STAGE_CAZY, self.annotate_cazy)]
+                         if flag and not checkpoint.completed(stage)]
+            self.stages_done = 0
+            self.stages_total = len(requested)
+            logging.debug('    - %i annotation stages to run', self.stages_total,
+                          extra=Events.event(Events.PROGRESS, stage='annotate', genomes=genome_count,
+                                             done=0, total=self.stages_total))
+            # Each stage is planned against the whole budget. The Scheduler
+            # shares the budget between the stages running at once, and
+            # gives hmmsearch stages more jobs as the others finish. Without
+            # --cpus, the budget is --parallel x --threads
+            if self.cpu_budget is None:
+                budget = int(self.parallel) * int(self.threads)
+            else:
+                budget = self.cpus
+
+            scheduler = Scheduler(budget)
+
+            if ((self.annotate_cluster or self.annotate_ortholog) and
+                    checkpoint.start(self.STAGE_CLUSTER, [self.GENOME_HYPOTHETICAL])):
+                threads = self._threads(self.STAGE_CLUSTER, 'mmseqs', budget)
+                scheduler.add(self.STAGE_CLUSTER, self._hypothetical_stage,
+                              (genomes_list, checkpoint, threads),
+                              1, max_cpus=threads.planned, resize=threads.resize)
+
+            if self.annotate_ko and checkpoint.start(self.STAGE_KO, [self.GENOME_KO]):
+                threads = self._threads(self.STAGE_KO, 'diamond', budget)
+                scheduler.add(self.STAGE_KO, self._diamond_stage,
+                              (genomes_list, checkpoint, self.STAGE_KO, self.databases.KO_DB,
+                               AnnotationParser.KO, self.GENOME_KO, MatrixGenerator.KO, threads),
+                              1, max_cpus=threads.planned, resize=threads.resize)
+
+            # KO ids found by HMMs are added to those found by DIAMOND, so the
+            # ko_hmm hits are only merged once the ko stage has merged its own.
+            # The search itself can run alongside the DIAMOND search.
+            if self.annotate_ko_hmm and checkpoint.start(self.STAGE_KO_HMM, [self.GENOME_KO_HMM]):
+                jobs = self._jobs(self.STAGE_KO_HMM, genome_count, budget)
+                search_stage = self.STAGE_KO_HMM + '_search'
+                scheduler.add(search_stage, self._hmmsearch_search,
+                              (genomes_list, self.STAGE_KO_HMM, self.databases.KO_HMM_DB,
+                               AnnotationParser.KO, self.GENOME_KO_HMM, jobs),
+                              jobs.threads, max_cpus=jobs.planned * jobs.threads, resize=jobs.resize)
+                scheduler.add(self.STAGE_KO_HMM, self._hmmsearch_merge,
+                              (genomes_list, checkpoint, self.STAGE_KO_HMM, AnnotationParser.KO,
+                               self.GENOME_KO_HMM, MatrixGenerator.KO),
+                              1, [self.STAGE_KO, search_stage])
+
+            if self.annotate_ec and checkpoint.start(self.STAGE_EC, [self.GENOME_EC]):
+                threads = self._threads(self.STAGE_EC, 'diamond', budget)
+                scheduler.add(self.STAGE_EC, self._diamond_stage,
+                              (genomes_list, checkpoint, self.STAGE_EC, self.databases.EC_DB,
+                               AnnotationParser.EC, self.GENOME_EC, MatrixGenerator.EC, threads),
+                              1, max_cpus=threads.planned, resize=threads.resize)
+
+            if self.annotate_pfam and checkpoint.start(self.STAGE_PFAM, [self.GENOME_PFAM]):
+                jobs = self._jobs(self.STAGE_PFAM, genome_count, budget)
+                scheduler.add(self.STAGE_PFAM, self._hmmsearch_stage,
+                              (genomes_list, checkpoint, self.STAGE_PFAM, self.databases.PFAM_DB,
+                               AnnotationParser.PFAM, self.GENOME_PFAM, MatrixGenerator.PFAM, jobs),
+                              jobs.threads, max_cpus=jobs.planned * jobs.threads, resize=jobs.resize)
+
+            if self.annotate_tigrfam and checkpoint.start(self.STAGE_TIGRFAM, [self.GENOME_TIGRFAM]):
+                jobs = self._jobs(self.STAGE_TIGRFAM, genome_count, budget)
+                scheduler.add(self.STAGE_TIGRFAM, self._hmmsearch_stage,
+                              (genomes_list, checkpoint, self.STAGE_TIGRFAM, self.databases.TIGRFAM_DB,
+                               AnnotationParser.TIGRFAM, self.GENOME_TIGRFAM, MatrixGenerator.TIGRFAM, jobs),
+                              jobs.threads, max_cpus=jobs.planned * jobs.threads, resize=jobs.resize)
+
+            if self.annotate_cazy and checkpoint.start(self.STAGE_CAZY, [self.GENOME_CAZY]):
+                jobs = self._jobs(self.STAGE_CAZY, genome_count, budget)
+                scheduler.add(self.STAGE_CAZY, self._hmmsearch_stage,
+                              (genomes_list, checkpoint, self.STAGE_CAZY, self.databases.CAZY_DB,
+                               AnnotationParser.CAZY, self.GENOME_CAZY, MatrixGenerator.CAZY, jobs),
+                              jobs.threads, max_cpus=jobs.planned * jobs.threads, resize=jobs.resize)
+
+            scheduler.run()
 
             if hasattr(list(genomes_list[0].sequences.values())[0], "prod_id"):
-                logging.info('Generating .gff files:')
-                self.generate_gff_files(genomes_list)
-
-                logging.info('Renaming protein headers')
-                self.rename_fasta(genomes_list)
 
-            if not self.light:
-                logging.info('Storing genome objects')
+                if checkpoint.start(self.STAGE_GFF, [self.GENOME_GFF]):
+                    logging.info('Generating .gff files:',
+                                 extra=Events.event(Events.STARTED, stage=self.STAGE_GFF))
+                    self.generate_gff_files(genomes_list)
+                    checkpoint.record(self.STAGE_GFF, genomes_list)
+
+                # Renaming rewrites the headers in place, so it is safe to repeat
+                if checkpoint.start(self.STAGE_RENAME, []):
+                    logging.info('Renaming protein headers')
+                    self.rename_fasta(genomes_list)
+                    checkpoint.record(self.STAGE_RENAME, genomes_list)
+
+            if not self.light and checkpoint.start(self.STAGE_PICKLE, [self.GENOME_OBJ]):
+                logging.info('Storing genome objects',
+                             extra=Events.event(Events.STARTED, stage=self.STAGE_PICKLE))
                 self.pickle_objects(genomes_list)
-
-            logging.info('Finished annotation')
+                checkpoint.record(self.STAGE_PICKLE, genomes_list)
+                logging.debug('    - Stored %i genome objects', len(genomes_list),
+                              extra=Events.event(Events.FINISHED, stage=self.STAGE_PICKLE,
+                                                 bytes=Events.output_size(path.join(self.output_directory,
+                                                                                    self.GENOME_OBJ))))
+
+            checkpoint.finish()
+            self._load_matrices()
+            logging.info('Finished annotation',
+                         extra=Events.event(Events.FINISHED, stage='annotate', genomes=len(genomes_list),
+                                            bytes=Events.output_size(self.output_directory)))
 
         else:
             logging.error('No files found with %s suffix in input directory', self.suffix)
+
+        return self.matrices
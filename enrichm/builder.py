@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Build the mappings of an EnrichM database from local copies of KEGG and
+Pfam files.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import re
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import logging
+import tempfile
+# Local
+from enrichm.workers import WorkerPool
+from enrichm.toolbox import open_file
+###############################################################################
+
+def open_source(path):
+    '''
+    Open a source file as text, decompressing it if it is compressed.
+    '''
+    return open_file(path)
+
+def hash_source(path):
+    '''
+    The sha256 of a source file.
+    '''
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as source_io:
+
+        for block in iter(lambda: source_io.read(1048576), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+def strip_prefix(identifier):
+    # KEGG REST output prefixes identifiers with their database (e.g. rn:R00001)
+    return identifier.split(':')[-1]
+
+def parse_link(path):
+    '''
+    Parse a KEGG link file (e.g. link/ko/reaction) into a dictionary from the
+    first column to a list of the second.
+    '''
+    output_dictionary = dict()
+
+    with open_source(path) as source_io:
+
+        for line in source_io:
+            sline = line.rstrip('\n').split('\t')
+
+            if len(sline) < 2:
+                continue
+
+            key, item = strip_prefix(sline[0]), strip_prefix(sline[1])
+
+            if key in output_dictionary:
+                output_dictionary[key].append(item)
+            else:
+                output_dictionary[key] = [item]
+
+    return output_dictionary
+
+def parse_list(path):
+    '''
+    Parse a KEGG list file (e.g. list/compound) into a dictionary from each
+    identifier to its first name.
+    '''
+    output_dictionary = dict()
+
+    with open_source(path) as source_io:
+
+        for line in source_io:
+            sline = line.rstrip('\n').split('\t')
+
+            if len(sline) < 2:
+                continue
+
+            output_dictionary[strip_prefix(sline[0])] = sline[1].split(';')[0]
+
+    return output_dictionary
+
+def build_link(paths):
+    return [parse_link(paths[0])]
+
+def build_list(paths):
+    return [parse_list(paths[0])]
+
+def build_ko_to_reaction(paths):
+    ko_to_reaction = dict()
+
+    for reaction, kos in parse_link(paths[0]).items():
+
+        for ko in kos:
+
+            if ko in ko_to_reaction:
+                ko_to_reaction[ko].append(reaction)
+            else:
+                ko_to_reaction[ko] = [reaction]
+
+    return [ko_to_reaction]
+
+def build_ko_to_module(paths):
+    ko_to_reaction, = build_ko_to_reaction(paths[:1])
+    reaction_to_module = parse_link(paths[1])
+    ko_to_module = dict()
+
+    for ko, reactions in ko_to_reaction.items():
+
+        for reaction in reactions:
+
+            for module in reaction_to_module.get(reaction, list()):
+
+                if ko not in ko_to_module:
+                    ko_to_module[ko] = list()
+
+                if module not in ko_to_module[ko]:
+                    ko_to_module[ko].append(module)
+
+    return [ko_to_module]
+
+def build_pfam(paths):
+    '''
+    Parse Pfam-A.clans.tsv into the Pfam to clan, clan to name, Pfam to name,
+    Pfam to description and clan to Pfam dictionaries.
+    '''
+    pfam2clan = dict()
+    clan2name = dict()
+    pfam2name = dict()
+    pfam2description = dict()
+    clan2pfam = dict()
+
+    with open_source(paths[0]) as source_io:
+
+        for line in source_io:
+            pfam, clan, clan_name, pfam_name, description = line.rstrip('\n').split('\t')
+
+            if clan.startswith('CL') and len(clan) == 6:
+                pfam2clan[pfam] = clan
+                clan2name[clan] = clan_name
+
+                if clan in clan2pfam:
+                    clan2pfam[clan] += ',' + pfam
+                else:
+                    clan2pfam[clan] = pfam
+
+            pfam2name[pfam] = pfam_name
+            pfam2description[pfam] = description
+
+    return [pfam2clan, clan2name, pfam2name, pfam2description, clan2pfam]
+
+def build_module_definitions(paths):
+    '''
+    Parse the KEGG module flat file into a dictionary from each module to its
+    definition. Modules without a definition are left out.
+    '''
+    module_to_definition = dict()
+    module = None
+
+    with open_source(paths[0]) as source_io:
+
+        for line in source_io:
+
+            if line.startswith('ENTRY'):
+                module = line.split()[1]
+
+            elif line.startswith('DEFINITION') and module is not None:
+                module_to_definition[module] = ' '.join(line.split()[1:])
+
+            elif line.startswith('///'):
+                module = None
+
+    return [module_to_definition]
+
+def build_brite(paths):
+    '''
+    Parse the KEGG compound classification (br08001) into a dictionary from
+    each compound to the names of the levels it is classified under.
+    '''
+    output_dictionary = dict()
+    levels = {'A':None, 'B':None, 'C':None}
+
+    with open_source(paths[0]) as source_io:
+
+        for line in source_io:
+            level = line[:1]
+
+            if level in levels:
+                levels[level] = ' '.join(re.sub('<[^>]+>', '', line[1:]).split())
+
+            elif level == 'D':
+                sline = line.split()
+                compound = sline[1]
+                names = {'A':levels['A'], 'B':levels['B'], 'C':levels['C'], 'D':' '.join(sline[2:])}
+
+                if compound not in output_dictionary:
+                    output_dictionary[compound] = {key:[name] for key, name in names.items()}
+                else:
+
+                    for key, name in names.items():
+                        output_dictionary[compound][key].append(name)
+
+    return [output_dictionary]
+
+def write_pickle(obj, pickle_path):
+    '''
+    Write a pickle, through a temporary file so that readers never see part
+    of it.
+    '''
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(pickle_path))
+
+    try:
+
+        with os.fdopen(file_descriptor, 'wb') as out_io:
+            pickle.dump(obj, out_io)
+
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, pickle_path)
+
+    finally:
+
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+def build_artifacts(task):
+    '''
+    Build the artifacts of one group, and write them to the database. Run in
+    the worker processes.
+
+    Parameters
+    ----------
+    task    - Tuple. Name of the group, name of the build function, source paths, artifact paths
+
+    Output
+    ------
+    The name of the group, and the seconds taken to build it
+    '''
+    group, builder, source_paths, artifact_paths = task
+    start = time.time()
+
+    for obj, artifact_path in zip(BUILDERS[builder](source_paths), artifact_paths):
+        write_pickle(obj, artifact_path)
+
+    return group, time.time() - start
+
+BUILDERS = {'link':build_link,
+            'list':build_list,
+            'ko_to_reaction':build_ko_to_reaction,
+            'ko_to_module':build_ko_to_module,
+            'pfam':build_pfam,
+            'module_definitions':build_module_definitions,
+            'brite':build_brite}
+
+class DatabaseBuilder:
+    '''
+    Builds the mappings of an EnrichM database (the pickles read by
+    Databases) from local copies of the files update_databases.py downloads.
+    KEGG REST files are named after their endpoint, e.g. link/ko/reaction
+    saved as link_ko_reaction.tsv, and any source may be gzipped. Sources
+    are parsed in parallel, and the sha256 of each is recorded in
+    MANIFEST. Artifacts whose sources haven't changed since the last build
+    of this version, or of the installed version, are reused instead of
+    being built again. Everything else the new version needs (the id lists,
+    DIAMOND and HMM databases, GTDB matrices, and mappings whose sources
+    are missing) is linked from the installed version, and the new version
+    is only installed if nothing is missing.
+    '''
+    MANIFEST = 'build_manifest.json'
+    # Files of a version that aren't built from the sources, and must be
+    # carried over from the installed version
+    REQUIRED = ['ids', 'databases', 'gtdb', 'ko_cutoffs.tsv', 'taxonomy_gtdb.tsv']
+    # Files of the installed version that are not carried over: those written
+    # by the build, and those compiled from the mappings (see 'enrichm data
+    # --compile'), which are out of date once the mappings are rebuilt
+    NOT_CARRIED = ['VERSION', MANIFEST, 'mappings.sqlite', 'reaction_ids.npz']
+    NOT_CARRIED_PREFIXES = ['parsed_modules.']
+    # Mappings derived from others, which Databases derives itself when they
+    # are missing. Neither required nor carried over, as they may be out of
+    # date with the mappings they are derived from.
+    DERIVED = ['ko_to_reaction', 'ko_to_module', 'compound_to_module']
+    # Increase when the output of any build function changes, so that
+    # everything is rebuilt
+    BUILDER_VERSION = 1
+    # Group name, build function, sources, artifacts
+    GROUPS = [('reaction_to_orthology', 'link', ['link_ko_reaction.tsv'], ['reaction_to_orthology']),
+              ('reaction_to_compound', 'link', ['link_compound_reaction.tsv'], ['reaction_to_compound']),
+              ('compound_to_reaction', 'link', ['link_reaction_compound.tsv'], ['compound_to_reaction']),
+              ('reaction_to_module', 'link', ['link_module_reaction.tsv'], ['reaction_to_module']),
+              ('module_to_reaction', 'link', ['link_reaction_module.tsv'], ['module_to_reaction']),
+              ('reaction_to_pathway', 'link', ['link_pathway_reaction.tsv'], ['reaction_to_pathway']),
+              ('pathway_to_reaction', 'link', ['link_reaction_pathway.tsv'], ['pathway_to_reaction']),
+              ('compound_descriptions', 'list', ['list_compound.tsv'], ['compound_descriptions']),
+              ('reaction_descriptions', 'list', ['list_reaction.tsv'], ['reaction_descriptions']),
+              ('pathway_descriptions', 'list', ['list_pathway.tsv'], ['pathway_descriptions']),
+              ('module_descriptions', 'list', ['list_module.tsv'], ['module_descriptions']),
+              ('ko_descriptions', 'list', ['list_ko.tsv'], ['ko_descriptions']),
+              ('ko_to_reaction', 'ko_to_reaction', ['link_ko_reaction.tsv'], ['ko_to_reaction']),
+              ('ko_to_module', 'ko_to_module', ['link_ko_reaction.tsv', 'link_module_reaction.tsv'], ['ko_to_module']),
+              ('module_to_definition', 'module_definitions', ['module'], ['module_to_definition']),
+              ('br08001', 'brite', ['br08001.keg'], ['br08001']),
+              ('pfam', 'pfam', ['Pfam-A.clans.tsv'],
+               ['pfam_to_clan', 'clan_to_name', 'pfam_to_name', 'pfam_to_description', 'clan_to_pfam'])]
+
+    def __init__(self, source_directory, database_directory, version, processes):
+        '''
+        Parameters
+        ----------
+        source_directory    - String. Directory with the KEGG and Pfam files
+        database_directory  - String. Database directory to build in (the directory with the VERSION file)
+        version             - String. Name of the version to build. Defaults to today's date
+        processes           - Integer. Number of sources to parse at once
+        '''
+        self.source_directory = source_directory
+        self.database_directory = database_directory
+        self.version = version or time.strftime("%d-%m-%Y")
+        self.processes = processes
+        self.version_directory = os.path.join(database_directory, self.version)
+
+    def _source_path(self, source):
+        for file_name in [source, source + '.gz']:
+            path = os.path.join(self.source_directory, file_name)
+
+            if os.path.isfile(path):
+                return path
+
+        return None
+
+    def _artifact_path(self, version_directory, pickle_version, artifact):
+        return os.path.join(version_directory, '.'.join([artifact, pickle_version, 'pickle']))
+
+    @staticmethod
+    def _write_text(path, text):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        with os.fdopen(file_descriptor, 'w') as out_io:
+            out_io.write(text)
+
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+
+    def _installed_directory(self):
+        '''
+        The directory of the installed version, or None if there isn't one.
+        '''
+        version_path = os.path.join(self.database_directory, 'VERSION')
+
+        if not os.path.isfile(version_path):
+            return None
+
+        with open(version_path) as version_io:
+            installed = version_io.readline().strip().replace('.tar.gz', '')
+
+        installed_directory = os.path.join(self.database_directory, installed)
+
+        if not os.path.isfile(os.path.join(installed_directory, 'VERSION')):
+            return None
+
+        return installed_directory
+
+    @staticmethod
+    def _link(source_path, destination_path):
+        # Hard linked where possible, so that unchanged files take no space
+        try:
+            os.link(source_path, destination_path)
+        except OSError:
+            shutil.copy2(source_path, destination_path)
+
+    def _previous_builds(self):
+        '''
+        The builds whose artifacts can be reused: this version, if it has
+        been built before, and the installed version.
+
+        Output
+        ------
+        A list of the directory, pickle version and manifest of each build
+        '''
+        directories = [self.version_directory]
+        installed_directory = self._installed_directory()
+
+        if installed_directory is not None:
+            directories.append(installed_directory)
+
+        previous_builds = list()
+
+        for directory in directories:
+            manifest_path = os.path.join(directory, self.MANIFEST)
+            pickle_version_path = os.path.join(directory, 'VERSION')
+
+            if not (os.path.isfile(manifest_path) and os.path.isfile(pickle_version_path)):
+                continue
+
+            with open(manifest_path) as manifest_io:
+                manifest = json.load(manifest_io)
+
+            if manifest.get('builder_version') != self.BUILDER_VERSION:
+                continue
+
+            with open(pickle_version_path) as pickle_version_io:
+                pickle_version = pickle_version_io.readline().strip()
+
+            previous_builds.append((directory, pickle_version, manifest['groups']))
+
+        return previous_builds
+
+    def _reuse(self, group, artifacts, source_hashes, previous_builds):
+        '''
+        Reuse the artifacts of a group from a previous build, if its sources
+        are unchanged. Artifacts of other versions are hard linked (or copied
+        if they can't be) under the name of this version.
+
+        Output
+        ------
+        Whether the artifacts were reused
+        '''
+        for directory, pickle_version, manifest in previous_builds:
+            previous_paths = [self._artifact_path(directory, pickle_version, artifact) for artifact in artifacts]
+
+            if manifest.get(group) != source_hashes or not all(os.path.isfile(path) for path in previous_paths):
+                continue
+
+            for artifact, previous_path in zip(artifacts, previous_paths):
+                artifact_path = self._artifact_path(self.version_directory, self.version, artifact)
+
+                if os.path.abspath(previous_path) == os.path.abspath(artifact_path):
+                    continue
+
+                if os.path.exists(artifact_path):
+                    os.remove(artifact_path)
+
+                self._link(previous_path, artifact_path)
+
+            return True
+
+        return False
+
+    def _carry_over(self, artifacts):
+        '''
+        Link the files of the installed version that this build doesn't make
+        (the id lists, DIAMOND and HMM databases, GTDB matrices, and mappings
+        without a source) into the new version. Pickles are renamed to the
+        new version.
+
+        Parameters
+        ----------
+        artifacts   - Set. Artifacts built or reused by this build, which are not carried over
+
+        Output
+        ------
+        The names of the files carried over
+        '''
+        installed_directory = self._installed_directory()
+
+        if installed_directory is None or \
+           os.path.abspath(installed_directory) == os.path.abspath(self.version_directory):
+            return list()
+
+        with open(os.path.join(installed_directory, 'VERSION')) as pickle_version_io:
+            pickle_suffix = '.%s.pickle' % pickle_version_io.readline().strip()
+
+        carried = list()
+
+        for file_name in sorted(os.listdir(installed_directory)):
+
+            if file_name in self.NOT_CARRIED or file_name.startswith(tuple(self.NOT_CARRIED_PREFIXES)):
+                continue
+
+            new_name = file_name
+
+            if file_name.endswith(pickle_suffix):
+                artifact = file_name[:-len(pickle_suffix)]
+
+                if artifact in artifacts or artifact in self.DERIVED:
+                    continue
+
+                new_name = os.path.basename(self._artifact_path(self.version_directory, self.version, artifact))
+
+            source_path = os.path.join(installed_directory, file_name)
+            destination_path = os.path.join(self.version_directory, new_name)
+
+            if os.path.lexists(destination_path):
+                continue
+
+            if os.path.isdir(source_path):
+                shutil.copytree(source_path, destination_path, symlinks=True, copy_function=self._link)
+            else:
+                self._link(source_path, destination_path)
+
+            carried.append(new_name)
+
+        return carried
+
+    def _missing(self):
+        '''
+        The artifacts and required files that the new version doesn't have.
+        '''
+        missing = [os.path.basename(self._artifact_path(self.version_directory, self.version, artifact))
+                   for _, _, _, artifacts in self.GROUPS for artifact in artifacts
+                   if artifact not in self.DERIVED]
+        missing += self.REQUIRED
+
+        return [file_name for file_name in missing
+                if not os.path.exists(os.path.join(self.version_directory, file_name))]
+
+    def build(self):
+        '''
+        Build the database, and make it the installed version once it is
+        complete.
+
+        Output
+        ------
+        The names of the groups that were built, rather than reused
+        '''
+        previous_builds = self._previous_builds()
+        os.makedirs(self.version_directory, exist_ok=True)
+
+        sources = {source:self._source_path(source) for _, _, group_sources, _ in self.GROUPS
+                   for source in group_sources}
+
+        for source, path in sources.items():
+
+            if path is None:
+                logging.warning("Source %s not found in %s, the mappings built from it will be taken from the installed version"
+                                % (source, self.source_directory))
+
+        paths = sorted(set(path for path in sources.values() if path is not None))
+        logging.info("Hashing %i source files" % len(paths))
+        hashes = dict(zip(paths, WorkerPool.map(hash_source, paths, self.processes)))
+
+        manifest = dict()
+        tasks = list()
+
+        for group, builder, group_sources, artifacts in self.GROUPS:
+
+            if any(sources[source] is None for source in group_sources):
+                continue
+
+            source_paths = [sources[source] for source in group_sources]
+            source_hashes = {os.path.basename(path):hashes[path] for path in source_paths}
+            manifest[group] = source_hashes
+
+            if self._reuse(group, artifacts, source_hashes, previous_builds):
+                logging.info("    - %s is up to date" % group)
+                continue
+
+            tasks.append((group, builder, source_paths,
+                          [self._artifact_path(self.version_directory, self.version, artifact) for artifact in artifacts]))
+
+        logging.info("Building %i of %i groups of mappings using %i processes" % (len(tasks), len(manifest), self.processes))
+
+        for group, seconds in WorkerPool.map(build_artifacts, tasks, self.processes):
+            logging.info("    - Built %s in %.1f seconds" % (group, seconds))
+
+        artifacts = set(artifact for group, _, _, group_artifacts in self.GROUPS
+                        if group in manifest for artifact in group_artifacts)
+        carried = self._carry_over(artifacts)
+
+        if carried:
+            logging.info("Carried over %i files from the installed version" % len(carried))
+
+        missing = self._missing()
+
+        if missing:
+            raise Exception("Unable to build database %s, these files were neither built from %s nor found in the installed version: %s"
+                            % (self.version, self.source_directory, ', '.join(missing)))
+
+        self._write_text(os.path.join(self.version_directory, 'VERSION'), self.version + '\n')
+        self._write_text(os.path.join(self.version_directory, self.MANIFEST),
+                         json.dumps({'builder_version':self.BUILDER_VERSION, 'groups':manifest}, indent=1, sort_keys=True))
+        # Switch to the new version last, so that an interrupted build never
+        # replaces a working database
+        self._write_text(os.path.join(self.database_directory, 'VERSION'), self.version + '.tar.gz\n')
+        logging.info("Built database %s in %s" % (self.version, self.database_directory))
+
+        return [task[0] for task in tasks]
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Record the stages of a pipeline that have completed, so that an interrupted
+run can be resumed.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import logging
+import tempfile
+###############################################################################
+
+def atomic_write(output_path, content, mode='w'):
+    '''
+    Write content to a temporary file beside output_path, then move it into
+    place so that readers never see a partially written file.
+
+    Parameters
+    ----------
+    output_path - String. Path to write to
+    content     - String or bytes. Content to write
+    mode        - String. Mode to open the temporary file with
+    '''
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)))
+
+    try:
+        with os.fdopen(file_descriptor, mode) as out_io:
+            out_io.write(content)
+
+        os.replace(tmp_path, output_path)
+    except BaseException:
+
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        raise
+
+class Checkpoint:
+    '''
+    A manifest of the completed stages of a pipeline, along with the hash of
+    the inputs and the parameters they were run with. The state of the
+    pipeline after the most recently completed stage is kept in a pickle
+    alongside the manifest.
+    '''
+    MANIFEST = 'stage_manifest.json'
+    STATE = 'stage_checkpoint.pickle'
+    INPUT = 'input'
+    PARAMETERS = 'parameters'
+    STAGES = 'stages'
+    STAGE = 'stage'
+    FINISHED = 'finished'
+
+    def __init__(self, output_directory, input_paths, parameters, resume):
+        '''
+        Parameters
+        ----------
+        output_directory    - String. Path to the pipeline's output directory
+        input_paths         - List. Paths to the files or directories used as input
+        parameters          - Dict. Parameters that affect the results of the pipeline
+        resume              - Boolean. Reuse the stages recorded in an existing manifest
+        '''
+        self.output_directory = output_directory
+        self.manifest_path = os.path.join(output_directory, self.MANIFEST)
+        self.state_path = os.path.join(output_directory, self.STATE)
+        # Round trip through json so that tuples etc. compare equal to a loaded manifest
+        self.parameters = json.loads(json.dumps(parameters))
+        self.input_hash = self.hash_inputs(input_paths)
+        self.manifest = {self.INPUT:self.input_hash,
+                         self.PARAMETERS:self.parameters,
+                         self.STAGES:list(),
+                         self.FINISHED:False}
+
+        if resume and os.path.isfile(self.manifest_path):
+
+            with open(self.manifest_path) as manifest_io:
+                manifest = json.load(manifest_io)
+
+            if manifest[self.INPUT] != self.input_hash:
+                raise Exception("Unable to resume: the input files have changed since %s was written. Use --force to start again." % self.manifest_path)
+
+            if manifest[self.PARAMETERS] != self.parameters:
+                raise Exception("Unable to resume: the parameters differ from those recorded in %s. Use --force to start again." % self.manifest_path)
+
+            if manifest[self.STAGES] and not (manifest[self.FINISHED] or os.path.isfile(self.state_path)):
+                raise Exception("Unable to resume: checkpoint %s is missing. Use --force to start again." % self.state_path)
+
+            self.manifest = manifest
+            completed = [stage[self.STAGE] for stage in manifest[self.STAGES]]
+
+            if completed:
+                logging.info("Resuming. Completed stages: %s", ', '.join(completed))
+
+    @staticmethod
+    def hash_inputs(input_paths):
+        '''
+        Hash the names, sizes and modification times of the input files.
+        Directories are hashed by the files within them.
+
+        Parameters
+        ----------
+        input_paths - List. Paths to the files or directories used as input
+
+        Output
+        ------
+        A hex digest of the inputs
+        '''
+        input_hash = hashlib.md5()
+
+        for input_path in input_paths:
+
+            if os.path.isdir(input_path):
+                file_paths = sorted(os.path.join(input_path, file) for file in os.listdir(input_path))
+            else:
+                file_paths = [input_path]
+
+            for file_path in file_paths:
+                file_stat = os.stat(file_path)
+                input_hash.update(('%s\t%i\t%f\n' % (os.path.abspath(file_path), file_stat.st_size,
+                                                     file_stat.st_mtime)).encode())
+
+        return input_hash.hexdigest()
+
+    @property
+    def finished(self):
+        return self.manifest[self.FINISHED]
+
+    def completed(self, stage):
+        '''
+        Check whether a stage has already been completed.
+
+        Parameters
+        ----------
+        stage   - String. Name of the stage
+        '''
+        return stage in [entry[self.STAGE] for entry in self.manifest[self.STAGES]]
+
+    def start(self, stage, directories):
+        '''
+        Prepare to run a stage. Returns False if the stage has already been
+        completed, otherwise removes any partial output left by a previous
+        attempt at the stage and returns True.
+
+        Parameters
+        ----------
+        stage       - String. Name of the stage
+        directories - List. Subdirectories of the output directory written by the stage
+        '''
+        if self.completed(stage):
+            logging.info('    - Skipping completed stage: %s', stage)
+            return False
+
+        for directory in directories:
+            directory_path = os.path.join(self.output_directory, directory)
+
+            if os.path.isdir(directory_path):
+                logging.debug('Removing partial output from a previous run: %s', directory_path)
+                shutil.rmtree(directory_path)
+
+        return True
+
+    def record(self, stage, state):
+        '''
+        Record that a stage has been completed. The state is written before the
+        manifest, so the manifest never lists a stage whose state was lost.
+
+        Parameters
+        ----------
+        stage   - String. Name of the stage
+        state   - Object. Pickleable state of the pipeline after the stage
+        '''
+        atomic_write(self.state_path, pickle.dumps(state), 'wb')
+        self.manifest[self.STAGES].append({self.STAGE:stage,
+                                           self.INPUT:self.input_hash,
+                                           self.PARAMETERS:self.parameters,
+                                           'time':time.strftime("%Y-%m-%d %H:%M:%S")})
+        self._write_manifest()
+
+    def load(self):
+        '''
+        Load the state of the pipeline after the most recently completed stage.
+        '''
+        with open(self.state_path, 'rb') as state_io:
+            return pickle.load(state_io)
+
+    def finish(self):
+        '''
+        Mark the pipeline as finished, and remove the state checkpoint.
+        '''
+        self.manifest[self.FINISHED] = True
+        self._write_manifest()
+
+        if os.path.isfile(self.state_path):
+            os.remove(self.state_path)
+
+    def _write_manifest(self):
+        atomic_write(self.manifest_path, json.dumps(self.manifest, indent=1))
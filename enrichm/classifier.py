@@ -26,10 +26,9 @@ import logging
 from itertools import chain
 # Local
 from enrichm.databases import Databases
-from enrichm.module_description_parser import ModuleDescription
 from enrichm.parser import Parser
 from enrichm.writer import Writer
-from enrichm.toolbox import get_present_annotations
+from enrichm.profiler import Profiler
 ###############################################################################
 
 class Classify:
@@ -38,7 +37,7 @@ class Classify:
     '''
 
     def __init__(self):
-        databases = Databases()
+        databases = self.databases = Databases()
         self.signature_modules = databases.signature_modules
         self.m2def = databases.m2def()
         self.modules = databases.m()
@@ -59,6 +58,9 @@ class Classify:
             for line in custom_modules_io:
                 custom_modules_dict[line.split('\t')[0]] = line.strip().split('\t')[1]
 
+        # Copy first, the loaded modules may be shared with other jobs
+        self.m2def = dict(self.m2def)
+        self.modules = dict(self.modules)
         self.m2def.update(custom_modules_dict)
 
         for key in custom_modules_dict:
@@ -67,6 +69,7 @@ class Classify:
     def aggregate(self):
         pass
 
+    @Profiler.profile('Classify.classify_pipeline')
     def classify_pipeline(self, custom_modules, cutoff, aggregate, genome_and_annotation_matrix,
                           output_directory):
         '''
@@ -78,7 +81,9 @@ class Classify:
                                           (http://www.genome.jp/kegg/module.html)
         cutoff                          - float. Fraction of a module needed in order to be included
                                           in the output.
-        genome_and_annotation_matrix    - string. Path to file containing genome - annotation matrix
+        genome_and_annotation_matrix    - string or AnnotationMatrix. Path to file containing genome -
+                                          annotation matrix, or a matrix returned by
+                                          Annotate.annotate_pipeline
         output                          - string. Path to file to output results to.
 
         '''
@@ -90,12 +95,12 @@ class Classify:
             logging.info('Reading in custom modules: %s' % custom_modules)
             self.update_with_custom_modules(custom_modules)
 
-        genome_to_annotation_sets, _, _ = Parser.parse_simple_matrix(genome_and_annotation_matrix)
+        matrix = Parser.parse_matrix(genome_and_annotation_matrix)
+        # The annotations present in each genome, found once for all modules
+        genome_to_annotation_sets = {genome:matrix.present(genome) for genome in matrix.colnames}
 
         if aggregate:
-            logging.info('Reading in abundances: %s' %
-                         (genome_and_annotation_matrix))
-            abundances, _, _ = Parser.parse_simple_matrix(genome_and_annotation_matrix)
+            abundances = matrix.values
             abundance_result = dict()
 
         logging.info("Read in annotations for %i genomes" % len(genome_to_annotation_sets))
@@ -105,51 +110,47 @@ class Classify:
 
         genome_output_lines = [["Genome_name", "Module_id", "Module_name"]]
 
-        for name, pathway_string in self.m2def.items():
+        for name, path in self.databases.parsed_modules(self.m2def).items():
+            pathway[name] = path
 
-            if name not in self.signature_modules:
-                path = ModuleDescription(pathway_string)
-                pathway[name] = path
+            for genome, annotations in genome_to_annotation_sets.items():
+                num_covered, _, _, ko_path = path.num_covered_steps(annotations)
+                num_all = path.num_steps()
+                perc_covered = num_covered / float(num_all)
+                ko_path_list = list(chain(*ko_path.values()))
 
-                for genome, annotation_frequency in genome_to_annotation_sets.items():
-                    annotations = get_present_annotations(annotation_frequency)
-                    num_covered, _, _, ko_path = path.num_covered_steps(annotations)
-                    num_all = path.num_steps()
-                    perc_covered = num_covered / float(num_all)
-                    ko_path_list = list(chain(*ko_path.values()))
+                if perc_covered >= cutoff:
 
-                    if perc_covered >= cutoff:
+                    if path.is_single_step:
 
-                        if path.is_single_step:
+                        if perc_covered != 1:
 
-                            if perc_covered != 1:
-
-                                if cutoff < 1:
-                                    num_all = 1
-                                    num_covered = 0
-                                    perc_covered = 0.0
-
-                                else:
-                                    continue
+                            if cutoff < 1:
+                                num_all = 1
+                                num_covered = 0
+                                perc_covered = 0.0
 
                             else:
-                                num_all = 1
-                                num_covered = 1
+                                continue
 
-                        if aggregate:
+                        else:
+                            num_all = 1
+                            num_covered = 1
 
-                            if genome not in abundance_result:
-                                abundance_result[genome] = dict()
+                    if aggregate:
 
-                            pathway_abundance = [abundances[genome][ko] for ko in ko_path_list]
-                            if len(pathway_abundance)>0:
-                                pathway_average_abundance = sum(pathway_abundance) / len(pathway_abundance)
-                            else:
-                                pathway_average_abundance = 0
-                            abundance_result[genome][name] = pathway_average_abundance
-                        genome_output_lines.append([genome, name, self.modules[name], ','.join(ko_path_list)])
-                        output_line = [genome, name, self.modules[name], str(num_covered), str(num_all), str(round(perc_covered * 100, 2))]
-                        output_lines.append(output_line)
+                        if genome not in abundance_result:
+                            abundance_result[genome] = dict()
+
+                        pathway_abundance = [abundances[genome][ko] for ko in ko_path_list]
+                        if len(pathway_abundance)>0:
+                            pathway_average_abundance = sum(pathway_abundance) / len(pathway_abundance)
+                        else:
+                            pathway_average_abundance = 0
+                        abundance_result[genome][name] = pathway_average_abundance
+                    genome_output_lines.append([genome, name, self.modules[name], ','.join(ko_path_list)])
+                    output_line = [genome, name, self.modules[name], str(num_covered), str(num_all), str(round(perc_covered * 100, 2))]
+                    output_lines.append(output_line)
 
         Writer.write(output_lines, os.path.join(output_directory, self.ko_output))
         Writer.write(genome_output_lines, os.path.join(output_directory, self.module_paths))
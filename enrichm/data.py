@@ -17,14 +17,134 @@
 ###############################################################################
 # Imports
 import os
-import urllib
+import time
 import shutil
+import hashlib
 import logging
+import tarfile
+import tempfile
+import http.client
+import urllib.error
+import urllib.request
 from pathlib import Path
 from enrichm.toolbox import run_command
 # Local
 ###############################################################################
 
+class ResumableDownload:
+    '''
+    A file-like object reading from a URL. If the connection drops, the
+    download is picked up where it left off with an HTTP Range request,
+    so the reader (e.g. tarfile) sees one uninterrupted stream. The sha256
+    of everything read is kept as it goes.
+    '''
+    # Connection timeout, in seconds
+    TIMEOUT = 60
+
+    def __init__(self, url, retries, retry_wait):
+        '''
+        Parameters
+        ----------
+        url         - String. URL to download
+        retries     - Integer. Number of times to resume after the connection drops
+        retry_wait  - Integer. Seconds to wait before the first retry, doubled for each after
+        '''
+        self.url = url
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.offset = 0
+        self.length = None
+        self.resumed = 0
+        self.sha256 = hashlib.sha256()
+        self.response = None
+        self.next_progress = 0.1
+
+    def _open(self):
+        request = urllib.request.Request(self.url)
+
+        if self.offset:
+            request.add_header('Range', 'bytes=%i-' % self.offset)
+
+        response = urllib.request.urlopen(request, timeout=self.TIMEOUT)
+
+        if self.offset:
+
+            if response.status == 206:
+                content_range = response.headers.get('Content-Range', '')
+
+                if not content_range.startswith('bytes %i-' % self.offset):
+                    response.close()
+                    raise Exception("Server resumed %s from the wrong place: %s" % (self.url, content_range))
+
+            else:
+                logging.warning("Server doesn't support resuming downloads, skipping the %i bytes already read" % self.offset)
+                to_skip = self.offset
+
+                while to_skip:
+                    skipped = response.read(min(to_skip, 1048576))
+
+                    if not skipped:
+                        raise http.client.IncompleteRead(b'', to_skip)
+
+                    to_skip -= len(skipped)
+
+        elif response.headers.get('Content-Length'):
+            self.length = int(response.headers['Content-Length'])
+
+        self.response = response
+
+    def read(self, size=-1):
+        attempt = 0
+
+        while True:
+
+            try:
+
+                if self.response is None:
+                    self._open()
+
+                data = self.response.read(size if size >= 0 else None)
+
+                # Reads of part of a response return nothing, rather than
+                # raising, if the connection closes early
+                if not data and size != 0 and self.length and self.offset < self.length:
+                    raise http.client.IncompleteRead(data, self.length - self.offset)
+
+                break
+
+            except urllib.error.HTTPError:
+                raise
+
+            except (OSError, http.client.HTTPException) as error:
+
+                if self.response is not None:
+                    self.response.close()
+                    self.response = None
+
+                attempt += 1
+
+                if attempt > self.retries:
+                    raise Exception("Unable to download %s, gave up after %i retries: %s"
+                                    % (self.url, self.retries, error))
+
+                logging.warning("Download interrupted after %i bytes (%s), resuming" % (self.offset, error))
+                self.resumed += 1
+                time.sleep(self.retry_wait * 2 ** (attempt - 1))
+
+        self.offset += len(data)
+        self.sha256.update(data)
+
+        if self.length and self.offset >= self.length * self.next_progress:
+            logging.info("    - %i%% downloaded" % (100 * self.offset // self.length))
+            self.next_progress = (10 * self.offset // self.length + 1) / 10
+
+        return data
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
 class Data:
     '''
     Utilities for archiving, downloading and updating databases.
@@ -37,6 +157,10 @@ class Data:
         DATABASE_DIR	= os.path.join(DATA_PATH, 'databases')
     VERSION 		= 'VERSION'
     ARCHIVE_SUFFIX 	= '.tar.gz'
+    CHECKSUM_SUFFIX = '.sha256'
+    STAGING_PREFIX  = '.staging-'
+    RETRIES         = 10
+    RETRY_WAIT      = 5
 
     def __init__(self):
         self.ftp = 'https://data.ace.uq.edu.au/public/enrichm/'
@@ -67,35 +191,136 @@ class Data:
         logging.info('Cleaning up')
         shutil.rmtree(old_db_path)
 
+    def _checksum(self, new_db_file):
+        '''
+        The published sha256 of a database archive, or None if there isn't one.
+
+        Parameters
+        ----------
+        new_db_file	- String. File name of the database archive
+        '''
+        try:
+            checksum_line = urllib.request.urlopen(self.ftp + new_db_file + self.CHECKSUM_SUFFIX,
+                                                   timeout=ResumableDownload.TIMEOUT).readline()
+
+        except urllib.error.HTTPError as error:
+
+            if error.code == 404:
+                return None
+
+            raise
+
+        # Either just the checksum, or in the format written by sha256sum
+        return checksum_line.decode("utf-8").split()[0].lower()
+
     def _download_db(self, new_db_file):
         '''
-        Download and decompress a new database file
+        Download a new database, decompressing it as it downloads into a
+        staging directory within the database directory. Nothing is written
+        outside the staging directory, which is removed if the download
+        fails or the archive doesn't match its published checksum.
 
         Parameters
         ----------
         new_db_file	- String. File name of new database to download and decompress.
+
+        Output
+        ------
+        The staging directory the database was decompressed into
         '''
+        checksum = self._checksum(new_db_file)
 
-        new_db_path_archive \
-            = os.path.join(self.DATABASE_DIR, new_db_file)
-        
-        logging.info('Downloading new database: %s', new_db_file)
-        cmd = f'wget \
-                    -q {self.ftp + new_db_file} \
-                    -O {new_db_path_archive}'
-        run_command(cmd)
-        
-        cmd = f'wget \
-                    -q {self.ftp + self.VERSION} \
-                    -O {os.path.join(self.DATABASE_DIR, self.VERSION)}'
-        run_command(cmd)
+        if checksum is None:
+            logging.warning('No checksum published for %s, unable to verify the download' % new_db_file)
 
-        logging.info('Decompressing new database')
-        cmd = 'tar -xvzf %s -C %s > /dev/null' % (new_db_path_archive, self.DATABASE_DIR)
-        run_command(cmd)
+        staging_directory = tempfile.mkdtemp(prefix=self.STAGING_PREFIX, dir=self.DATABASE_DIR)
+        download = ResumableDownload(self.ftp + new_db_file, self.RETRIES, self.RETRY_WAIT)
+        logging.info('Downloading and decompressing new database: %s', new_db_file)
 
-        logging.info('Cleaning up')
-        os.remove(new_db_path_archive)
+        try:
+
+            with tarfile.open(fileobj=download, mode='r|gz') as archive:
+
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extractall(staging_directory, filter='data')
+                else:
+                    archive.extractall(staging_directory, members=self._safe_members(archive, staging_directory))
+
+            # Read the padding after the end of the archive, so it is checksummed
+            while download.read(1048576):
+                pass
+
+            if checksum is not None and download.sha256.hexdigest() != checksum:
+                raise Exception("Downloaded database %s doesn't match its checksum (expected %s, got %s)"
+                                % (new_db_file, checksum, download.sha256.hexdigest()))
+
+        except BaseException:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+            raise
+
+        finally:
+            download.close()
+
+        logging.info('Downloaded %i bytes%s' % (download.offset,
+                                                ', resumed %i times' % download.resumed if download.resumed else ''))
+
+        return staging_directory
+
+    @staticmethod
+    def _safe_members(archive, directory):
+        # For Pythons without extraction filters: skip anything that would be
+        # written outside the directory
+        directory = os.path.realpath(directory)
+
+        for member in archive:
+            member_path = os.path.realpath(os.path.join(directory, member.name))
+
+            if (member_path.startswith(directory + os.sep) and
+                not member.issym() and not member.islnk() and not member.isdev()):
+                yield member
+            else:
+                logging.warning('Skipping %s in database archive' % member.name)
+
+    def _install_db(self, staging_directory, new_db_file):
+        '''
+        Move a downloaded database into place, and then point the VERSION file
+        at it. VERSION is replaced in one step, so it always names a complete
+        database.
+
+        Parameters
+        ----------
+        staging_directory   - String. Directory the database was decompressed into
+        new_db_file         - String. File name of the new database
+        '''
+        for file in os.listdir(staging_directory):
+            file_path = os.path.join(self.DATABASE_DIR, file)
+
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            elif os.path.exists(file_path):
+                os.remove(file_path)
+
+            os.rename(os.path.join(staging_directory, file), file_path)
+
+        os.rmdir(staging_directory)
+
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.DATABASE_DIR)
+
+        with os.fdopen(file_descriptor, 'w') as out_io:
+            out_io.write(new_db_file + '\n')
+
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, os.path.join(self.DATABASE_DIR, self.VERSION))
+
+    def _clean_staging(self):
+        '''
+        Remove staging directories left by downloads that were killed.
+        '''
+        for file in os.listdir(self.DATABASE_DIR):
+
+            if file.startswith(self.STAGING_PREFIX):
+                logging.info('Removing unfinished download: %s' % file)
+                shutil.rmtree(os.path.join(self.DATABASE_DIR, file), ignore_errors=True)
 
     def do(self, uninstall, dry):
         '''
@@ -132,14 +357,18 @@ class Data:
                         "Unable to locate enrichM database! Please specify its location by creating a local BASH variable called ENRICHM_DIR: export ENRICHM_DB=/path/to/database/")
 
                 if version_local!=version_remote:
-                    logging.info('New database found. Archiving old database.')
+                    logging.info('New database found.')
+                    self._clean_staging()
+                    staging_directory = self._download_db(version_remote)
+                    logging.info('Archiving old database.')
                     self._archive_db(version_local.replace(self.ARCHIVE_SUFFIX,''))
-                    self._download_db(version_remote)
+                    self._install_db(staging_directory, version_remote)
                 else:
                     logging.info('Database is up to date!')
 
             else:
                 logging.info('Creating file to store databases.')
                 os.makedirs(self.DATABASE_DIR)
-                self._download_db(version_remote)
+                staging_directory = self._download_db(version_remote)
+                self._install_db(staging_directory, version_remote)
 
@@ -18,14 +18,129 @@
 
 # Imports
 import os
+import hashlib
 import logging
 import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
 # Local
+from enrichm.version import __version__
 from enrichm.data import Data
+from enrichm.store import DatabaseStore
+from enrichm.module_description_parser import ModuleDescription
 
 ###############################################################################
 
+class DatabaseCache:
+    '''
+    Reference data loaded from the database, shared by every Databases object
+    in the process so that each mapping is only deserialized once. Entries
+    are keyed by database version and mapping name. The size of each entry is
+    estimated from the size of the file it was loaded from, and once the total
+    is over the limit the least recently used entries are dropped. The limit
+    is set in megabytes by the ENRICHM_DB_CACHE_MB environment variable; 0
+    turns the cache off.
+
+    Cached objects are shared, so they must not be modified by callers. Copy
+    them first if changes are needed.
+    '''
+    MAX_SIZE_VARIABLE = 'ENRICHM_DB_CACHE_MB'
+    DEFAULT_MAX_SIZE_MB = 4096
+
+    def __init__(self, max_size):
+        '''
+        Parameters
+        ----------
+        max_size    - Integer. Maximum total size of the entries, in bytes
+        '''
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.sizes = dict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Re-entrant, as derived mappings are built from other entries
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def from_environment():
+        max_size_mb = os.environ.get(DatabaseCache.MAX_SIZE_VARIABLE, DatabaseCache.DEFAULT_MAX_SIZE_MB)
+
+        try:
+            max_size_mb = float(max_size_mb)
+        except ValueError:
+            raise Exception("%s must be a number of megabytes, not '%s'"
+                            % (DatabaseCache.MAX_SIZE_VARIABLE, max_size_mb))
+
+        return DatabaseCache(int(max_size_mb * 1024 * 1024))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, loader):
+        '''
+        Get an entry, loading it if it is not in the cache. Entries are loaded
+        while holding the lock, so concurrent callers don't load the same
+        entry twice.
+
+        Parameters
+        ----------
+        key     - Tuple. Database version and mapping name
+        loader  - Function. Called without arguments to load the entry.
+                  Returns the loaded object and its estimated size in bytes
+
+        Output
+        ------
+        The cached object
+        '''
+        with self.lock:
+
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            self.misses += 1
+            value, size = loader()
+
+            if size <= self.max_size:
+                self.entries[key] = value
+                self.sizes[key] = size
+                self.size += size
+                self._evict()
+
+            return value
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            key, _ = self.entries.popitem(last=False)
+            self.size -= self.sizes.pop(key)
+            logging.debug("Dropped %s %s from the database cache" % key)
+
+    def clear(self):
+        '''
+        Empty the cache.
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+
 class Databases:
+    # Shared by all Databases objects in the process
+    cache = DatabaseCache.from_environment()
+    # Compiled stores opened so far, keyed by path and modification time
+    stores = dict()
+    stores_lock = threading.Lock()
+    # Where parsed modules are cached if the database directory isn't
+    # writable, or the modules aren't those of the database
+    USER_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(str(Path.home()), '.cache')),
+                                  'enrichm')
 
     def __init__(self):
         if os.path.isfile(os.path.join(Data.DATABASE_DIR, 'VERSION')):
@@ -38,6 +153,8 @@ class Databases:
             with open(os.path.join(self.CUR_DATABASE_DIR, 'VERSION')) as out_io:
                 self.PICKLE_VERSION = out_io.readline().strip()
 
+            self.STORE = os.path.join(self.CUR_DATABASE_DIR, DatabaseStore.FILE_NAME)
+            self.REACTION_IDS = os.path.join(self.CUR_DATABASE_DIR, 'reaction_ids.npz')
             self.IDS_DIR = os.path.join(self.CUR_DATABASE_DIR, 'ids')
             self.REF_DIR = os.path.join(self.CUR_DATABASE_DIR, 'databases')
             self.GTDB_DIR = os.path.join(self.CUR_DATABASE_DIR, 'gtdb')
@@ -72,6 +189,9 @@ class Databases:
             self.R2P = os.path.join(self.CUR_DATABASE_DIR, 'reaction_to_pathway')
             self.P2R = os.path.join(self.CUR_DATABASE_DIR, 'pathway_to_reaction')
             self.C2R = os.path.join(self.CUR_DATABASE_DIR, 'compound_to_reaction')
+            self.K2R = os.path.join(self.CUR_DATABASE_DIR, 'ko_to_reaction')
+            self.K2M = os.path.join(self.CUR_DATABASE_DIR, 'ko_to_module')
+            self.C2M = os.path.join(self.CUR_DATABASE_DIR, 'compound_to_module')
             self.C = os.path.join(self.CUR_DATABASE_DIR, 'compound_descriptions')
             self.R = os.path.join(self.CUR_DATABASE_DIR, 'reaction_descriptions')
             self.P = os.path.join(self.CUR_DATABASE_DIR, 'pathway_descriptions')
@@ -110,6 +230,22 @@ bash variable called ENRICHM_DB? (Currently I'm looking here: {Data.DATABASE_DIR
         self.CAZY_DB = os.path.join(self.REF_DIR, self.CAZY_DB_NAME + self.HMM_SUFFIX)
         self.PFAM_CLAN_DB = os.path.join(self.IDS_DIR, 'PFAM_CLANS.txt')
 
+    @staticmethod
+    def ids_dir():
+        '''
+        The directory of the id files of the installed database, found without
+        setting up the rest of the paths.
+        '''
+        version_path = os.path.join(Data.DATABASE_DIR, 'VERSION')
+
+        if not os.path.isfile(version_path):
+            return Databases().IDS_DIR
+
+        with open(version_path) as version_io:
+            db_version = version_io.readline().strip().replace('.tar.gz', '')
+
+        return os.path.join(Data.DATABASE_DIR, db_version, 'ids')
+
     def m2def(self):
         logging.debug("Loading module descriptions")
         return self.load_pickle(self.M2DEF)
@@ -166,6 +302,70 @@ bash variable called ENRICHM_DB? (Currently I'm looking here: {Data.DATABASE_DIR
         logging.debug("Loading compound classifications")
         return self.load_pickle(self.K)
 
+    def parsed_modules(self, m2def=None):
+        '''
+        The module definitions parsed into ModuleDescriptions, excluding the
+        signature modules. Parsing is slow, so the parsed modules are saved
+        in the database directory (or USER_CACHE_DIR if it can't be written
+        to, or the definitions include custom modules), keyed by enrichm
+        version, database version and a hash of the definitions, and only
+        parsed again if one of those changes. The ModuleDescriptions
+        returned may be shared, so must not be modified.
+
+        Parameters
+        ----------
+        m2def   - Dict. Module definitions, if not those of the database (e.g. with custom modules added)
+        '''
+        custom = m2def is not None and m2def != self.m2def()
+
+        if m2def is None:
+            m2def = self.m2def()
+
+        digest = hashlib.md5(pickle.dumps(sorted(m2def.items()), protocol=4)).hexdigest()
+
+        return self.cache.get((self.DB_VERSION, 'parsed_modules', digest),
+                              lambda: self._parsed_modules(m2def, digest, custom))
+
+    def _parsed_modules(self, m2def, digest, custom):
+        # The saved ModuleDescriptions are only valid for the version of the
+        # parser that made them
+        file_name = '.'.join(['parsed_modules', __version__, self.DB_VERSION, digest, self.PICKLE])
+        # Each set of custom modules would leave a file behind, so they are
+        # kept out of the shared database directory
+        directories = [self.USER_CACHE_DIR] if custom else [self.CUR_DATABASE_DIR, self.USER_CACHE_DIR]
+        paths = [os.path.join(directory, file_name) for directory in directories]
+
+        for path in paths:
+
+            if os.path.isfile(path):
+
+                try:
+
+                    with open(path, 'rb') as file_io:
+                        return pickle.load(file_io), os.path.getsize(path)
+
+                except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                    logging.warning("Ignoring unreadable parsed modules: %s" % path)
+
+        logging.debug("Parsing %i module definitions" % len(m2def))
+        parsed_modules = {module:ModuleDescription(definition) for module, definition in m2def.items()
+                          if module not in self.signature_modules}
+
+        for path in paths:
+
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._write_pickle(parsed_modules, path)
+
+            except OSError:
+                continue
+
+            return parsed_modules, os.path.getsize(path)
+
+        logging.warning("Unable to save parsed modules, they will be parsed again next time")
+
+        return parsed_modules, 0
+
     def compound_desc_dict(self):
         logging.debug("Loading pfam to clan information")
         return self.load_pickle(self.COMPOUND_DESC)
@@ -205,6 +405,9 @@ bash variable called ENRICHM_DB? (Currently I'm looking here: {Data.DATABASE_DIR
         return Parser.parse_taxonomy(self.TAXONOMY)
 
     def k2r(self):
+        return self.load_derived(self.K2R, self._k2r, self.R2K)
+
+    def _k2r(self):
         k2r = dict()
         for reaction, kos in self.r2k().items():
             for ko in kos:
@@ -213,7 +416,62 @@ bash variable called ENRICHM_DB? (Currently I'm looking here: {Data.DATABASE_DIR
                 k2r[ko].append(reaction)
         return k2r
 
+    def reaction_ids(self):
+        '''
+        The dense numbering of the reactions of the database, and the KO to
+        reaction map over it (see ReactionIds). Read from the database if it
+        has been compiled, otherwise numbered from k2r once per process.
+        '''
+        return self.cache.get((self.DB_VERSION, 'reaction_ids'), self._reaction_ids)
+
+    def _reaction_ids(self):
+        # Imported here, so that loading the other mappings doesn't import numpy
+        from enrichm.ids import ReactionIds
+
+        if os.path.isfile(self.REACTION_IDS):
+            return ReactionIds.load(self.REACTION_IDS), os.path.getsize(self.REACTION_IDS)
+
+        reaction_ids = ReactionIds.from_k2r(self.k2r())
+        # Roughly the memory used by each reaction and KO, its string and index entry
+        return reaction_ids, (len(reaction_ids.reactions) + len(reaction_ids.kos)) * 150 + reaction_ids.columns.nbytes
+
+    def write_reaction_ids(self):
+        '''
+        Number the reactions of the database, and write the numbering to it.
+        '''
+        # Imported here, so that loading the other mappings doesn't import numpy
+        from enrichm.ids import ReactionIds
+
+        try:
+            reaction_ids = ReactionIds.from_k2r(self.k2r())
+
+        except FileNotFoundError as error:
+            logging.warning("Unable to number reactions: %s" % error)
+            return
+
+        reaction_ids.save(self.REACTION_IDS)
+        logging.info("    - Numbered %i reactions of %i KOs" % (len(reaction_ids.reactions), len(reaction_ids.kos)))
+
+    def k2m(self):
+        return self.load_derived(self.K2M, self._k2m, self.R2M)
+
+    def _k2m(self):
+        k2m = dict()
+        r2m = self.r2m()
+
+        for ko, reactions in self.k2r().items():
+            for reaction in reactions:
+                for module in r2m.get(reaction, list()):
+                    if ko not in k2m:
+                        k2m[ko] = list()
+                    if module not in k2m[ko]:
+                        k2m[ko].append(module)
+        return k2m
+
     def c2m(self):
+        return self.load_derived(self.C2M, self._c2m, self.M2C)
+
+    def _c2m(self):
         c2m = dict()
 
         for module, compounds in self.m2c().items():
@@ -225,12 +483,123 @@ bash variable called ENRICHM_DB? (Currently I'm looking here: {Data.DATABASE_DIR
                     c2m[substrate] = [module]
         return c2m
 
+    def load_derived(self, file, derive, source):
+        '''
+        Load a mapping derived from another (e.g. KO to reaction, from
+        reaction to KO). These are written to the database when it is built
+        or compiled (see write_derived). Databases that don't have them
+        derive them here, once per process.
+
+        Parameters
+        ----------
+        file    - String. Path to the pickle of the derived mapping, without the version and suffix
+        derive  - Function. Derives the mapping from the database
+        source  - String. Path to the pickle it is derived from, used to estimate its size
+        '''
+        store = self.store()
+
+        if os.path.isfile(self.pickle_path(file)) or \
+           (store is not None and os.path.basename(file) in store.mappings):
+            return self.load_pickle(file)
+
+        return self.cache.get((self.DB_VERSION, os.path.basename(file)),
+                              lambda: (derive(), self.pickle_size(source)))
+
+    def write_derived(self):
+        '''
+        Derive the mappings that are otherwise derived at runtime, and write
+        them to the database alongside the others.
+        '''
+        for file, derive in [(self.K2R, self._k2r), (self.K2M, self._k2m), (self.C2M, self._c2m)]:
+
+            try:
+                derived = derive()
+
+            except FileNotFoundError as error:
+                logging.warning("Unable to derive %s: %s" % (os.path.basename(file), error))
+                continue
+
+            pickle_path = self.pickle_path(file)
+            self._write_pickle(derived, pickle_path)
+            logging.info("    - Wrote %s" % os.path.basename(pickle_path))
+
+    @staticmethod
+    def _write_pickle(obj, pickle_path):
+        # Written to a temporary file first, so readers never see part of it
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(pickle_path))
+
+        try:
+
+            with os.fdopen(file_descriptor, 'wb') as out_io:
+                pickle.dump(obj, out_io)
+
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, pickle_path)
+
+        finally:
+
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def pickle_path(self, file):
+        return '.'.join([file, self.PICKLE_VERSION, self.PICKLE])
+
+    def pickle_size(self, file):
+        return os.path.getsize(self.pickle_path(file))
+
+    def store(self):
+        '''
+        The compiled store of the database (see 'enrichm data --compile'), or
+        None if it hasn't been compiled.
+        '''
+        if not os.path.isfile(self.STORE):
+            return None
+
+        key = (self.STORE, os.path.getmtime(self.STORE))
+
+        with Databases.stores_lock:
+
+            if key not in Databases.stores:
+                store = DatabaseStore(self.STORE)
+
+                if store.pickle_version != self.PICKLE_VERSION:
+                    logging.warning("Ignoring compiled database %s, it was compiled from a different version"
+                                    % self.STORE)
+                    store = None
+
+                Databases.stores[key] = store
+
+            return Databases.stores[key]
+
     def load_pickle(self, file):
+        '''
+        Load a mapping from the database, or get it from the cache if it has
+        been loaded already. If the database has been compiled, mappings are
+        read from the store, and only the keys that are used are loaded. The
+        object returned may be shared, so must not be modified.
+
+        Parameters
+        ----------
+        file    - String. Path to the pickle, without the version and suffix
+        '''
+        return self.cache.get((self.DB_VERSION, os.path.basename(file)),
+                              lambda: self._load_pickle(file))
+
+    def _load_pickle(self, file):
+        store = self.store()
+
+        if store is not None:
+            mapping = store.mapping(os.path.basename(file))
+
+            if mapping is not None:
+                return mapping
+
+        pickle_path = self.pickle_path(file)
 
-        with open('.'.join([file, self.PICKLE_VERSION, self.PICKLE]), 'rb') as file_io:
+        with open(pickle_path, 'rb') as file_io:
             loaded_pickle = pickle.load(file_io)
 
-        return loaded_pickle
+        return loaded_pickle, os.path.getsize(pickle_path)
 
     def parse_ko_cutoffs(self):
         cut_ko = dict()
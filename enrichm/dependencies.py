@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Locate the external tools needed by each EnrichM subcommand.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import re
+import json
+import shutil
+import tempfile
+import subprocess
+# Local
+from enrichm.data import Data
+###############################################################################
+
+class Dependencies:
+    '''
+    Resolves the paths and versions of external tools. Results are cached in
+    a fingerprint file under the database directory, and are only re-probed
+    when PATH changes or a cached binary has been modified.
+
+    This runs before logging has been set up, so nothing is logged here.
+    '''
+    FINGERPRINT = 'tool_fingerprint.json'
+    PATH = 'PATH'
+    TOOLS = 'tools'
+
+    URLS = {'hmmsearch':"http://hmmer.org/download.html",
+            'diamond':"https://github.com/bbuchfink/diamond",
+            'Rscript':"https://www.r-project.org",
+            'parallel':"https://www.gnu.org/software/parallel",
+            'prodigal':"https://github.com/hyattpd/Prodigal/wiki/installation",
+            'mmseqs':"https://github.com/soedinglab/MMseqs2",
+            'sponge':"https://joeyh.name/code/moreutils",
+            'mcl':"https://micans.org/mcl",
+            'mcxload':"https://micans.org/mcl",
+            'mcxdump':"https://micans.org/mcl"}
+
+    VERSION_ARGUMENTS = {'hmmsearch':'-h',
+                         'diamond':'version',
+                         'Rscript':'--version',
+                         'parallel':'--version',
+                         'prodigal':'-v',
+                         'mmseqs':'version',
+                         'sponge':'-h',
+                         'mcl':'--version',
+                         'mcxload':'--version',
+                         'mcxdump':'--version'}
+
+    def __init__(self, fingerprint_directory=None):
+        if fingerprint_directory is None:
+            fingerprint_directory = Data.DATABASE_DIR
+
+        self.fingerprint_path = os.path.join(fingerprint_directory, self.FINGERPRINT)
+
+    def _read_fingerprint(self):
+        '''
+        Read the cached tool fingerprint. A fingerprint recorded under a
+        different PATH is discarded.
+        '''
+        if not os.path.isfile(self.fingerprint_path):
+            return dict()
+
+        try:
+            with open(self.fingerprint_path) as fingerprint_io:
+                fingerprint = json.load(fingerprint_io)
+        except (OSError, ValueError):
+            return dict()
+
+        if fingerprint.get(self.PATH) != os.environ.get(self.PATH):
+            return dict()
+
+        return fingerprint.get(self.TOOLS, dict())
+
+    def _write_fingerprint(self, tools):
+        '''
+        Atomically write the tool fingerprint. Failing to write it (e.g. a
+        read-only database directory) is not fatal.
+        '''
+        fingerprint_directory = os.path.dirname(self.fingerprint_path)
+
+        if not os.path.isdir(fingerprint_directory):
+            return
+
+        try:
+            file_descriptor, tmp_path = tempfile.mkstemp(dir=fingerprint_directory)
+
+            with os.fdopen(file_descriptor, 'w') as out_io:
+                json.dump({self.PATH:os.environ.get(self.PATH), self.TOOLS:tools}, out_io, indent=1)
+
+            os.replace(tmp_path, self.fingerprint_path)
+        except OSError:
+            pass
+
+    def probe_version(self, tool, tool_path):
+        '''
+        Run a tool to find its version string.
+
+        Parameters
+        ----------
+        tool        - String. Name of the tool
+        tool_path   - String. Path to the tool's executable
+
+        Output
+        ------
+        The first line of output mentioning a version number, or 'NA'
+        '''
+        version_argument = self.VERSION_ARGUMENTS.get(tool, '--version')
+
+        try:
+            process = subprocess.run([tool_path, version_argument], stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, universal_newlines=True,
+                                     timeout=30)
+        except (OSError, subprocess.SubprocessError):
+            return 'NA'
+
+        for line in process.stdout.split('\n'):
+
+            if re.search(r'\d+\.\d+', line):
+                return line.strip('# ').strip()
+
+        return 'NA'
+
+    def resolve(self, tools):
+        '''
+        Find the paths and versions of a list of tools.
+
+        Parameters
+        ----------
+        tools   - Iterable. Names of the tools to resolve
+
+        Output
+        ------
+        A dictionary of tool name to a dictionary of path, mtime and version,
+        and a list of tools that could not be found
+        '''
+        cached_tools = self._read_fingerprint()
+        resolved = dict()
+        missing = list()
+        updated = False
+
+        for tool in sorted(tools):
+            cached = cached_tools.get(tool)
+
+            if cached:
+
+                try:
+                    if os.stat(cached['path']).st_mtime == cached['mtime']:
+                        resolved[tool] = cached
+                        continue
+                except OSError:
+                    pass
+
+            tool_path = shutil.which(tool)
+
+            if tool_path is None:
+                missing.append(tool)
+                continue
+
+            resolved[tool] = {'path':tool_path,
+                              'mtime':os.stat(tool_path).st_mtime,
+                              'version':self.probe_version(tool, tool_path)}
+            updated = True
+
+        if updated:
+            cached_tools.update(resolved)
+            self._write_fingerprint(cached_tools)
+
+        return resolved, missing
+
+    def check(self, tools):
+        '''
+        Ensure a list of tools are installed.
+
+        Parameters
+        ----------
+        tools   - Iterable. Names of the tools needed
+
+        Output
+        ------
+        A dictionary of tool name to a dictionary of path, mtime and version
+        '''
+        resolved, missing = self.resolve(tools)
+
+        if len(missing)>0:
+            dependency_string = '\n'.join(['\t%s\t%s' % (d, self.URLS.get(d, '')) for d in missing])
+            raise Exception('The following dependencies need to be installed to run enrichm:\n%s' % (dependency_string))
+
+        return resolved
@@ -19,16 +19,18 @@
 import random
 import os
 import logging
-import multiprocessing as mp
+import tempfile
 from itertools import product, combinations, chain
-from scipy import stats
+from scipy import stats, sparse
 import numpy as np
-import statsmodels.sandbox.stats.multicomp as sm
 from enrichm.draw_plots import Plot
 from enrichm.databases import Databases
-from enrichm.module_description_parser import ModuleDescription
 from enrichm.parser import Parser, ParseAnnotate
 from enrichm.writer import Writer
+from enrichm.profiler import Profiler
+from enrichm.matrix import AnnotationMatrix
+from enrichm.workers import WorkerPool, SharedArrays
+from enrichm.events import Events
 ################################################################################
 
 def gene_fisher_calc(x):
@@ -112,6 +114,45 @@ def zscore_calc(x):
                     str(z_score),
                     p_value]
 
+def frequency_calc(task):
+    '''
+    Count the annotations of two groups in a range of rows of the shared
+    count matrix (see Test.count_matrix), and test each with a calculation
+    above. Counts are the presence and absence of each annotation in each
+    group, or with freq, the count of the annotation in every genome.
+    '''
+    calculation, descriptors, shape, start, annotations, group_1, group_2, group_1_size, freq = task
+    arrays = SharedArrays.attach(descriptors)
+    counts = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+    # Only the rows of this task are made dense
+    counts = counts[start:start + len(annotations)].toarray()
+    output_lines = list()
+
+    for row, annotation in enumerate(annotations):
+        group_1_counts = counts[row, :group_1_size]
+        group_2_counts = counts[row, group_1_size:]
+
+        if freq:
+            group_1_true, group_1_false = group_1_counts.tolist(), 0
+            group_2_true, group_2_false = group_2_counts.tolist(), 0
+
+            if(len([x for x in group_1_true if x!='0'])==0 and
+                len([x for x in group_2_true if x!='0'])==0 ):
+                continue
+        else:
+            group_1_true = int(np.count_nonzero(group_1_counts > 0.0))
+            group_1_false = len(group_1_counts) - group_1_true
+            group_2_true = int(np.count_nonzero(group_2_counts > 0.0))
+            group_2_false = len(group_2_counts) - group_2_true
+
+            if(group_1_true==0 and group_2_true==0):
+                continue
+
+        output_lines.append(calculation([annotation, group_1, group_2, [group_1_true, group_1_false],
+                                         [group_2_true, group_2_false]]))
+
+    return output_lines
+
 ################################################################################
 
 class Enrichment:
@@ -285,29 +326,43 @@ class Enrichment:
                 else:
                     g2_sig_kos.add(sline[0])
 
-        for module, definition in database.m2def().items():
-
-            if module not in database.signature_modules:
-                pathway = ModuleDescription(definition)
-                num_all         = pathway.num_steps()
-                g1_num_covered, _, _, _ = pathway.num_covered_steps(g1_sig_kos)
-                g1_perc_covered    = g1_num_covered / float(num_all)
+        for module, pathway in database.parsed_modules().items():
+            num_all         = pathway.num_steps()
+            g1_num_covered, _, _, _ = pathway.num_covered_steps(g1_sig_kos)
+            g1_perc_covered    = g1_num_covered / float(num_all)
 
-                g2_num_covered, _, _, _ = pathway.num_covered_steps(g2_sig_kos)
-                g2_perc_covered    = g2_num_covered / float(num_all)
+            g2_num_covered, _, _, _ = pathway.num_covered_steps(g2_sig_kos)
+            g2_perc_covered    = g2_num_covered / float(num_all)
 
-                if g1_perc_covered>0:
-                    output_line = [module, sline[1], num_all, g1_num_covered, g1_perc_covered, module_descriptions[module]]
-                    module_output.append(output_line)
+            if g1_perc_covered>0:
+                output_line = [module, sline[1], num_all, g1_num_covered, g1_perc_covered, module_descriptions[module]]
+                module_output.append(output_line)
 
-                if g2_perc_covered>0:
-                    output_line = [module, sline[2], num_all, g2_num_covered, g2_perc_covered, module_descriptions[module]]
-                    module_output.append(output_line)
+            if g2_perc_covered>0:
+                output_line = [module, sline[2], num_all, g2_num_covered, g2_perc_covered, module_descriptions[module]]
+                module_output.append(output_line)
 
         prefix = '_vs_'.join([sline[1], sline[2]]).replace(' ', '_')
 
         return module_output, prefix
 
+    def write_results(self, results, output_directory):
+        '''
+        Write the results of enrichment tests.
+
+        Parameters
+        ----------
+        results             - List. Pairs of output lines and the name of the file to write them to
+        output_directory    - String. Directory to write the results to
+        '''
+        for test_result_lines, test_result_output_file in results:
+            test_result_output_path = os.path.join(output_directory, test_result_output_file)
+            Writer.write(test_result_lines, test_result_output_path)
+            logging.debug('Wrote %i results to %s', len(test_result_lines) - 1, test_result_output_path,
+                          extra=Events.event(Events.FINISHED, stage='write', output=test_result_output_path,
+                                             hits=len(test_result_lines) - 1,
+                                             bytes=Events.output_size(test_result_output_path)))
+
     def enrichment_pipeline(# Input options
            self, annotate_output, annotation_matrix, metadata_path, abundances_path, abundance_metadata_path, transcriptome_path, transcriptome_metadata_path,
            # Runtime options
@@ -316,7 +371,11 @@ class Enrichment:
            ko, pfam, tigrfam, cluster, ortholog, cazy, ec, ko_hmm,
            # Output options
            output_directory):
-
+        '''
+        Run the enrichment pipeline. annotation_matrix may be the path to a
+        frequency matrix, or an AnnotationMatrix returned by
+        Annotate.annotate_pipeline.
+        '''
         plot  = Plot()
         database  = Databases()
 
@@ -341,7 +400,8 @@ class Enrichment:
             elif ec:
                 annotation_matrix = pa.ec
 
-        logging.info('Parsing annotation matrix')
+        logging.info('Parsing annotation matrix',
+                     extra=Events.event(Events.STARTED, stage='enrichment'))
         annotations_dict, _, annotations, = Parser.parse_simple_matrix(annotation_matrix)
         annotation_type = self.check_annotation_type(annotations)
 
@@ -367,11 +427,7 @@ class Enrichment:
                                                 ab_attribute_dict,
                                                 annotations)
             results = test.test_weighted_abundances(weighted_abundance, annotations)
-
-            for result in results:
-                test_result_lines, test_result_output_file = result
-                test_result_output_path = os.path.join(output_directory, test_result_output_file)
-                Writer.write(test_result_lines, test_result_output_path)
+            self.write_results(results, output_directory)
 
         else:
             logging.info('Parsing metadata: %s' % metadata_path)
@@ -417,11 +473,7 @@ class Enrichment:
 
             test = Test(annotations_dict, combination_dict, annotation_type, threshold, multi_test_correction, processes, database)
             results = test.test_pipeline(attribute_dict)
-
-            for result in results:
-                test_result_lines, test_result_output_file = result
-                test_result_output_path = os.path.join(output_directory, test_result_output_file)
-                Writer.write(test_result_lines, test_result_output_path)
+            self.write_results(results, output_directory)
 
         raw_proportions_output_lines = self.calculate_portions(annotations, combination_dict, annotations_dict, genome_list, proportions_cutoff)
         Writer.write(raw_proportions_output_lines, os.path.join(output_directory, self.PROPORTIONS))
@@ -438,7 +490,18 @@ class Enrichment:
                     module_output, prefix = self.module_completeness(database, os.path.join(output_directory, result_file), pval_cutoff)
                     Writer.write(module_output, os.path.join(output_directory, prefix +'_'+ self.MODULE_COMPLETENESS))
 
-        plot.draw_pca_plot(annotation_matrix, metadata_path, output_directory)
+        if isinstance(annotation_matrix, AnnotationMatrix) or AnnotationMatrix.is_binary(annotation_matrix):
+            # The plotting script reads the text matrix from disk
+            with tempfile.NamedTemporaryFile(suffix='.tsv') as matrix_file:
+                Parser.parse_matrix(annotation_matrix).write(matrix_file.name)
+                plot.draw_pca_plot(matrix_file.name, metadata_path, output_directory)
+        else:
+            plot.draw_pca_plot(annotation_matrix, metadata_path, output_directory)
+
+        logging.debug('Finished enrichment',
+                      extra=Events.event(Events.FINISHED, stage='enrichment',
+                                         annotations=len(annotations),
+                                         bytes=Events.output_size(output_directory)))
 
 class Test(Enrichment):
 
@@ -455,6 +518,9 @@ class Test(Enrichment):
     IVG_OUTPUT             = 'ivg_results.cdf.tsv'
     GENE_FISHER_OUTPUT     = 'gvg_results.fisher.tsv'
     GVG_OUTPUT             = 'gvg_results.mannwhitneyu.tsv'
+    # Tasks per worker process when testing gene frequencies, so that the
+    # work is spread evenly
+    CHUNKS_PER_PROCESS     = 4
 
     mtc_dict = {'b': 'Bonferroni',
                 's': 'Sidak',
@@ -479,7 +545,7 @@ class Test(Enrichment):
         self.multi_test_correction  = multi_test_correction
         self.annotation_type        = annotation_type
         self.groups                 = groups
-        self.pool                   = mp.Pool(processes = processes)
+        self.processes              = processes
         self.m2def                  = database.m2def()
         self.m                      = database.m()
         self.clan2pfam              = database.clan2pfam()
@@ -511,6 +577,9 @@ class Test(Enrichment):
         return enrichment_test, overrepresentation_test
 
     def correct_multi_test(self, pvalues):
+        # statsmodels is slow to import and is only needed here, so load it
+        # on demand rather than for every user of this module (e.g. uses).
+        import statsmodels.sandbox.stats.multicomp as sm
         logging.info('Applying multi-test correction using the %s method' % (self.mtc_dict[self.multi_test_correction]) )
         corrected_pvals \
             = sm.multipletests(pvalues,
@@ -521,64 +590,71 @@ class Test(Enrichment):
 
         return corrected_pvals
 
-    def count(self, annotation, group, freq):
+    def count_matrix(self, group_1, group_2):
+        '''
+        The annotations of the genomes in two groups as a sparse matrix, with
+        a row per annotation and a column per genome, the genomes of group_1
+        first. Only the counts above zero are held, so this scales with the
+        annotations the genomes have rather than every annotation of every
+        genome.
 
-        if freq:
-            group_true = list()
+        Parameters
+        ----------
+        group_1 - String. Name of the first group
+        group_2 - String. Name of the second group
 
+        Output
+        ------
+        The matrix in CSR form, and the annotations of its rows
+        '''
+        annotations = list(set(chain(*self.genome_annotations.values())))
+        rows = {annotation:row for row, annotation in enumerate(annotations)}
+        genomes = [self.genome_annotations[genome] for genome in self.groups[group_1] + self.groups[group_2]]
+
+        # Integers are kept as integers, so they are written out the same
+        if all(isinstance(count, int) for genome in genomes for count in genome.values()):
+            dtype = np.int64
         else:
-            group_true = 0
+            dtype = np.float64
 
-        group_false = 0
+        count_rows, count_columns, count_data = list(), list(), list()
 
-        for genome in self.groups[group]:
-            if annotation in self.genome_annotations[genome]:
-                if freq:
-                    group_true.append(self.genome_annotations[genome][annotation])
-                else:
-                    if self.genome_annotations[genome][annotation]>0.0:
-                        group_true+=1
-                    else:
-                        group_false+=1
+        for column, genome in enumerate(genomes):
 
-            else:
+            for annotation, count in genome.items():
 
-                if freq:
-                    group_true.append(0)
+                if count:
+                    count_rows.append(rows[annotation])
+                    count_columns.append(column)
+                    count_data.append(count)
 
-                else:
-                    group_false+=1
-
-        return group_true, group_false
+        counts = sparse.csr_matrix((np.array(count_data, dtype=dtype), (count_rows, count_columns)),
+                                   shape=(len(annotations), len(genomes)))
 
-    def gene_frequencies(self, group_1, group_2, freq=False):
+        return counts, annotations
 
-        res_list    = list()
-        annotations = set(chain(*self.genome_annotations.values()))
+    def test_frequencies(self, calculation, group_1, group_2, freq=False):
+        '''
+        Test the gene frequencies of two groups (see frequency_calc) in the
+        worker pool. The sparse counts are put in shared memory once, and each
+        task is a range of annotations.
 
-        for annotation in annotations:
-            passed = True
-            group_1_true, group_1_false \
-                = self.count(annotation,
-                              group_1,
-                              freq)
-            group_2_true, group_2_false \
-                = self.count(annotation,
-                              group_2,
-                              freq)
-
-            if freq:
-                if(len([x for x in group_1_true if x!='0'])==0 and
-                    len([x for x in group_2_true if x!='0'])==0 ):
-                    passed = False
-            else:
-                if(group_1_true==0 and group_2_true==0):
-                    passed = False
+        Parameters
+        ----------
+        calculation - Function. gene_fisher_calc, mannwhitneyu_calc or zscore_calc
+        group_1     - String. Name of the first group
+        group_2     - String. Name of the second group
+        freq        - Boolean. Test the counts, rather than presence and absence
+        '''
+        counts, annotations = self.count_matrix(group_1, group_2)
+        chunk_size = max(1, -(-len(annotations) // (max(1, int(self.processes)) * self.CHUNKS_PER_PROCESS)))
 
-            if passed:
-                res_list.append([annotation, group_1, group_2, [group_1_true, group_1_false], [group_2_true, group_2_false]])
+        with SharedArrays({'data':counts.data, 'indices':counts.indices, 'indptr':counts.indptr}) as shared:
+            tasks = [(calculation, shared.descriptors, counts.shape, start, annotations[start:start + chunk_size],
+                      group_1, group_2, len(self.groups[group_1]), freq)
+                     for start in range(0, len(annotations), chunk_size)]
 
-        return res_list
+            return list(chain(*WorkerPool.map(frequency_calc, tasks, self.processes)))
 
     def corrected_pvals(self, output_lines):
         pvalues = [output_line[-1] for output_line in output_lines]
@@ -627,8 +703,12 @@ class Test(Enrichment):
 
         logging.info('Calculating enrichment across samples using Mann-Whitney U test')
         results = list()
+        group_combinations = list(combinations(weighted_abundance, 2))
 
-        for combination in combinations(weighted_abundance, 2):
+        for done, combination in enumerate(group_combinations):
+            logging.debug('Comparing samples: %s', ', '.join(combination),
+                          extra=Events.event(Events.PROGRESS, stage='test', groups=list(combination),
+                                             done=done, total=len(group_combinations)))
             prefix = '_vs_'.join(
                 [sorted(combination)[0], sorted(combination)[1]]).replace(' ', '_')
             res_list = list()
@@ -640,7 +720,7 @@ class Test(Enrichment):
                               combination[1], [group_1], [group_2]]
                 res_list.append(gene_count)
 
-            output_lines = self.pool.map(mannwhitneyu_calc, res_list)
+            output_lines = WorkerPool.map(mannwhitneyu_calc, res_list, self.processes)
 
             for idx, corrected_pval in enumerate(self.corrected_pvals(output_lines)):
                 output_lines[idx].append(str(corrected_pval))
@@ -649,21 +729,28 @@ class Test(Enrichment):
             output_lines = self.MANNWHITNEYU_HEADER + output_lines
             results.append([output_lines, prefix + '_' + self.GVG_OUTPUT])
 
+        logging.debug('Finished %i comparisons', len(group_combinations),
+                      extra=Events.event(Events.FINISHED, stage='test', done=len(group_combinations),
+                                         total=len(group_combinations)))
+
         return results
 
+    @Profiler.profile('Test.test_pipeline')
     def test_pipeline(self, group_dict):
         results = list()
+        group_combinations = list(combinations(group_dict, 2))
 
-        for combination in combinations(group_dict, 2):
+        for done, combination in enumerate(group_combinations):
             enrichment_test, overrepresentation_test = self.test_chooser( [group_dict[member] for member in combination] )
             prefix = '_vs_'.join([sorted(combination)[0], sorted(combination)[1]]).replace(' ', '_')
 
-            logging.info('Comparing gene frequency among groups: %s', ', '.join(combination))
+            logging.info('Comparing gene frequency among groups: %s', ', '.join(combination),
+                         extra=Events.event(Events.PROGRESS, stage='test', groups=list(combination),
+                                            done=done, total=len(group_combinations)))
 
             if enrichment_test == stats.fisher_exact:
                 logging.info('Testing gene enrichment using Fisher\'s exact test')
-                gene_count = self.gene_frequencies(*combination)
-                output_lines = self.pool.map(gene_fisher_calc, gene_count)
+                output_lines = self.test_frequencies(gene_fisher_calc, *combination)
 
                 for idx, corrected_pval in enumerate(self.corrected_pvals(output_lines)):
                     output_lines[idx].append(str(corrected_pval))
@@ -682,8 +769,7 @@ class Test(Enrichment):
 
             if(overrepresentation_test == stats.mannwhitneyu):
                 logging.info('Testing over-representation using Mann-Whitney U test')
-                gene_count = self.gene_frequencies(*combination, True)
-                output_lines = self.pool.map(mannwhitneyu_calc, gene_count)
+                output_lines = self.test_frequencies(mannwhitneyu_calc, *combination, True)
 
                 for idx, corrected_pval in enumerate(self.corrected_pvals(output_lines)):
                     output_lines[idx].append(str(corrected_pval))
@@ -693,8 +779,7 @@ class Test(Enrichment):
 
             elif overrepresentation_test == stats.norm.cdf:
                 logging.info('Testing over-representation using Z score test')
-                gene_count = self.gene_frequencies(*combination, True)
-                output_lines = self.pool.map(zscore_calc, gene_count)
+                output_lines = self.test_frequencies(zscore_calc, *combination, True)
                 output_lines = [x for x in output_lines if x]
 
                 for idx, corrected_pval in enumerate(self.corrected_pvals(output_lines)):
@@ -707,4 +792,8 @@ class Test(Enrichment):
             output_lines = header + output_lines
             results.append([output_lines, prefix +'_'+ output])
 
+        logging.debug('Finished %i comparisons', len(group_combinations),
+                      extra=Events.event(Events.FINISHED, stage='test', done=len(group_combinations),
+                                         total=len(group_combinations)))
+
         return results
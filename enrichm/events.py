@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+A machine readable stream of progress events, built on the logging calls.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import json
+import socket
+import logging
+import threading
+###############################################################################
+
+class Events:
+    '''
+    Names of the events, and a helper to attach an event to a logging call:
+
+        logging.info('Finished', extra=Events.event(Events.FINISHED, stage='ko'))
+
+    Log records carrying an event are written to the event stream by
+    EventHandler, whatever the logging verbosity.
+    '''
+    STARTED = 'started'
+    FINISHED = 'finished'
+    PROGRESS = 'progress'
+    # Number of open EventHandlers
+    handlers = 0
+    handlers_lock = threading.Lock()
+
+    @staticmethod
+    def enabled():
+        '''
+        Whether events are being written anywhere, so that values only
+        reported in events aren't worked out when nothing reads them.
+        '''
+        return Events.handlers > 0
+
+    @staticmethod
+    def event(name, **fields):
+        '''
+        Parameters
+        ----------
+        name    - String. Name of the event (STARTED, FINISHED or PROGRESS)
+        fields  - Values to report with the event, e.g. stage, genome,
+                  proteins, hits, bytes. Progress through a stage is reported
+                  with done and total, from which an ETA is estimated.
+
+        Output
+        ------
+        A dictionary to pass as the extra argument of a logging call
+        '''
+        fields['event'] = name
+        return {'event':fields}
+
+    @staticmethod
+    def output_size(*output_paths):
+        '''
+        Number of bytes written to some files or directories, to report with
+        an event. None if events are not enabled, as walking large output
+        directories is slow.
+        '''
+        if not Events.enabled():
+            return None
+
+        return sum(Events.size(output_path) for output_path in output_paths)
+
+    @staticmethod
+    def size(output_path):
+        '''
+        Number of bytes in a file, or in all files within a directory.
+        '''
+        if output_path is None or not os.path.exists(output_path):
+            return 0
+
+        if os.path.isfile(output_path):
+            return os.path.getsize(output_path)
+
+        total = 0
+
+        for directory, _, files in os.walk(output_path):
+
+            for file_name in files:
+                file_path = os.path.join(directory, file_name)
+
+                if os.path.isfile(file_path):
+                    total += os.path.getsize(file_path)
+
+        return total
+
+class EventHandler(logging.Handler):
+    '''
+    Write the events attached to log records as JSON lines to a file or FIFO.
+    Every event includes the time, host and process, and the log message.
+    Events for a stage reporting done and total are given the elapsed time
+    since the stage started, and an estimate of the seconds remaining (eta).
+    '''
+
+    def __init__(self, output_path):
+        logging.Handler.__init__(self, logging.DEBUG)
+        # Opening a FIFO blocks until something is reading from it
+        self.output_io = open(output_path, 'a', buffering=1)
+        self.host = socket.gethostname()
+        self.stage_starts = dict()
+        self.stage_lock = threading.Lock()
+
+        with Events.handlers_lock:
+            Events.handlers += 1
+
+    def _timing(self, event, created):
+        stage = event.get('stage')
+
+        if stage is None:
+            return
+
+        with self.stage_lock:
+
+            # A stage starts at its started event, or else its first event
+            if event['event'] == Events.STARTED and 'genome' not in event:
+                self.stage_starts[stage] = created
+
+            start = self.stage_starts.setdefault(stage, created)
+
+        elapsed = created - start
+
+        if event['event'] == Events.FINISHED and 'genome' not in event:
+            event.setdefault('elapsed', round(elapsed, 3))
+
+        done, total = event.get('done'), event.get('total')
+
+        if done and total:
+            event.setdefault('elapsed', round(elapsed, 3))
+            event.setdefault('eta', round(elapsed / done * (total - done), 3))
+
+    def emit(self, record):
+        event = getattr(record, 'event', None)
+
+        if event is None:
+            return
+
+        try:
+            event = dict(event)
+            self._timing(event, record.created)
+            event.update({'time':round(record.created, 3), 'host':self.host,
+                          'pid':record.process, 'message':record.getMessage()})
+
+            self.output_io.write(json.dumps(event, default=str) + '\n')
+
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        with self.lock:
+
+            if not self.output_io.closed:
+                self.output_io.close()
+
+                with Events.handlers_lock:
+                    Events.handlers -= 1
+
+        logging.Handler.close(self)
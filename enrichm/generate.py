@@ -25,6 +25,7 @@ import pickle
 import os
 import logging
 import numpy as np
+from scipy import sparse
 from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
 from sklearn.model_selection import train_test_split, RandomizedSearchCV, GridSearchCV
 # Local
@@ -122,30 +123,29 @@ class GenerateModel:
 
         return output_lines
 
-    def transpose(self, labels, features, attribute_list):
+    def transpose(self, labels, matrix):
         '''
 
         Inputs
         ------
+        labels  - Dict. Sample to label
+        matrix  - AnnotationMatrix. Attributes (rows) of each sample (columns)
 
         Outputs
         -------
+        The labels, and the attributes of each sample, in the order of labels.
+        The attributes of a SparseAnnotationMatrix are kept sparse, which the
+        random forests accept as they are.
 
         '''
-        labels_list = list()
-        features_list = list()
+        labels_list = [labels[col] for col in labels]
+        columns = [matrix.column_index[col] for col in labels]
+        features = matrix.array[:, columns].T
 
-        for col in list(labels.keys()):
+        if sparse.issparse(features):
+            return labels_list, features.tocsr().astype(float)
 
-            labels_list.append(labels[col])
-            col_values = list()
-
-            for attribute in attribute_list:
-                col_values.append(features[col][attribute])
-
-            features_list.append(col_values)
-
-        return labels_list, np.array(features_list)
+        return labels_list, features.astype(float)
 
     def grid_search_cv(self, random_search_cv, threads, random_forest_model):
         '''
@@ -301,8 +301,9 @@ class GenerateModel:
 
         logging.info('Parsing inputs:')
         labels, _, _ = Parser.parse_metadata_matrix(groups_path)
-        features, _, attribute_list = Parser.parse_simple_matrix(input_matrix_path)
-        labels_list, features_list = self.transpose(labels, features, attribute_list)
+        matrix = Parser.parse_matrix(input_matrix_path)
+        attribute_list = list(matrix.rownames)
+        labels_list, features_list = self.transpose(labels, matrix)
         labels_dict, labels_list_numeric = self.numerify(labels_list)
 
         logging.info("Tuning hyperparameters")
@@ -17,6 +17,8 @@
 ###############################################################################
 
 from enrichm.sequence_io import SequenceIO
+from enrichm.profiler import Profiler
+from enrichm.toolbox import strip_compression
 import logging
 import os
 
@@ -37,7 +39,7 @@ class Genome:
         self.ortholog_dict = dict()
         self.path = path
         self.gene = gene
-        self.name = os.path.split(os.path.splitext(path)[0])[1]
+        self.name = os.path.split(os.path.splitext(strip_compression(path))[0])[1]
 
         if light == False:
 
@@ -46,7 +48,7 @@ class Genome:
                 self.length = 0
                 gc_list 	= 0.0
 
-                for description, sequence in seqio.each(open(nucl)):
+                for description, sequence in seqio.each(nucl):
                     self.length += len(str(sequence))
                     gc_list 	+= (str(sequence).count('G') + str(sequence).count('C'))
 
@@ -54,16 +56,16 @@ class Genome:
 
             if gene:
 
-                for protein_count, (protein_description, protein_sequence) in enumerate(seqio.each(open(path))):
+                for protein_count, (protein_description, protein_sequence) in enumerate(seqio.each(path)):
 
-                    for _, gene_sequence in seqio.each(open(gene)):
+                    for _, gene_sequence in seqio.each(gene):
                         name = protein_description.partition(' ')[0]
                         sequence = Sequence(protein_description, protein_sequence, gene_sequence)
                         self.sequences[name] = sequence
                         self.protein_ordered_dict[protein_count] = name
             else:
 
-                for protein_count, (protein_description, protein_sequence) in enumerate(seqio.each(open(path))):
+                for protein_count, (protein_description, protein_sequence) in enumerate(seqio.each(path)):
                     name = protein_description.partition(' ')[0]
                     sequence = Sequence(protein_description, protein_sequence)
                     self.sequences[name] = sequence
@@ -71,12 +73,13 @@ class Genome:
 
         else:
 
-            for protein_count, (description, _) in enumerate(seqio.each(open(path))):
+            for protein_count, (description, _) in enumerate(seqio.each(path)):
                 name = description.partition(' ')[0]
                 sequence = Sequence(description)
                 self.sequences[name] = sequence
                 self.protein_ordered_dict[protein_count] = name
 
+    @Profiler.profile('Genome.add')
     def add(self, annotations, evalue_cutoff, bitscore_cutoff,
          percent_aln_query_cutoff, percent_aln_reference_cutoff, specific_cutoffs,
             annotation_type, ref_ids):
@@ -95,7 +98,12 @@ class Genome:
                                           that must be aligned to consider the annotation.
         annotation_type					- String. Either 'KO', 'TIGRFAM', 'PFAM',
                                           'HYPOTHETICAL' or 'COG'
+
+        Output
+        ------
+        The number of hits added
         '''
+        hits = 0
         # Load up annotation parser, and tell it what annotation type to expect
         ap = AnnotationParser(annotation_type)
 
@@ -148,6 +156,7 @@ class Genome:
 
         for seqname, annotations, evalue, annotation_range in iterator:
             self.sequences[seqname].add(annotations, evalue, annotation_range, ref_ids)
+            hits += 1
 
             for annotation in annotations:
 
@@ -156,6 +165,54 @@ class Genome:
                 else:
                     refdict[annotation]=[seqname]
 
+        return hits
+
+    def snapshot(self):
+        '''
+        Copy the annotations of the genome and its sequences, so that they
+        can be put back with restore if adding further annotations fails.
+
+        Output
+        ------
+        The state of the genome, to pass to restore
+        '''
+        genome_state = dict()
+
+        for attribute, value in self.__dict__.items():
+
+            if isinstance(value, set):
+                value = set(value)
+
+            elif isinstance(value, dict) and attribute != 'sequences':
+                # e.g. ko_dict, whose lists of sequences are appended to
+                value = {key:(list(item) if isinstance(item, list) else item)
+                         for key, item in value.items()}
+
+            genome_state[attribute] = value
+
+        sequence_states = dict()
+
+        for name, sequence in self.sequences.items():
+            sequence_state = dict(sequence.__dict__)
+            sequence_state['annotations'] = list(sequence.annotations)
+            sequence_states[name] = sequence_state
+
+        return genome_state, sequence_states
+
+    def restore(self, state):
+        '''
+        Put back the annotations copied by snapshot.
+
+        Parameters
+        ----------
+        state - Tuple. The state returned by snapshot
+        '''
+        genome_state, sequence_states = state
+        self.__dict__ = dict(genome_state)
+
+        for name, sequence_state in sequence_states.items():
+            self.sequences[name].__dict__ = dict(sequence_state)
+
     def count(self, annotation, type):
         '''
 
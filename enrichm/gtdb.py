@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Columnar copies of the GTDB reference annotation matrices.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import logging
+import tempfile
+import numpy as np
+###############################################################################
+
+class GtdbMatrix:
+    '''
+    The GTDB annotation matrices (gtdb_ko.tsv etc.) have an annotation per
+    row and a reference genome per column, so reading a few genomes from the
+    text file means parsing all of it. The columnar copy stores the counts
+    transposed in a .npy file, with the counts of each genome contiguous.
+    The annotations (rows of the text file) and genomes (its columns) are
+    listed in order in .rows.txt and .cols.txt files next to it. Genomes are
+    read from the .npy through a memory map, so only the genomes selected
+    are read from disk.
+    '''
+    NPY_SUFFIX = '.npy'
+    ROWS_SUFFIX = '.rows.txt'
+    COLS_SUFFIX = '.cols.txt'
+    BLOCK_ROWS = 1024
+
+    @staticmethod
+    def paths(matrix):
+        '''
+        The paths of the columnar copy of a matrix.
+
+        Parameters
+        ----------
+        matrix  - String. Path to the text matrix, e.g. gtdb_ko.tsv
+
+        Output
+        ------
+        The paths to the .npy, .rows.txt and .cols.txt files
+        '''
+        prefix = os.path.splitext(matrix)[0]
+
+        return (prefix + GtdbMatrix.NPY_SUFFIX, prefix + GtdbMatrix.ROWS_SUFFIX,
+                prefix + GtdbMatrix.COLS_SUFFIX)
+
+    @staticmethod
+    def exists(matrix):
+        '''
+        Whether the columnar copy of a matrix has been made.
+        '''
+        return all(os.path.isfile(path) for path in GtdbMatrix.paths(matrix))
+
+    @staticmethod
+    def _write_lines(path, lines):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        with os.fdopen(file_descriptor, 'w') as out_io:
+
+            for line in lines:
+                out_io.write(line + '\n')
+
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def convert(matrix):
+        '''
+        Make the columnar copy of a matrix. The text file is read twice, once
+        to size the array and pick the smallest integer type that holds the
+        counts, and once to fill it, so the whole matrix is never held in
+        memory.
+
+        Parameters
+        ----------
+        matrix  - String. Path to the text matrix, e.g. gtdb_ko.tsv
+        '''
+        npy_path, rows_path, cols_path = GtdbMatrix.paths(matrix)
+        rows = list()
+        maximum = 0
+
+        with open(matrix) as matrix_io:
+            columns = matrix_io.readline().strip().split('\t')[1:]
+
+            for row in matrix_io:
+                srow = row.strip().split()
+                rows.append(srow[0])
+                maximum = max(maximum, max((int(count) for count in srow[1:]), default=0))
+
+        dtype = np.min_scalar_type(maximum)
+        logging.info("    - Converting %s: %i annotations by %i genomes (%s)"
+                     % (os.path.basename(matrix), len(rows), len(columns), dtype))
+
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(npy_path), suffix=GtdbMatrix.NPY_SUFFIX)
+        os.close(file_descriptor)
+
+        try:
+            array = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=dtype,
+                                              shape=(len(columns), len(rows)))
+
+            with open(matrix) as matrix_io:
+                matrix_io.readline()
+                start = 0
+                block = list()
+
+                # Rows are written in blocks, as each is a strided write
+                # across every genome
+                for row in matrix_io:
+                    block.append(row.strip().split()[1:])
+
+                    if len(block) == GtdbMatrix.BLOCK_ROWS:
+                        array[:, start:start + len(block)] = np.array(block, dtype=dtype).T
+                        start += len(block)
+                        block = list()
+
+                if block:
+                    array[:, start:start + len(block)] = np.array(block, dtype=dtype).T
+
+            array.flush()
+            del array
+
+            # The sidecars are written first, as the .npy marks the copy as complete
+            GtdbMatrix._write_lines(rows_path, rows)
+            GtdbMatrix._write_lines(cols_path, columns)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, npy_path)
+
+        finally:
+
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        return npy_path
+
+    @staticmethod
+    def load_columns(columns, matrix):
+        '''
+        Read the counts of some genomes from the columnar copy of a matrix.
+        Returns the same as Parser.filter_large_matrix.
+
+        Parameters
+        ----------
+        columns - Iterable. Genomes to read
+        matrix  - String. Path to the text matrix, e.g. gtdb_ko.tsv
+
+        Output
+        ------
+        A dictionary of the counts above zero of each genome found, and a list
+        of the genomes found
+        '''
+        npy_path, rows_path, cols_path = GtdbMatrix.paths(matrix)
+
+        with open(rows_path) as rows_io:
+            rows = [line.rstrip('\n') for line in rows_io]
+
+        column_index = dict()
+
+        with open(cols_path) as cols_io:
+
+            for index, line in enumerate(cols_io):
+                column_index.setdefault(line.rstrip('\n'), index)
+
+        array = np.load(npy_path, mmap_mode='r')
+        include = [column for column in columns if column in column_index]
+        output_dict = dict()
+
+        for column in include:
+            counts = np.asarray(array[column_index[column]])
+            output_dict[column] = {rows[index]:int(counts[index]) for index in np.flatnonzero(counts)}
+
+        return output_dict, include
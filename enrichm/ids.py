@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Compiled catalogs of the KEGG, Pfam, TIGRFAM, CAZy and EC identifiers, and
+the dense numbering of the reactions of the database.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import pickle
+import logging
+import tempfile
+import threading
+import numpy as np
+###############################################################################
+
+class IdCatalog:
+    '''
+    The ids of an annotation type (KO_IDS.txt, PFAM_IDS.txt, etc.), which are
+    the rows of the frequency tables written by annotate, in order. Each
+    catalog is compiled to a pickle next to its text file, and loaded once
+    per process, so that every table of an annotation type shares one list
+    of rows and one index of id to row.
+    '''
+    SUFFIX = '.pickle'
+    # Files of the database listing the ids of each annotation type
+    ID_FILES = ['KO_IDS.txt', 'EC_IDS.txt', 'PFAM_IDS.txt', 'TIGRFAM_IDS.txt', 'CAZY_IDS.txt']
+    # Catalogs loaded, by database directory and id file
+    catalogs = dict()
+    lock = threading.Lock()
+
+    def __init__(self, ids):
+        '''
+        Parameters
+        ----------
+        ids - List. Annotation ids, in row order
+        '''
+        self.ids = list(ids)
+        self.index = {annotation:row for row, annotation in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, annotations):
+        '''
+        The rows of some annotations, or -1 for those not in the catalog.
+
+        Parameters
+        ----------
+        annotations - Iterable. Annotation ids
+        '''
+        return [self.index.get(annotation, -1) for annotation in annotations]
+
+    @staticmethod
+    def path(ids_dir, id_file):
+        return os.path.join(ids_dir, os.path.splitext(id_file)[0] + IdCatalog.SUFFIX)
+
+    @staticmethod
+    def _read_ids(ids_dir, id_file):
+        with open(os.path.join(ids_dir, id_file)) as id_io:
+            return [line.strip() for line in id_io]
+
+    @staticmethod
+    def build(ids_dir, id_file):
+        '''
+        Compile the text list of ids of an annotation type.
+
+        Parameters
+        ----------
+        ids_dir     - String. Directory of the id files of the database
+        id_file     - String. Name of the id file, e.g. KO_IDS.txt
+        '''
+        ids = IdCatalog._read_ids(ids_dir, id_file)
+        output_path = IdCatalog.path(ids_dir, id_file)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=ids_dir)
+
+        with os.fdopen(file_descriptor, 'wb') as out_io:
+            pickle.dump(ids, out_io, protocol=4)
+
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, output_path)
+        logging.info("Compiled %i ids of %s" % (len(ids), id_file))
+
+        return IdCatalog(ids)
+
+    @staticmethod
+    def load(ids_dir, id_file):
+        '''
+        Load the ids of an annotation type, from the compiled catalog if there
+        is one, otherwise from the text file.
+
+        Parameters
+        ----------
+        ids_dir     - String. Directory of the id files of the database
+        id_file     - String. Name of the id file, e.g. KO_IDS.txt
+        '''
+        input_path = IdCatalog.path(ids_dir, id_file)
+        text_path = os.path.join(ids_dir, id_file)
+
+        # A catalog older than its text file is out of date
+        if os.path.isfile(input_path) and \
+                (not os.path.isfile(text_path) or os.path.getmtime(input_path) >= os.path.getmtime(text_path)):
+
+            with open(input_path, 'rb') as input_io:
+                return IdCatalog(pickle.load(input_io))
+
+        return IdCatalog(IdCatalog._read_ids(ids_dir, id_file))
+
+    @staticmethod
+    def get(id_file, ids_dir=None):
+        '''
+        The catalog of an annotation type, loaded on first use.
+
+        Parameters
+        ----------
+        id_file     - String. Name of the id file, e.g. KO_IDS.txt
+        ids_dir     - String. Directory of the id files. Defaults to that of
+                      the installed database.
+        '''
+        if ids_dir is None:
+            # Imported here, so that modules using catalogs don't load the
+            # database module until a catalog is needed
+            from enrichm.databases import Databases
+            ids_dir = Databases.ids_dir()
+
+        key = (ids_dir, id_file)
+        catalog = IdCatalog.catalogs.get(key)
+
+        if catalog is None:
+
+            with IdCatalog.lock:
+                catalog = IdCatalog.catalogs.get(key)
+
+                if catalog is None:
+                    catalog = IdCatalog.catalogs[key] = IdCatalog.load(ids_dir, id_file)
+
+        return catalog
+
+class ReactionIds:
+    '''
+    The reactions of the database numbered densely, and the KO to reaction
+    map as arrays of those numbers: the reactions of the KO in row i of kos
+    are columns[indptr[i]:indptr[i + 1]]. TPM matrices use the numbers as
+    their columns, so every matrix shares one index of reaction to column,
+    rather than each holding a dictionary of reaction ids of its own. Written
+    to the database by 'enrichm data --compile' (see Databases.reaction_ids).
+    '''
+
+    def __init__(self, reactions, kos, indptr, columns):
+        '''
+        Parameters
+        ----------
+        reactions   - List. Reaction ids, in column order
+        kos         - List. KO ids, in row order
+        indptr      - Array. Start of the reactions of each KO in columns, and the end of the last
+        columns     - Array. Columns of the reactions of each KO
+        '''
+        self.reactions = IdCatalog(reactions)
+        self.kos = IdCatalog(kos)
+        self.indptr = indptr
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.reactions)
+
+    def ko_columns(self, ko):
+        '''
+        The columns of the reactions a KO carries out, empty for KOs without
+        any.
+
+        Parameters
+        ----------
+        ko  - String. KO id
+        '''
+        row = self.kos.index.get(ko)
+
+        if row is None:
+            return self.columns[:0]
+
+        return self.columns[self.indptr[row]:self.indptr[row + 1]]
+
+    @staticmethod
+    def from_k2r(k2r):
+        '''
+        Number the reactions of a KO to reaction map.
+
+        Parameters
+        ----------
+        k2r - Dict. KO to the reactions it carries out
+        '''
+        reactions = sorted(set(reaction for ko_reactions in k2r.values() for reaction in ko_reactions))
+        reaction_index = {reaction:column for column, reaction in enumerate(reactions)}
+        kos = sorted(k2r)
+        indptr = np.zeros(len(kos) + 1, dtype=np.int64)
+        np.cumsum([len(k2r[ko]) for ko in kos], out=indptr[1:])
+        columns = np.array([reaction_index[reaction] for ko in kos for reaction in k2r[ko]], dtype=np.int32)
+
+        return ReactionIds(reactions, kos, indptr, columns)
+
+    def save(self, output_path):
+        '''
+        Write the numbering, replacing any existing file once it is complete.
+
+        Parameters
+        ----------
+        output_path - String. Path to write to
+        '''
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix='.npz')
+
+        try:
+
+            with os.fdopen(file_descriptor, 'wb') as out_io:
+                np.savez(out_io, reactions=np.array(self.reactions.ids, dtype=str),
+                         kos=np.array(self.kos.ids, dtype=str), indptr=self.indptr, columns=self.columns)
+
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, output_path)
+
+        finally:
+
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @staticmethod
+    def load(input_path):
+        '''
+        Read a numbering written by save.
+
+        Parameters
+        ----------
+        input_path  - String. Path to the numbering
+        '''
+        with np.load(input_path) as arrays:
+            return ReactionIds(arrays['reactions'].tolist(), arrays['kos'].tolist(),
+                               arrays['indptr'], arrays['columns'])
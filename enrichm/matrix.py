@@ -0,0 +1,726 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+An in-memory frequency matrix of annotations (rows) per genome (columns).
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import logging
+from collections.abc import Mapping
+import os
+import tempfile
+import numpy as np
+# Local
+from enrichm.gtdb import GtdbMatrix
+from enrichm.toolbox import open_file
+###############################################################################
+
+class MatrixColumn(Mapping):
+    '''
+    The values of one genome of an AnnotationMatrix as a read only
+    dictionary of annotation to value, for code written against the
+    dictionaries the matrix used to be parsed into.
+    '''
+
+    def __init__(self, matrix, column):
+        self.matrix = matrix
+        self.column = column
+        self.column_values = None
+
+    def _values(self):
+        # Converted once, so that lookups return Python numbers
+        if self.column_values is None:
+            self.column_values = self.matrix.array[:, self.column].tolist()
+
+        return self.column_values
+
+    def __getitem__(self, rowname):
+        return self._values()[self.matrix.row_index[rowname]]
+
+    def __contains__(self, rowname):
+        return rowname in self.matrix.row_index
+
+    def __iter__(self):
+        return iter(self.matrix.rownames)
+
+    def __len__(self):
+        return len(self.matrix.rownames)
+
+    def items(self):
+        return list(zip(self.matrix.rownames, self._values()))
+
+    def values(self):
+        return list(self._values())
+
+class SparseMatrixColumn(Mapping):
+    '''
+    The values of one genome of a SparseAnnotationMatrix as a read only
+    dictionary. Only the annotations the genome has are iterated over, but
+    looking up any other annotation of the matrix gives 0.
+    '''
+
+    def __init__(self, matrix, column):
+        self.matrix = matrix
+        self.column = column
+        self.column_values = None
+
+    def _values(self):
+        if self.column_values is None:
+            rows, values = self.matrix.nonzero(self.column)
+            self.column_values = dict(zip([self.matrix.rownames[row] for row in rows.tolist()], values.tolist()))
+
+        return self.column_values
+
+    def __getitem__(self, rowname):
+        value = self._values().get(rowname)
+
+        if value is None:
+            # Raises a KeyError for annotations not in the matrix
+            self.matrix.row_index[rowname]
+            return self.matrix.array.dtype.type(0).item()
+
+        return value
+
+    def __contains__(self, rowname):
+        return rowname in self.matrix.row_index
+
+    def __iter__(self):
+        return iter(self._values())
+
+    def __len__(self):
+        return len(self._values())
+
+    def items(self):
+        return list(self._values().items())
+
+    def values(self):
+        return list(self._values().values())
+
+class MatrixValues(Mapping):
+    '''
+    An AnnotationMatrix as a read only dictionary of genome to MatrixColumn.
+    '''
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.columns = dict()
+
+    def __getitem__(self, colname):
+        column = self.columns.get(colname)
+
+        if column is None:
+            column = self.columns[colname] = self.matrix.COLUMN(self.matrix, self.matrix.column_index[colname])
+
+        return column
+
+    def __contains__(self, colname):
+        return colname in self.matrix.column_index
+
+    def __iter__(self):
+        return iter(self.matrix.colnames)
+
+    def __len__(self):
+        return len(self.matrix.colnames)
+
+class AnnotationMatrix:
+    '''
+    Frequency of each annotation within each genome. Produced by annotate,
+    and accepted in place of a matrix file by classify and enrichment, so that
+    the pipelines can be chained in Python without writing and re-parsing
+    the matrix.
+
+    The frequencies are held in a NumPy array with a row per annotation and
+    a column per genome. values gives the dictionary of genome to dictionary
+    of annotation to frequency that the matrix used to be parsed into.
+
+    array       - Array. Frequencies, annotations by genomes
+    colnames    - List. Genome names, in column order
+    rownames    - List. Annotation ids, in row order
+    row_index   - Dict. Annotation id to row
+    column_index- Dict. Genome name to column
+    '''
+    ID = 'ID'
+    COLUMN = MatrixColumn
+
+    def __init__(self, values, colnames, rownames):
+        '''
+        Parameters
+        ----------
+        values      - Array or dict. Frequencies, annotations by genomes, or
+                      a dictionary of genome name to a dictionary of
+                      annotation to frequency. Annotations missing from the
+                      dictionary have a frequency of 0.
+        colnames    - List. Genome names, in column order
+        rownames    - List. Annotation ids, in row order
+        '''
+        self.colnames = colnames
+        self.rownames = rownames
+        self.row_index = {rowname:row for row, rowname in enumerate(rownames)}
+        self.column_index = {colname:column for column, colname in enumerate(colnames)}
+
+        if isinstance(values, Mapping):
+            self.array = self._from_dict(values)
+        else:
+            self.array = values
+
+        self.values = MatrixValues(self)
+
+    def _from_dict(self, values):
+        # Integers are kept as integers, so they are written out the same
+        if all(isinstance(value, (int, np.integer)) for column in values.values() for value in column.values()):
+            dtype = np.int64
+        else:
+            dtype = np.float64
+
+        array = np.zeros((len(self.rownames), len(self.colnames)), dtype=dtype)
+
+        for colname, column_values in values.items():
+            column = self.column_index[colname]
+
+            for rowname, value in column_values.items():
+                row = self.row_index.get(rowname)
+
+                if row is not None:
+                    array[row, column] = value
+
+        return array
+
+    def __getstate__(self):
+        # The dictionary adapter is made again when unpickled
+        state = dict(self.__dict__)
+        del state['values']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.values = MatrixValues(self)
+
+    def column(self, colname):
+        '''
+        The frequencies of a genome, in row order.
+
+        Parameters
+        ----------
+        colname - String. Genome name
+        '''
+        return self.array[:, self.column_index[colname]]
+
+    def present(self, colname):
+        '''
+        The annotations of a genome with a frequency above 0, in row order.
+
+        Parameters
+        ----------
+        colname - String. Genome name
+        '''
+        return [self.rownames[row] for row in np.flatnonzero(self.column(colname) > 0)]
+
+    def take(self, rows):
+        '''
+        The frequencies of some annotations as a dense array, genomes by
+        annotations.
+
+        Parameters
+        ----------
+        rows    - List. Rows of the annotations
+        '''
+        return self.array[rows].T
+
+    @staticmethod
+    def is_binary(matrix_path):
+        '''
+        Whether a path is to a binary copy of a matrix rather than the text.
+        '''
+        return matrix_path.endswith((GtdbMatrix.NPY_SUFFIX, SparseAnnotationMatrix.SUFFIX))
+
+    @staticmethod
+    def load(matrix_path):
+        '''
+        Read a matrix written by AnnotationMatrix.write, or a binary copy of
+        it (see write_binary). A binary copy is read in place of a text matrix
+        if it sits next to it and is up to date.
+
+        Parameters
+        ----------
+        matrix_path - String. Path to the matrix file, or its binary copy
+        '''
+        if matrix_path.endswith(SparseAnnotationMatrix.SUFFIX):
+            return SparseAnnotationMatrix.from_npz(matrix_path)
+
+        if matrix_path.endswith(GtdbMatrix.NPY_SUFFIX):
+            return AnnotationMatrix.from_npy(matrix_path)
+
+        npz_path = SparseAnnotationMatrix.npz_path(matrix_path)
+
+        if os.path.isfile(npz_path) and os.path.getmtime(npz_path) >= os.path.getmtime(matrix_path):
+            return SparseAnnotationMatrix.from_npz(npz_path)
+
+        npy_path = GtdbMatrix.paths(matrix_path)[0]
+
+        if GtdbMatrix.exists(matrix_path) and os.path.getmtime(npy_path) >= os.path.getmtime(matrix_path):
+            return AnnotationMatrix.from_npy(npy_path)
+
+        return AnnotationMatrix.from_file(matrix_path)
+
+    def write_binary(self, matrix_path):
+        '''
+        Write a binary copy of the matrix next to the text matrix, that is read
+        through a memory map, so that jobs reading the same matrix share one
+        copy of it in the page cache. The layout is that of the columnar GTDB
+        matrices (see GtdbMatrix): the frequencies of each genome contiguous
+        in a .npy, with the annotations and genomes in .rows.txt and .cols.txt
+        files.
+
+        Parameters
+        ----------
+        matrix_path - String. Path to the text matrix
+        '''
+        npy_path, rows_path, cols_path = GtdbMatrix.paths(matrix_path)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(npy_path)),
+                                                           suffix=GtdbMatrix.NPY_SUFFIX)
+        os.close(file_descriptor)
+
+        try:
+            array = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=self.array.dtype,
+                                              shape=(len(self.colnames), len(self.rownames)))
+            array[...] = self.array.T
+            array.flush()
+            del array
+
+            # The sidecars are written first, as the .npy marks the copy as complete
+            GtdbMatrix._write_lines(rows_path, self.rownames)
+            GtdbMatrix._write_lines(cols_path, self.colnames)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, npy_path)
+
+        finally:
+
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @staticmethod
+    def from_npy(npy_path):
+        '''
+        Map a matrix written by AnnotationMatrix.write_binary. The array is
+        read only.
+
+        Parameters
+        ----------
+        npy_path    - String. Path to the .npy file
+        '''
+        _, rows_path, cols_path = GtdbMatrix.paths(npy_path)
+
+        with open(rows_path) as rows_io:
+            rownames = [line.rstrip('\n') for line in rows_io]
+
+        with open(cols_path) as cols_io:
+            colnames = [line.rstrip('\n') for line in cols_io]
+
+        return AnnotationMatrix(np.load(npy_path, mmap_mode='r').T, colnames, rownames)
+
+    @staticmethod
+    def from_file(matrix_path):
+        '''
+        Parse a tab separated matrix with annotations as rows and genomes as
+        columns. If an annotation is repeated, its last row is kept, in the
+        position of its first.
+
+        Parameters
+        ----------
+        matrix_path - String. Path to the matrix file
+        '''
+        with open_file(matrix_path) as matrix_io:
+            colnames = matrix_io.readline().strip().split('\t')[1:]
+            rownames = list()
+            rows = list()
+
+            for line in matrix_io:
+                sline = line.strip().split('\t')
+                content = sline[1:]
+
+                # Missing entries are 0, and extra entries ignored
+                if len(content) != len(colnames):
+                    content = (content + ['0'] * len(colnames))[:len(colnames)]
+
+                rownames.append(sline[0])
+                rows.append(content)
+
+        array = np.array(rows, dtype=np.float64).reshape(len(rows), len(colnames))
+        row_index = dict()
+
+        for row, rowname in enumerate(rownames):
+            row_index[rowname] = row
+
+        if len(row_index) != len(rownames):
+            first_rows = dict()
+
+            for row, rowname in enumerate(rownames):
+                first_rows.setdefault(rowname, row)
+
+            rownames = list(first_rows)
+            array = array[[row_index[rowname] for rowname in rownames]]
+
+        return AnnotationMatrix(array, colnames, rownames)
+
+    def write(self, output_path):
+        '''
+        Write the matrix to a tab separated file.
+
+        Parameters
+        ----------
+        output_path - String. Path to file to which the matrix is written
+        '''
+        logging.info("    - Writing results to file: %s" % output_path)
+
+        with open_file(output_path, 'w') as out_io:
+            out_io.write('\t'.join([self.ID] + self.colnames) + '\n')
+
+            for rowname, row in zip(self.rownames, self.array):
+                out_io.write('\t'.join([rowname] + [str(value) for value in row.tolist()]) + '\n')
+
+class SparseAnnotationMatrix(AnnotationMatrix):
+    '''
+    An AnnotationMatrix for tables that are mostly zeros (e.g. clusters,
+    orthologs and pfam domains), with only the frequencies above zero held in
+    memory. array is a scipy.sparse CSC matrix of annotations by genomes, i.e.
+    the CSR matrix of genomes by annotations, so that the annotations of each
+    genome are contiguous. Alongside the text matrix, it is saved to a .npz
+    file that is read back without parsing (see SparseAnnotationMatrix.save).
+    '''
+    COLUMN = SparseMatrixColumn
+    SUFFIX = '.npz'
+
+    def __init__(self, values, colnames, rownames):
+        '''
+        Parameters
+        ----------
+        values      - Sparse matrix or dict. Frequencies, annotations by
+                      genomes, or a dictionary of genome name to a dictionary
+                      of annotation to frequency.
+        colnames    - List. Genome names, in column order
+        rownames    - List. Annotation ids, in row order
+        '''
+        # scipy is slow to import, so is only imported by the sparse matrices
+        from scipy import sparse
+
+        AnnotationMatrix.__init__(self, values, colnames, rownames)
+        self.array = sparse.csc_matrix(self.array)
+        self.array.eliminate_zeros()
+        self.array.sort_indices()
+
+    def _from_dict(self, values):
+        if all(isinstance(value, (int, np.integer)) for column in values.values() for value in column.values()):
+            dtype = np.int64
+        else:
+            dtype = np.float64
+
+        rows, columns, data = list(), list(), list()
+
+        for colname, column_values in values.items():
+            column = self.column_index[colname]
+
+            for rowname, value in column_values.items():
+                row = self.row_index.get(rowname)
+
+                if row is not None and value:
+                    rows.append(row)
+                    columns.append(column)
+                    data.append(value)
+
+        return SparseAnnotationMatrix.coo(rows, columns, data, dtype, (len(self.rownames), len(self.colnames)))
+
+    @staticmethod
+    def coo(rows, columns, data, dtype, shape):
+        '''
+        A sparse matrix from the row, column and value of each entry above 0.
+        '''
+        from scipy import sparse
+
+        return sparse.coo_matrix((np.array(data, dtype=dtype),
+                                  (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64))),
+                                 shape=shape)
+
+    def nonzero(self, column):
+        '''
+        The rows of a column with a frequency above zero, in order, and their
+        frequencies.
+
+        Parameters
+        ----------
+        column  - Integer. Column index
+        '''
+        start, end = self.array.indptr[column], self.array.indptr[column + 1]
+
+        return self.array.indices[start:end], self.array.data[start:end]
+
+    def column(self, colname):
+        return self.array[:, self.column_index[colname]].toarray().ravel()
+
+    def present(self, colname):
+        rows, values = self.nonzero(self.column_index[colname])
+
+        return [self.rownames[row] for row in rows[values > 0].tolist()]
+
+    def take(self, rows):
+        return self.array[rows].T.toarray()
+
+    @staticmethod
+    def npz_path(matrix_path):
+        '''
+        The path of the sparse copy of a text matrix.
+        '''
+        return os.path.splitext(matrix_path)[0] + SparseAnnotationMatrix.SUFFIX
+
+    def save(self, output_path):
+        '''
+        Save the matrix to a .npz file.
+
+        Parameters
+        ----------
+        output_path - String. Path to the .npz file
+        '''
+        # Written under a temporary name, as a partial copy would be read in
+        # place of the text matrix
+        temporary_path = output_path + '.tmp' + self.SUFFIX
+        np.savez(temporary_path, data=self.array.data, indices=self.array.indices,
+                 indptr=self.array.indptr, shape=np.array(self.array.shape),
+                 rownames=np.array(self.rownames, dtype=str), colnames=np.array(self.colnames, dtype=str))
+        os.replace(temporary_path, output_path)
+
+    def write_binary(self, matrix_path):
+        self.save(self.npz_path(matrix_path))
+
+    @staticmethod
+    def from_npz(npz_path):
+        '''
+        Read a matrix saved by SparseAnnotationMatrix.save.
+
+        Parameters
+        ----------
+        npz_path    - String. Path to the .npz file
+        '''
+        from scipy import sparse
+
+        with np.load(npz_path) as npz:
+            array = sparse.csc_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+
+            return SparseAnnotationMatrix(array, npz['colnames'].tolist(), npz['rownames'].tolist())
+
+    @staticmethod
+    def from_file(matrix_path):
+        '''
+        Parse a tab separated matrix (see AnnotationMatrix.from_file), keeping
+        only the frequencies above zero, so the dense matrix is never held in
+        memory.
+
+        Parameters
+        ----------
+        matrix_path - String. Path to the matrix file
+        '''
+        with open_file(matrix_path) as matrix_io:
+            colnames = matrix_io.readline().strip().split('\t')[1:]
+            # Columns and values above zero of each row. A repeated row keeps
+            # the position of its first, and the values of its last
+            entries = dict()
+
+            for line in matrix_io:
+                sline = line.strip().split('\t')
+                content = np.array(sline[1:len(colnames) + 1], dtype=np.float64)
+                columns = np.flatnonzero(content)
+                entries[sline[0]] = (columns, content[columns])
+
+        rownames = list(entries)
+        rows = np.repeat(np.arange(len(rownames)), [len(columns) for columns, _ in entries.values()])
+        columns = np.concatenate([columns for columns, _ in entries.values()] or [np.zeros(0, dtype=np.int64)])
+        data = np.concatenate([values for _, values in entries.values()] or [np.zeros(0)])
+
+        return SparseAnnotationMatrix(SparseAnnotationMatrix.coo(rows, columns, data, np.float64, (len(rownames), len(colnames))),
+                                      colnames, rownames)
+
+    def write(self, output_path):
+        logging.info("    - Writing results to file: %s" % output_path)
+        # Rows are written one at a time from the row compressed matrix
+        array = self.array.tocsr()
+        zero = str(array.dtype.type(0).item())
+
+        with open_file(output_path, 'w') as out_io:
+            out_io.write('\t'.join([self.ID] + self.colnames) + '\n')
+
+            for row, rowname in enumerate(self.rownames):
+                output_line = [zero] * len(self.colnames)
+                start, end = array.indptr[row], array.indptr[row + 1]
+
+                for column, value in zip(array.indices[start:end].tolist(), array.data[start:end].tolist()):
+                    output_line[column] = str(value)
+
+                out_io.write('\t'.join([rowname] + output_line) + '\n')
+
+class TpmMatrix:
+    '''
+    Expression of each reaction within each genome in each sample, from the
+    TPM values of the genes of the genomes reported by detectM. array is a
+    scipy.sparse CSR matrix with a row per sample and genome, the genomes of
+    each sample contiguous (row = sample * len(genomes) + genome), and a
+    column per reaction of the database, numbered as in ReactionIds.
+
+    samples     - List. Sample names, in order
+    genomes     - List. Genome names, in order
+    reactions   - List. Reaction ids, in column order
+    '''
+    # Columns of the detectM output that are read
+    GENE = 0
+    TPM = 10
+    # Lines read at a time, roughly, in bytes
+    CHUNK_BYTES = 67108864
+    # Entries held before those of different lines are summed
+    MERGE_ENTRIES = 50000000
+
+    def __init__(self, array, samples, genomes, reaction_ids):
+        '''
+        Parameters
+        ----------
+        array           - Sparse matrix. Expression, samples and genomes by reactions
+        samples         - List. Sample names, in order
+        genomes         - List. Genome names, in order
+        reaction_ids    - ReactionIds. Numbering of the reactions, shared by every TpmMatrix
+        '''
+        self.array = array
+        self.samples = samples
+        self.genomes = genomes
+        self.reactions = reaction_ids.reactions.ids
+        self.sample_index = {sample:index for index, sample in enumerate(samples)}
+        self.genome_index = {genome:index for index, genome in enumerate(genomes)}
+        self.reaction_index = reaction_ids.reactions.index
+
+    def sample(self, sample):
+        '''
+        The expression of each reaction within each genome in a sample, a
+        sparse matrix of genomes by reactions.
+
+        Parameters
+        ----------
+        sample  - String. Sample name
+        '''
+        start = self.sample_index[sample] * len(self.genomes)
+
+        return self.array[start:start + len(self.genomes)]
+
+    @staticmethod
+    def _sum(samples, genomes, reactions, values, shape):
+        # Sum the values of repeated (sample, genome, reaction) entries
+        keys = (samples * shape[1] + genomes) * shape[2] + reactions
+        keys, inverse = np.unique(keys, return_inverse=True)
+        values = np.bincount(inverse.ravel(), weights=values, minlength=len(keys))
+        samples, keys = np.divmod(keys, shape[1] * shape[2])
+        genomes, reactions = np.divmod(keys, shape[2])
+
+        return [samples, genomes, reactions, values]
+
+    @staticmethod
+    def from_file(tpm_path, reaction_ids):
+        '''
+        Read the TPM values reported by detectM. The file is read in chunks,
+        and the TPM of a gene is added to each reaction of each of its KOs.
+        The reactions of each distinct annotation field are looked up once,
+        and the values of a chunk are summed as arrays rather than line by
+        line, so that the TPM of hundreds of millions of genes can be read.
+
+        Parameters
+        ----------
+        tpm_path        - String. Path to the detectM output, which may be compressed
+        reaction_ids    - ReactionIds. Numbering of the reactions, and the reactions of each KO
+
+        Output
+        ------
+        A TpmMatrix
+        '''
+        samples, genomes = dict(), dict()
+        reaction_count = len(reaction_ids)
+        # Annotation field to the columns of its reactions
+        annotation_reactions = dict()
+        entries = [np.zeros(0, dtype=np.int64)] * 3 + [np.zeros(0)]
+        pending = list()
+        pending_entries = 0
+
+        def lookup_reactions(annotation):
+            return [column for ko in annotation.decode().split(',')
+                    for column in reaction_ids.ko_columns(ko).tolist()]
+
+        def merge(entries, pending):
+            shape = (len(samples), len(genomes), reaction_count)
+            arrays = [np.concatenate([chunk[index] for chunk in [entries] + pending]) for index in range(4)]
+
+            return TpmMatrix._sum(*arrays, shape)
+
+        with open_file(tpm_path, 'rb') as tpm_io:
+            tpm_io.readline()
+
+            while True:
+                lines = tpm_io.readlines(TpmMatrix.CHUNK_BYTES)
+
+                if not lines:
+                    break
+
+                line_samples, line_genomes, line_tpms, line_counts, columns = list(), list(), list(), list(), list()
+
+                for line in lines:
+                    line = line.strip()
+
+                    if not line:
+                        continue
+
+                    # Split off the gene and TPM, then the annotation and
+                    # sample from the end, leaving the columns in between
+                    fields = line.split(b'\t', TpmMatrix.TPM + 1)
+                    _, annotation, sample = fields[-1].rsplit(b'\t', 2)
+                    tpm = float(fields[TpmMatrix.TPM])
+                    gene = fields[TpmMatrix.GENE]
+                    sample_column = samples.setdefault(sample, len(samples))
+                    genome_column = genomes.setdefault(b'_'.join(gene.split(b'_', 2)[:2]), len(genomes))
+                    annotation_columns = annotation_reactions.get(annotation)
+
+                    if annotation_columns is None:
+                        annotation_columns = annotation_reactions[annotation] = lookup_reactions(annotation)
+
+                    if annotation_columns:
+                        line_samples.append(sample_column)
+                        line_genomes.append(genome_column)
+                        line_tpms.append(tpm)
+                        line_counts.append(len(annotation_columns))
+                        columns.extend(annotation_columns)
+
+                line_counts = np.array(line_counts, dtype=np.int64)
+                pending.append([np.repeat(np.array(line_samples, dtype=np.int64), line_counts),
+                                np.repeat(np.array(line_genomes, dtype=np.int64), line_counts),
+                                np.array(columns, dtype=np.int64),
+                                np.repeat(np.array(line_tpms, dtype=np.float64), line_counts)])
+                pending_entries += len(columns)
+
+                if pending_entries > TpmMatrix.MERGE_ENTRIES:
+                    entries = merge(entries, pending)
+                    pending, pending_entries = list(), len(entries[3])
+
+        from scipy import sparse
+
+        sample_rows, genome_rows, reaction_columns, values = merge(entries, pending)
+        array = sparse.csr_matrix((values, (sample_rows * len(genomes) + genome_rows, reaction_columns)),
+                                  shape=(len(samples) * len(genomes), reaction_count))
+
+        return TpmMatrix(array, [sample.decode() for sample in samples], [genome.decode() for genome in genomes], reaction_ids)
@@ -19,6 +19,7 @@ import logging
 import os
 import statistics
 import itertools
+import numpy as np
 from enrichm.network_builder import NetworkBuilder
 from enrichm.databases import Databases
 from enrichm.parser import Parser
@@ -111,70 +112,68 @@ class NetworkAnalyser:
 
         return normalised_abundance_dict
 
-    def average_tpm_by_sample(self, tpm_results, sample_metadata):
-        output_dict = dict()
-        tpm_dict, annotations, genomes = tpm_results
-
-        for group, samples in sample_metadata.items():
-            output_dict[group] = dict()
-
-            for sample in samples:
-
-                for annotation in annotations:
-
-                    if str.encode(sample) in tpm_dict:
-
-                        for genome in genomes:
-
-                            if genome not in output_dict[group]:
-                                output_dict[group][genome] = dict()
-
-                            if annotation not in output_dict[group][genome]:
-                                output_dict[group][genome][annotation] = list()
-
-                            if genome in tpm_dict[str.encode(sample)]:
+    def average_tpm_by_sample(self, tpm_matrix, sample_metadata):
+        '''
+        Average the expression of each reaction within each genome across the
+        samples of each group.
 
-                                if annotation in tpm_dict[str.encode(sample)][genome]:
-                                    output_dict[group][genome][annotation].append(tpm_dict[str.encode(sample)][genome][annotation])
-                                else:
-                                    output_dict[group][genome][annotation].append(0.0)
+        Parameters
+        ----------
+        tpm_matrix      - TpmMatrix. Returned by Parser.parse_tpm_values
+        sample_metadata - Dict. Sample group to the samples in it
 
-                            else:
-                                output_dict[group][genome][annotation].append(0.0)
+        Output
+        ------
+        A dictionary of sample group to a sparse matrix of genomes by
+        reactions (see TpmMatrix), or None if none of its samples were found
+        '''
+        output_dict = dict()
 
-            for genome, values in output_dict[group].items():
+        for group, samples in sample_metadata.items():
+            samples = [sample for sample in samples if sample in tpm_matrix.sample_index]
 
-                for annotation in values:
-                    output_dict[group][genome][annotation] = sum(output_dict[group][genome][annotation])/len(output_dict[group][genome][annotation])
+            if samples:
+                output_dict[group] = sum(tpm_matrix.sample(sample) for sample in samples) / len(samples)
+            else:
+                output_dict[group] = None
 
         return output_dict
 
-    def average_tpm_values(self, transriptome_abundance_dict, group_metadata):
+    def average_tpm_values(self, transriptome_abundance_dict, group_metadata, tpm_matrix):
+        '''
+        Average the expression of each reaction across the genomes of each
+        group, for each sample group.
+
+        Parameters
+        ----------
+        transriptome_abundance_dict - Dict. Returned by average_tpm_by_sample
+        group_metadata              - Dict. Genome group to the genomes in it
+        tpm_matrix                  - TpmMatrix. The matrix that was averaged
+
+        Output
+        ------
+        A dictionary of sample group to genome group to reaction to average
+        expression
+        '''
         output_dict = dict()
         reactions = list(self.reactions.keys())
-        
-        for genome_group_name, group_reaction_abundance_dict in transriptome_abundance_dict.items():
+        # Columns of the reactions in the TPM matrix, -1 for those not expressed
+        columns = np.array([tpm_matrix.reaction_index.get(reaction, -1) for reaction in reactions], dtype=np.int64)
+        expressed = columns >= 0
+
+        for genome_group_name, group_averages in transriptome_abundance_dict.items():
             output_dict[genome_group_name] = dict()
 
             for group, members in group_metadata.items():
-                output_dict[genome_group_name][group] = dict()
-
-                for reaction in reactions:
-                    to_average = list()
+                values = np.zeros(len(reactions))
 
-                    for member in members:
-
-                        if member in group_reaction_abundance_dict:
-
-                            if str.encode(reaction) in group_reaction_abundance_dict[member]:
-                                to_average.append(group_reaction_abundance_dict[member][str.encode(reaction)])
-                            else:
-                                to_average.append(0.0)
-                        else:
-                            to_average.append(0.0)
+                if group_averages is not None:
+                    rows = [tpm_matrix.genome_index[member] for member in members if member in tpm_matrix.genome_index]
+                    # Genomes without any expression count as 0
+                    reaction_totals = np.asarray(group_averages[rows].sum(axis=0)).ravel()
+                    values[expressed] = reaction_totals[columns[expressed]] / len(members)
 
-                    average_value = sum(to_average) / len(to_average)
-                    output_dict[genome_group_name][group][reaction] = average_value
+                output_dict[genome_group_name][group] = dict(zip(reactions, values.tolist()))
 
         return output_dict
 
@@ -281,8 +280,9 @@ class NetworkAnalyser:
         if transcriptome_abundances_path:
             logging.info("Parsing detectM TPM abundances")
             transcriptome_metadata = Parser.parse_metadata_matrix(transcriptome_metadata_path)[2]
-            transcriptome_abundance_dict = self.average_tpm_by_sample(Parser.parse_tpm_values(transcriptome_abundances_path), transcriptome_metadata)
-            transcriptome_abundances = self.average_tpm_values(transcriptome_abundance_dict, group_to_genome)
+            tpm_matrix = Parser.parse_tpm_values(transcriptome_abundances_path)
+            transcriptome_abundance_dict = self.average_tpm_by_sample(tpm_matrix, transcriptome_metadata)
+            transcriptome_abundances = self.average_tpm_values(transcriptome_abundance_dict, group_to_genome, tpm_matrix)
         else:
             transcriptome_abundances = None
 
@@ -23,6 +23,7 @@ from itertools import product
 # Local
 from enrichm.databases import Databases
 from enrichm.parser import Parser
+from enrichm.profiler import Profiler
 ###############################################################################
 
 class NetworkBuilder:
@@ -305,6 +306,7 @@ class NetworkBuilder:
 
         return network_lines, node_metadata_lines
 
+    @Profiler.profile('NetworkBuilder.query_matrix')
     def query_matrix(self, queries, depth):
         '''
         Parameters
@@ -409,7 +411,8 @@ class NetworkBuilder:
                                   possible_reactions
                                   if reaction in self.reactions_to_compounds}
         else:
-            possible_reactions = self.reactions_to_compounds
+            # Copied as filtered reactions are removed below
+            possible_reactions = dict(self.reactions_to_compounds)
 
         for entry in filter:
 
@@ -18,8 +18,10 @@
 
 import os
 import pickle
-import multiprocessing as mp
-from enrichm.annotate import Annotate
+from enrichm.matrix import AnnotationMatrix, TpmMatrix
+from enrichm.gtdb import GtdbMatrix
+from enrichm.workers import WorkerPool
+from enrichm.toolbox import open_file
 
 ################################################################################
 
@@ -46,23 +48,42 @@ class Parser:
         return output_taxonomy_dictionary
 
     @staticmethod
-    def parse_simple_matrix(matrix):
-        with open(matrix) as matrix_io:
-            colnames = matrix_io.readline().strip().split('\t')[1:]
-            rownames = list()
-            output_dict = {colname:dict() for colname in colnames}
+    def parse_matrix(matrix):
+        '''
+        Parameters
+        ----------
+        matrix : String or AnnotationMatrix. Path to a matrix file (or its .npz
+                 sparse copy), or a matrix already in memory (e.g. returned by
+                 Annotate.annotate_pipeline)
 
-            for line in matrix_io:
-                sline = line.strip().split('\t')
-                rowname, content = sline[0], sline[1:]
+        Output
+        ------
+        An AnnotationMatrix, with the values in an array and maps of the row
+        and column names to their index.
+        '''
+        if isinstance(matrix, AnnotationMatrix):
+            return matrix
 
-                if rowname not in rownames:
-                    rownames.append(rowname)
+        return AnnotationMatrix.load(matrix)
+
+    @staticmethod
+    def parse_simple_matrix(matrix):
+        '''
+        Parameters
+        ----------
+        matrix : String or AnnotationMatrix. Path to a matrix file, or a matrix
+                 already in memory (e.g. returned by Annotate.annotate_pipeline)
 
-                for key, value in zip(colnames, content):
-                    output_dict[key][rowname] = float(value)
+        Output
+        ------
+        A dictionary of column to a dictionary of row to value, the column names
+        and the row names. The dictionaries of each column are read only views
+        of the matrix (see Parser.parse_matrix).
+        '''
+        matrix = Parser.parse_matrix(matrix)
 
-        return output_dict, colnames, rownames
+        # Callers add to the outer dictionary, so don't hand out the original
+        return dict(matrix.values), list(matrix.colnames), list(matrix.rownames)
 
     @staticmethod
     def parse_metadata_matrix(matrix_path):
@@ -75,7 +96,7 @@ class Parser:
         nr_values = set()
         attribute_dict = dict()
 
-        with open(matrix_path) as matrix_file_io:
+        with open_file(matrix_path) as matrix_file_io:
 
             for line in matrix_file_io:
                 rowname, entry = line.strip().split('\t')
@@ -97,7 +118,7 @@ class Parser:
     def parse_single_column_text_file(text_file):
         entries = set()
 
-        with open(text_file) as text_file_io:
+        with open_file(text_file) as text_file_io:
             for entry in text_file_io:
                 entries.add(entry.strip())
 
@@ -116,7 +137,13 @@ class Parser:
 
         '''
         columns = list(columns)
-        matrix_io = open(matrix)
+
+        # Only the selected columns are read from the columnar copy, if
+        # the database has been compiled
+        if GtdbMatrix.exists(matrix):
+            return GtdbMatrix.load_columns(columns, matrix)
+
+        matrix_io = open_file(matrix)
         header = matrix_io.readline().strip().split('\t')
 
         indexes = list()
@@ -142,48 +169,25 @@ class Parser:
                 if count > 0:
                     output_dict[column][annotation] = int(srow[index])
 
+        matrix_io.close()
+
         return output_dict, columns
 
     @staticmethod
     def parse_tpm_values(tpm_values):
-        from enrichm.databases import Databases
-        k2r = Databases().k2r()
-
-        output_dict = dict()
-        annotation_types = set()
-        genome_types = set()
-
-        tpm_values_io = open(tpm_values, 'rb')
-        tpm_values_io.readline()
-
-        for line in tpm_values_io:
-            gene, _, _, _, _, _, _, _, _, _, tpm, \
-            _, _, annotation, sample = line.strip().split(b'\t')
-            annotation_list = annotation.split(b',')
-            tpm = float(tpm)
-            genome = '_'.join(str(gene, "utf-8").split('_')[:2]) # temporary
-            genome_types.add(genome)
-
-            if sample not in output_dict:
-                output_dict[sample] = dict()
-
-            if genome not in output_dict[sample]:
-                output_dict[sample][genome] = dict()
-
-            for annotation_type in annotation_list:
-
-                if str(annotation_type, "utf-8") in k2r:
-                    reactions = k2r[str(annotation_type, "utf-8")]
-
-                    for reaction in reactions:
-                        reaction = str.encode(reaction)
+        '''
+        Parameters
+        ----------
+        tpm_values : String. Path to the TPM values of genes reported by detectM
 
-                        if reaction not in output_dict[sample][genome]:
-                            output_dict[sample][genome][reaction] = 0.0
-                            annotation_types.add(reaction)
+        Output
+        ------
+        A TpmMatrix of the expression of each reaction within each genome in
+        each sample.
+        '''
+        from enrichm.databases import Databases
 
-                        output_dict[sample][genome][reaction] += tpm
-        return output_dict, annotation_types, genome_types
+        return TpmMatrix.from_file(tpm_values, Databases().reaction_ids())
 
     @staticmethod
     def parse_enrichment_output(enrichment_output):
@@ -231,6 +235,9 @@ class Parser:
 class ParseAnnotate:
 
     def __init__(self, enrichm_annotate_output, processes):
+        # Imported here, so that parsing matrices doesn't load the annotate
+        # pipeline and everything it uses
+        from enrichm.annotate import Annotate
         self.path = enrichm_annotate_output
         # Parse genome objects
         self.genome_pickle_file_path \
@@ -294,7 +301,6 @@ class ParseAnnotate:
         List of Genome objects
         '''
 
-        output_genome_list = list()
         paths = list()
 
         for pickled_genome in genome_list:
@@ -302,11 +308,7 @@ class ParseAnnotate:
             if os.path.isfile(pickled_genome_path):
                 paths.append(pickled_genome_path)
 
-        self.pool = mp.Pool(processes=self.processes)
-        output_genome_list = self.pool.map_async(parse_genomes, paths)
-        output_genome_list.wait()
-        genome_objects = output_genome_list.get()
-        self.pool.close()
+        genome_objects = WorkerPool.map(parse_genomes, paths, self.processes)
 
         return genome_objects
 
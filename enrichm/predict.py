@@ -68,23 +68,14 @@ class Predict:
         logging.info('Loading model: %s' % (forester_model.rf_model))
 
         logging.info('Parsing data')
-        features, _, _ = Parser.parse_simple_matrix(input_matrix_path)
-
-        sample_list = list()
-        content_list = list()
-
-        for sample, content in features.items():
-            sample_list.append(sample)
-            sample_content = list()
-
-            for attribute in forester_model.attributes:
-
-                if attribute in content:
-                    sample_content.append(content[attribute])
-                else:
-                    sample_content.append('0')
-
-            content_list.append(sample_content)
+        matrix = Parser.parse_matrix(input_matrix_path)
+        sample_list = list(matrix.colnames)
+
+        # Attributes of the model missing from the matrix are 0
+        rows = [matrix.row_index.get(attribute) for attribute in forester_model.attributes]
+        found = [index for index, row in enumerate(rows) if row is not None]
+        content_list = np.zeros((len(sample_list), len(rows)))
+        content_list[:, found] = matrix.take([rows[index] for index in found])
 
         logging.info('Making predictions')
         output_lines = self.make_predictions(forester_model.model,
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Collect wall time, CPU time and memory usage for the stages of a pipeline.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import json
+import time
+import logging
+import resource
+import functools
+import threading
+from contextlib import contextmanager
+###############################################################################
+
+class Profiler:
+    '''
+    Aggregates the resource usage of named stages across a run. Profiling is
+    switched on with Profiler.start(), until then stages cost a single check.
+    Stages that are entered more than once (e.g. Genome.add, once per genome)
+    are summed, and the number of calls is reported.
+
+    CPU time and child process usage are process-wide, so stages that run
+    concurrently in different threads will each include the other's usage.
+    '''
+    enabled = False
+    records = dict()
+    start_snapshot = None
+    lock = threading.Lock()
+
+    CALLS = 'calls'
+    WALL_TIME = 'wall_time'
+    CPU_TIME = 'cpu_time'
+    PEAK_RSS = 'peak_rss_kb'
+    CHILD_USER_TIME = 'children_user_time'
+    CHILD_SYSTEM_TIME = 'children_system_time'
+    CHILD_PEAK_RSS = 'children_peak_rss_kb'
+
+    @staticmethod
+    def _snapshot():
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        return (time.perf_counter(), time.process_time(), self_usage.ru_maxrss,
+                child_usage.ru_utime, child_usage.ru_stime, child_usage.ru_maxrss)
+
+    @classmethod
+    def start(cls):
+        '''
+        Switch on profiling, discarding anything recorded previously.
+        '''
+        with cls.lock:
+            cls.enabled = True
+            cls.records = dict()
+            cls.start_snapshot = cls._snapshot()
+
+    @classmethod
+    def stop(cls):
+        '''
+        Switch off profiling.
+        '''
+        with cls.lock:
+            cls.enabled = False
+
+    @classmethod
+    def _record(cls, name, start, end):
+        with cls.lock:
+
+            if name not in cls.records:
+                cls.records[name] = {cls.CALLS:0, cls.WALL_TIME:0.0, cls.CPU_TIME:0.0,
+                                     cls.PEAK_RSS:0, cls.CHILD_USER_TIME:0.0,
+                                     cls.CHILD_SYSTEM_TIME:0.0, cls.CHILD_PEAK_RSS:0}
+            record = cls.records[name]
+            record[cls.CALLS] += 1
+            record[cls.WALL_TIME] += end[0] - start[0]
+            record[cls.CPU_TIME] += end[1] - start[1]
+            # ru_maxrss is a high water mark rather than a counter
+            record[cls.PEAK_RSS] = max(record[cls.PEAK_RSS], end[2])
+            record[cls.CHILD_USER_TIME] += end[3] - start[3]
+            record[cls.CHILD_SYSTEM_TIME] += end[4] - start[4]
+            record[cls.CHILD_PEAK_RSS] = max(record[cls.CHILD_PEAK_RSS], end[5])
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name):
+        '''
+        Context manager recording the resource usage of the enclosed block.
+
+        Parameters
+        ----------
+        name    - String. Name of the stage to record the usage against
+        '''
+        if not cls.enabled:
+            yield
+            return
+
+        start = cls._snapshot()
+
+        try:
+            yield
+        finally:
+            cls._record(name, start, cls._snapshot())
+
+    @classmethod
+    def profile(cls, name):
+        '''
+        Decorator recording the resource usage of every call to a function.
+
+        Parameters
+        ----------
+        name    - String. Name of the stage to record the usage against
+        '''
+        def decorator(function):
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+
+                if not cls.enabled:
+                    return function(*args, **kwargs)
+
+                with cls.stage(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @classmethod
+    def report(cls):
+        '''
+        Output
+        ------
+        A dictionary of the totals for the run, and the usage of each stage
+        '''
+        with cls.lock:
+            stages = {name:dict(record) for name, record in cls.records.items()}
+
+        end = cls._snapshot()
+        start = cls.start_snapshot or end
+        total = {cls.WALL_TIME:end[0] - start[0],
+                 cls.CPU_TIME:end[1] - start[1],
+                 cls.PEAK_RSS:end[2],
+                 cls.CHILD_USER_TIME:end[3] - start[3],
+                 cls.CHILD_SYSTEM_TIME:end[4] - start[4],
+                 cls.CHILD_PEAK_RSS:end[5]}
+
+        return {'total':total, 'stages':stages}
+
+    @classmethod
+    def write(cls, output_path, command=None):
+        '''
+        Write the profile of the run to a JSON file.
+
+        Parameters
+        ----------
+        output_path - String. Path to write the report to
+        command     - List. The command line of the run
+        '''
+        report = cls.report()
+
+        if command:
+            report['command'] = ' '.join(command)
+
+        logging.info('Writing performance profile to file: %s', output_path)
+
+        with open(output_path, 'w') as out_io:
+            json.dump(report, out_io, indent=1, sort_keys=True)
@@ -20,19 +20,25 @@ import sys
 import os
 import shutil
 import time
+import importlib
 from enrichm.data import Data
-from enrichm.network_analyzer import NetworkAnalyser
-from enrichm.enrichment import Enrichment
-from enrichm.annotate import Annotate
-from enrichm.classifier import Classify
-from enrichm.generate import GenerateModel
-from enrichm.predict import Predict
-from enrichm.uses import Uses
+from enrichm.dependencies import Dependencies
+from enrichm.events import EventHandler
+from enrichm.profiler import Profiler
 
 ####################################################################################################
 
 debug = {1:logging.CRITICAL, 2:logging.ERROR, 3:logging.WARNING, 4:logging.INFO, 5:logging.DEBUG}
 
+# Recorded as early as possible so that --profile_imports can report the time
+# taken to get from interpreter startup to dispatching a pipeline.
+START_TIME = time.time()
+
+# Third party packages that are expensive to import. Reported by
+# --profile_imports so that we notice if a lightweight subcommand starts
+# pulling them in.
+HEAVY_MODULES = ['numpy', 'scipy', 'statsmodels', 'sklearn', 'pandas']
+
 ####################################################################################################
 
 class Run:
@@ -46,6 +52,18 @@ class Run:
         self.PREDICT         = 'predict'
         self.GENERATE        = 'generate'
         self.USES            = 'uses'
+        self.PATHWAY         = 'pathway'
+        self.EXPLORE         = 'explore'
+        self.SERVE           = 'serve'
+        # Subcommands that don't write to an output directory
+        self.NO_OUTPUT       = [self.DATA, self.SERVE]
+
+        self.IMPORT_PROFILE  = 'import_profile.tsv'
+        self.PROFILE         = 'profile.json'
+        self.import_times    = list()
+        self.dispatch_time   = None
+        self.dispatch_heavy  = None
+        self.dependencies    = dict()
 
     def _logging_setup(self, args):
         if args.verbosity not in range(1, 6):
@@ -61,42 +79,75 @@ class Run:
         stream_logger.setLevel(debug[args.verbosity])
         logger.addHandler(stream_logger)
 
-        if args.subparser_name!=self.DATA:
+        if args.subparser_name not in self.NO_OUTPUT:
             file_logger = logging.FileHandler(os.path.join(args.output, args.log), 'a')
             file_logger.setFormatter(log_format)
+            file_logger.setLevel(debug[args.verbosity])
             logger.addHandler(file_logger)
 
-    def _check_general(self, args):
+        if args.events:
+            # Events are written whatever the verbosity, so every record is
+            # passed on to the handlers, which filter by their own level
+            logger.setLevel(logging.DEBUG)
+            logger.addHandler(EventHandler(args.events))
+
+    def _required_dependencies(self, args):
         '''
-        Check general input and output options are valid.
+        Work out which external tools are needed to run a subcommand. For
+        annotate this depends on the input type and annotations requested.
 
         Parameters
         ----------
         args    - object. Argparse object
+
+        Output
+        ------
+        A set of the names of the external tools required
         '''
-        dependencies = {'hmmsearch':"http://hmmer.org/download.html",
-                        'diamond':"https://github.com/bbuchfink/diamond",
-                        'R':"https://www.r-project.org",
-                        'parallel':"https://www.gnu.org/software/parallel",
-                        'prodigal':"https://github.com/hyattpd/Prodigal/wiki/installation",
-                        'mmseqs':"https://github.com/soedinglab/MMseqs2"}
+        dependencies = set()
+
+        if args.subparser_name == self.ANNOTATE:
 
-        missing_dependencies = list()
+            if(args.genome_files or args.genome_directory):
+                dependencies.update(['prodigal', 'parallel'])
 
-        for dependency in dependencies.keys():
+            if(args.ko or args.ec):
+                dependencies.add('diamond')
 
-            if shutil.which(dependency) == None:
-                missing_dependencies.append(dependency)
+            if(args.ko_hmm or args.pfam or args.tigrfam or args.cazy):
+                dependencies.update(['hmmsearch', 'parallel'])
 
-        if len(missing_dependencies)>0:
-            dependency_string = '\n'.join(['\t%s\t%s' % (d, dependencies[d]) for d in missing_dependencies])
-            raise Exception('The following dependencies need to be installed to run enrichm:\n%s' % (dependency_string))
+            if(args.clusters or args.orthologs):
+                dependencies.update(['mmseqs', 'sponge', 'mcl', 'mcxload', 'mcxdump'])
 
-        if args.subparser_name != self.DATA:
+        elif args.subparser_name == self.ENRICHMENT:
+            dependencies.add('Rscript')
+
+        return dependencies
+
+    def _check_general(self, args):
+        '''
+        Check general input and output options are valid.
+
+        Parameters
+        ----------
+        args    - object. Argparse object
+        '''
+        self.dependencies = Dependencies().check(self._required_dependencies(args))
+
+        if args.subparser_name not in self.NO_OUTPUT:
             # Set up working directory
             if not args.output:
                 args.output = '%s-enrichm_%s_output' % (time.strftime("%Y-%m-%d_%H-%M"), args.subparser_name)
 
+            resume = getattr(args, 'resume', False)
+
+            if(resume and args.force):
+                raise Exception("Only one of --resume and --force can be specified.")
+
+            if(resume and os.path.isdir(args.output)):
+                return
+
             if(os.path.isdir(args.output) or os.path.isfile(args.output)):
 
                 if args.force:
@@ -135,6 +186,9 @@ class Run:
             elif(args.protein_directory or args.protein_files):
                 args.suffix = '.faa'
 
+        if(args.cpus is not None and args.cpus<1):
+            raise Exception("Number of CPUs (--cpus) must be a positive integer.")
+
         if(args.id>1 or args.id<0):
             raise Exception("Identity (--id) must be between 0 and 1.")
 
@@ -221,11 +275,11 @@ class Run:
             if not (args.tpm_values and args.tpm_metadata):
                 raise Exception("Both --tpm_values and --tpm_metadata need to be specified")
 
-        if args.subparser_name == NetworkAnalyser.PATHWAY:
+        if args.subparser_name == self.PATHWAY:
             args.depth = None
             args.queries = None
 
-        if args.subparser_name == NetworkAnalyser.EXPLORE:
+        if args.subparser_name == self.EXPLORE:
             args.filter = None
             args.limit = None
 
@@ -264,6 +318,68 @@ class Run:
         '''
         pass
 
+    def _load(self, module_name, class_name):
+        '''
+        Import a pipeline class only once its subcommand has been dispatched.
+        Importing every pipeline up front pulls in scipy, statsmodels and
+        sklearn, which dominates the runtime of small jobs.
+
+        Parameters
+        ----------
+        module_name - string. Name of the enrichm module to import
+        class_name  - string. Name of the class to return from that module
+
+        Output
+        ------
+        The requested class
+        '''
+        modules_before = len(sys.modules)
+        start = time.time()
+        module = importlib.import_module(module_name)
+        elapsed = time.time() - start
+        self.import_times.append([module_name, round(elapsed, 4),
+                                  len(sys.modules) - modules_before])
+        self.dispatch_time = time.time()
+        # Packages loaded later, by the pipeline itself, are only loaded when
+        # they are used and so don't count against startup
+        self.dispatch_heavy = [heavy for heavy in HEAVY_MODULES if heavy in sys.modules]
+
+        return getattr(module, class_name)
+
+    def _profile_imports(self, args):
+        '''
+        Report how long it took to import the modules needed by this
+        subcommand, and which expensive third party packages were loaded.
+
+        Parameters
+        ----------
+        args    - object. Argparse object
+        '''
+        startup = round((self.dispatch_time or time.time()) - START_TIME, 4)
+        if self.dispatch_heavy is not None:
+            heavy_modules = self.dispatch_heavy
+        else:
+            heavy_modules = [module for module in HEAVY_MODULES if module in sys.modules]
+
+        logging.info("Import profile for the %s subcommand:" % args.subparser_name)
+        logging.info("    - Time from startup to dispatch: %ss" % startup)
+
+        for module_name, elapsed, new_modules in self.import_times:
+            logging.info("    - %s imported in %ss (%i new modules)" % (module_name, elapsed, new_modules))
+
+        logging.info("    - Modules loaded: %i" % len(sys.modules))
+        logging.info("    - Heavy packages loaded by dispatch: %s" % (', '.join(heavy_modules) if heavy_modules else 'none'))
+
+        if args.subparser_name not in self.NO_OUTPUT:
+            # Imported here, after the imports have been measured, as the
+            # writer module loads numpy
+            from enrichm.writer import Writer
+            output_lines = [['Module', 'Seconds', 'New_modules']]
+            output_lines += self.import_times
+            output_lines.append(['startup_to_dispatch', startup, len(sys.modules)])
+            output_lines.append(['heavy_packages', ','.join(heavy_modules), len(heavy_modules)])
+            Writer.write(output_lines, os.path.join(args.output, self.IMPORT_PROFILE))
+
     def run_enrichm(self, args, command):
         '''
         Parameters
@@ -275,15 +391,57 @@ class Run:
         self._check_general(args)
         self._logging_setup(args)
 
+        for tool, entry in sorted(self.dependencies.items()):
+            logging.debug("Using %s (%s): %s" % (tool, entry['version'], entry['path']))
+
         logging.info("Command: %s" % ' '.join(command))
         logging.info("Running the %s pipeline" % args.subparser_name)
 
+        if args.profile:
+            Profiler.start()
+
         if args.subparser_name == self.DATA:
-            d = Data()
-            d.do(args.uninstall, args.dry)
+
+            if args.build:
+                DatabaseBuilder = self._load('enrichm.builder', 'DatabaseBuilder')
+                builder = DatabaseBuilder(args.build, Data.DATABASE_DIR, args.build_version, args.cpus)
+                builder.build()
+
+            if args.compile:
+                Databases = self._load('enrichm.databases', 'Databases')
+                DatabaseStore = self._load('enrichm.store', 'DatabaseStore')
+                databases = Databases()
+                logging.info("Compiling database %s" % databases.DB_VERSION)
+                databases.write_derived()
+                databases.write_reaction_ids()
+                databases.parsed_modules()
+                GtdbMatrix = self._load('enrichm.gtdb', 'GtdbMatrix')
+
+                for gtdb_matrix in [databases.GTDB_KO, databases.GTDB_PFAM, databases.GTDB_TIGRFAM,
+                                    databases.GTDB_CAZY, databases.GTDB_EC]:
+
+                    if os.path.isfile(gtdb_matrix):
+                        GtdbMatrix.convert(gtdb_matrix)
+                DatabaseStore.compile(databases.CUR_DATABASE_DIR, databases.PICKLE_VERSION)
+                IdCatalog = self._load('enrichm.ids', 'IdCatalog')
+
+                for id_file in IdCatalog.ID_FILES:
+
+                    if os.path.isfile(os.path.join(databases.IDS_DIR, id_file)):
+                        IdCatalog.build(databases.IDS_DIR, id_file)
+
+            if not (args.build or args.compile):
+                d = Data()
+                d.do(args.uninstall, args.dry)
+
+        elif args.subparser_name == self.SERVE:
+            Server = self._load('enrichm.server', 'Server')
+            server = Server(args.socket)
+            server.serve()
 
         if args.subparser_name == self.ANNOTATE:
             self._check_annotate(args)
+            Annotate = self._load('enrichm.annotate', 'Annotate')
             annotate = Annotate(# Define inputs and outputs
                                 args.output,
                                 # Define type of annotation to be carried out
@@ -297,7 +455,8 @@ class Run:
                                 args.inflation, args.chunk_number, args.chunk_max,
                                 args.count_domains,
                                 # Parameters
-                                args.threads, args.parallel, args.suffix, args.light)
+                                args.threads, args.parallel, args.suffix, args.light,
+                                args.resume, args.cpus)
 
             annotate.annotate_pipeline(args.genome_directory,
                                        args.protein_directory,
@@ -306,12 +465,14 @@ class Run:
 
         elif args.subparser_name == self.CLASSIFY:
             self._check_classify(args)
+            Classify = self._load('enrichm.classifier', 'Classify')
             classify = Classify()
             classify.classify_pipeline(args.custom_modules, args.cutoff, args.aggregate,
                                        args.genome_and_annotation_matrix, args.output)
 
         elif args.subparser_name == self.ENRICHMENT:
             self._check_enrichment(args)
+            Enrichment = self._load('enrichm.enrichment', 'Enrichment')
             enrichment = Enrichment()
             enrichment.enrichment_pipeline(# Input options
                                            args.annotate_output, args.annotation_matrix,
@@ -327,9 +488,10 @@ class Run:
                                            # Outputs
                                            args.output)
 
-        elif(args.subparser_name == NetworkAnalyser.PATHWAY or
-             args.subparser_name == NetworkAnalyser.EXPLORE):
+        elif(args.subparser_name == self.PATHWAY or
+             args.subparser_name == self.EXPLORE):
             self._check_network(args)
+            NetworkAnalyser = self._load('enrichm.network_analyzer', 'NetworkAnalyser')
             network_analyser=NetworkAnalyser()
             network_analyser.network_pipeline(args.subparser_name, args.matrix, 
                                               args.genome_metadata, args.tpm_values,
@@ -340,6 +502,7 @@ class Run:
 
         if args.subparser_name == self.PREDICT:
             self._check_predict(args)
+            Predict = self._load('enrichm.predict', 'Predict')
             predict = Predict()
             predict.predict_pipeline(args.forester_model_directory,
                  args.input_matrix,
@@ -347,6 +510,7 @@ class Run:
 
         elif args.subparser_name == self.GENERATE:
             self._check_generate(args)
+            GenerateModel = self._load('enrichm.generate', 'GenerateModel')
             generate_model = GenerateModel()
             generate_model.generate_pipeline(args.input_matrix,
                   args.groups,
@@ -358,6 +522,7 @@ class Run:
 
         elif args.subparser_name == self.USES:
             self._check_uses(args)
+            Uses = self._load('enrichm.uses', 'Uses')
             uses = Uses()
             uses.uses_pipeline(args.compounds_list,
                     args.annotation_matrix,
@@ -365,4 +530,10 @@ class Run:
                     args.output,
                     args.count)
 
+        if args.profile_imports:
+            self._profile_imports(args)
+
+        if(args.profile and args.subparser_name not in self.NO_OUTPUT):
+            Profiler.write(os.path.join(args.output, self.PROFILE), command)
+
         logging.info('Finished running EnrichM')
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Run interdependent stages concurrently within a CPU budget.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+###############################################################################
+
+# The most threads worth giving a single job of each tool. Tools missing from
+# here scale well enough to be given the whole budget.
+TOOL_MAX_THREADS = {'prodigal':1,
+                    'hmmsearch':4}
+
+def plan_cpus(cpus, task_count, tool):
+    '''
+    Split a CPU budget between concurrent jobs and threads per job. Jobs are
+    preferred over threads for tools that scale poorly with threads, and
+    there are never more jobs than tasks.
+
+    Parameters
+    ----------
+    cpus        - Integer. Number of CPUs available
+    task_count  - Integer. Number of independent tasks (e.g. genomes) to run
+    tool        - String. Name of the tool being run
+
+    Output
+    ------
+    The number of concurrent jobs, and the number of threads for each job
+    '''
+    cpus = max(1, int(cpus))
+
+    if tool not in TOOL_MAX_THREADS or task_count <= 1:
+        return 1, min(cpus, TOOL_MAX_THREADS.get(tool, cpus))
+
+    max_threads = TOOL_MAX_THREADS[tool]
+
+    jobs = min(task_count, cpus)
+    threads = max(1, min(max_threads, cpus // jobs))
+
+    return jobs, threads
+
+class Threads:
+    '''
+    The threads of a task that can't change once it has started, e.g. a
+    single DIAMOND search. Passed as the resize function of a Scheduler task,
+    it takes the first offer, up to the threads planned, and declines the rest.
+    '''
+
+    def __init__(self, threads):
+        self.planned = max(1, int(threads))
+        self.threads = None
+
+    def resize(self, cpus):
+        if self.threads is None:
+            self.threads = max(1, min(self.planned, cpus))
+
+        return self.threads
+
+class ParallelJobs:
+    '''
+    The number of concurrent jobs of a task run through GNU parallel, each
+    with a fixed number of threads. The number is written to a file passed to
+    parallel with -j, which parallel reads again whenever a job finishes, so
+    the task takes on more jobs as CPUs are freed by other tasks. Passed as
+    the resize function of a Scheduler task.
+    '''
+
+    def __init__(self, path, jobs, threads):
+        self.path = path
+        self.planned = max(1, int(jobs))
+        self.threads = max(1, int(threads))
+        self.jobs = None
+
+    def resize(self, cpus):
+        jobs = max(1, min(self.planned, cpus // self.threads))
+
+        if jobs != self.jobs:
+            # parallel may read the file at any time, so it is replaced whole
+            temporary_path = self.path + '.tmp'
+
+            with open(temporary_path, 'w') as out_io:
+                out_io.write('%i\n' % jobs)
+
+            os.replace(temporary_path, self.path)
+            self.jobs = jobs
+
+        return self.jobs * self.threads
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+class Task:
+    '''
+    A stage to be run by the Scheduler.
+    '''
+
+    def __init__(self, name, function, args, cpus, depends, max_cpus, resize):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.cpus = cpus
+        self.max_cpus = max(cpus, max_cpus)
+        self.resize = resize
+        self.depends = set(depends)
+        # CPUs given to the task while it runs
+        self.allotted = 0
+
+    def offer(self, cpus):
+        '''
+        Offer CPUs to the task, returning the number it takes.
+        '''
+        cpus = min(cpus, self.max_cpus)
+
+        if self.resize is not None:
+            cpus = self.resize(cpus)
+
+        return cpus
+
+class Scheduler:
+    '''
+    A small DAG scheduler. Each task declares the CPUs it needs, the most it
+    can use, and the tasks it depends on. Tasks are started in the order they
+    were added as soon as their dependencies have finished and the CPUs they
+    need are free, and tasks that are ready together share the free CPUs.
+    CPUs freed by finished tasks that no waiting task can start with are
+    offered to the running tasks. The work done by the tasks is expected to
+    be in external processes, so tasks are run in threads.
+    '''
+
+    def __init__(self, cpus):
+        self.cpus = max(1, int(cpus))
+        self.tasks = list()
+
+    def add(self, name, function, args=(), cpus=1, depends=(), max_cpus=None, resize=None):
+        '''
+        Add a task to be run.
+
+        Parameters
+        ----------
+        name        - String. Name of the task
+        function    - Function. Called with args when the task is run
+        args        - Iterable. Arguments to pass to function
+        cpus        - Integer. Number of CPUs the task needs to start
+        depends     - Iterable. Names of tasks which must finish first. Names of
+                      tasks that have not been added are ignored.
+        max_cpus    - Integer. Most CPUs the task can use (default: cpus)
+        resize      - Function. Called with the number of CPUs offered to the
+                      task, before it starts and whenever more are free while
+                      it runs, and returns the number it takes (see Threads
+                      and ParallelJobs). Without it, the task is given CPUs
+                      only when it starts.
+        '''
+        # A task bigger than the whole budget is run on its own
+        cpus = min(max(1, int(cpus)), self.cpus)
+        max_cpus = min(max(cpus, int(max_cpus or cpus)), self.cpus)
+        self.tasks.append(Task(name, function, args, cpus, depends, max_cpus, resize))
+
+    def run(self):
+        '''
+        Run all tasks. If a task fails, no further tasks are started, and the
+        exception is raised once the running tasks have finished.
+
+        Output
+        ------
+        A dictionary of task name to the value returned by the task
+        '''
+        names = set(task.name for task in self.tasks)
+        pending = list(self.tasks)
+        running = dict()
+        finished = set()
+        results = dict()
+        free_cpus = self.cpus
+        error = None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as executor:
+
+            while pending or running:
+
+                if error is None:
+                    ready = [task for task in pending
+                             if all(depend in finished for depend in task.depends if depend in names)]
+
+                    for index, task in enumerate(ready):
+
+                        if task.cpus <= free_cpus:
+                            # An equal share of what is free with the tasks
+                            # still to start, the rest is offered as it runs
+                            share = max(task.cpus, free_cpus // (len(ready) - index))
+                            task.allotted = task.offer(share)
+                            logging.debug("Starting stage %s with %i cpus (%i free)" % (task.name, task.allotted, free_cpus))
+                            free_cpus -= task.allotted
+                            pending.remove(task)
+                            running[executor.submit(task.function, *task.args)] = task
+
+                    # Running tasks keep what they are given until they
+                    # finish, so enough is held back to start any waiting task
+                    spare_cpus = free_cpus - max([task.cpus for task in pending], default=0)
+
+                    for task in running.values():
+
+                        if spare_cpus > 0 and task.resize is not None and task.allotted < task.max_cpus:
+                            allotted = max(task.allotted, task.offer(task.allotted + spare_cpus))
+
+                            if allotted > task.allotted:
+                                logging.debug("Giving stage %s %i more cpus" % (task.name, allotted - task.allotted))
+                                free_cpus -= allotted - task.allotted
+                                spare_cpus -= allotted - task.allotted
+                                task.allotted = allotted
+
+                if not running:
+
+                    if error is not None:
+                        break
+
+                    raise Exception("Unable to schedule stages: %s" % ', '.join(task.name for task in pending))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    task = running.pop(future)
+                    free_cpus += task.allotted
+
+                    try:
+                        results[task.name] = future.result()
+                        finished.add(task.name)
+                    except Exception as task_error:
+                        logging.error("Stage %s failed" % task.name)
+
+                        if error is None:
+                            error = task_error
+
+        if error is not None:
+            raise error
+
+        return results
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from enrichm.toolbox import open_file
+
 class Sequence:
     def __init__(self, name, seq):
         self.name = name
@@ -8,6 +10,14 @@ class Sequence:
 class SequenceIO:
     # Stolen from https://github.com/lh3/readfq/blob/master/readfq.py
     def each(self, fp): # this is a generator function
+        '''
+        fp may be a file object, or the path to a file, which may be
+        compressed (see toolbox.open_file)
+        '''
+        if isinstance(fp, str):
+            with open_file(fp) as fp_io:
+                yield from self.each(fp_io)
+            return
 
         last = None # this is a buffer keeping the last unprocessed line
         while True: # mimic closure; is it a bad idea?
@@ -46,12 +56,12 @@ class SequenceIO:
 
     def read_fasta_file(self, path_to_fasta_file):
         seqs = []
-        for name, seq, _ in self.each(open(path_to_fasta_file)):
+        for name, seq, _ in self.each(path_to_fasta_file):
             seqs.append(Sequence(name, seq))
         return seqs
 
     def write_fasta_file(self, sequence_objects, path_to_fasta_file):
-        with open(path_to_fasta_file,'w') as f:
+        with open_file(path_to_fasta_file,'w') as f:
             self.write_fasta(sequence_objects, f)
 
     def write_fasta(self, sequence_objects, io):
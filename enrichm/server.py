@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+Run EnrichM jobs in a long running process that keeps the reference data
+loaded and the worker pool running between jobs.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+# Local
+from enrichm.databases import Databases
+from enrichm.profiler import Profiler
+###############################################################################
+
+def default_socket_path():
+    '''
+    The socket used by enrichm serve and enrichm submit unless another is
+    given. One per user, so that jobs are never run on someone else's server.
+    '''
+    return os.path.join(tempfile.gettempdir(), 'enrichm-%i.sock' % os.getuid())
+
+class ClientStream:
+    '''
+    A file-like object that sends everything written to it to the client,
+    one line at a time. Used in place of stdout while a job runs, so the
+    client sees the job's log as if it had been run locally.
+    '''
+
+    def __init__(self, connection_io):
+        self.connection_io = connection_io
+        self.buffer = str()
+
+    def write(self, text):
+        self.buffer += text
+
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            send(self.connection_io, {'output':line})
+
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            send(self.connection_io, {'output':self.buffer})
+            self.buffer = str()
+
+def send(connection_io, message):
+    '''
+    Send a message as a single line of JSON.
+
+    Parameters
+    ----------
+    connection_io   - File. Writable file object of the socket
+    message         - Dict. Message to send
+    '''
+    connection_io.write(json.dumps(message) + '\n')
+    connection_io.flush()
+
+class Server:
+    '''
+    Accept jobs over a UNIX socket and run them one at a time in this
+    process, using the same code path as the command line. Databases share
+    the pickles they load (see DatabaseCache), so the reference data is
+    loaded once when the server starts rather than by every job. The worker
+    pool is created by the first job that needs it and reused by the rest.
+    '''
+    JOBS = ['classify', 'enrichment', 'uses', 'pathway', 'explore']
+    # Reference data used by the jobs above, loaded when the server starts
+    PRELOAD = ['m2def', 'm', 'k', 'r', 'c', 'p', 'r2k', 'r2c', 'r2m', 'm2r', 'r2p', 'p2r', 'c2r',
+               'm2c', 'k2r', 'k2m', 'c2m', 'compound_desc_dict', 'pfam2name', 'pfam2description', 'pfam2clan',
+               'clan2name', 'tigrfamdescription', 'ec2description', 'reaction_ids']
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path or default_socket_path()
+
+    def preload(self):
+        '''
+        Load the reference data into the shared cache.
+        '''
+        databases = Databases()
+
+        for name in self.PRELOAD:
+
+            try:
+                getattr(databases, name)()
+
+            except FileNotFoundError:
+                logging.warning("Unable to preload %s: not found in the database" % name)
+
+        logging.info("Loaded %i reference files from database %s" % (len(Databases.cache), databases.DB_VERSION))
+
+    def serve(self):
+        '''
+        Listen for jobs until interrupted.
+        '''
+        if os.path.exists(self.socket_path):
+
+            if Client(self.socket_path).alive():
+                raise Exception("An EnrichM server is already listening on %s" % self.socket_path)
+
+            os.remove(self.socket_path)
+
+        self.preload()
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        previous_umask = os.umask(0o077)
+
+        try:
+            server_socket.bind(self.socket_path)
+        finally:
+            os.umask(previous_umask)
+
+        server_socket.listen()
+        logging.info("Listening for jobs on %s" % self.socket_path)
+
+        try:
+
+            while True:
+                connection, _ = server_socket.accept()
+
+                with connection, connection.makefile('rw') as connection_io:
+                    self.handle(connection_io)
+
+        except KeyboardInterrupt:
+            logging.info("Stopping server")
+
+        finally:
+            server_socket.close()
+
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def handle(self, connection_io):
+        '''
+        Read a request from a client, and run it.
+
+        Parameters
+        ----------
+        connection_io   - File. File object of the client's connection
+        '''
+        try:
+            request = json.loads(connection_io.readline())
+
+        except ValueError:
+            logging.warning("Ignoring malformed request")
+            return
+
+        if request.get('ping'):
+            send(connection_io, {'status':0})
+            return
+
+        args = argparse.Namespace(**request['args'])
+
+        if args.subparser_name not in self.JOBS:
+            send(connection_io, {'status':1, 'error':"The %s subcommand can't be run by the server. Jobs can be one of: %s"
+                                 % (args.subparser_name, ', '.join(self.JOBS))})
+            return
+
+        logging.info("Running %s job from %s" % (args.subparser_name, request['cwd']))
+
+        try:
+            status = self.run_job(args, request['command'], request['cwd'], connection_io)
+
+        except (BrokenPipeError, ConnectionResetError):
+            logging.warning("Client disconnected before the job finished")
+
+        else:
+            send(connection_io, status)
+
+    def run_job(self, args, command, cwd, connection_io):
+        '''
+        Run a job as enrichm would from the command line, sending its output
+        to the client. Logging, the working directory and profiling are put
+        back as they were once the job is finished, whether it succeeded or
+        not.
+
+        Parameters
+        ----------
+        args            - Namespace. Arguments of the job, as parsed by the client
+        command         - List. The command as typed by the user
+        cwd             - String. Working directory of the client
+        connection_io   - File. File object of the client's connection
+
+        Output
+        ------
+        A dictionary with the exit status of the job, and the error if it failed
+        '''
+        from enrichm.run import Run
+
+        logger = logging.getLogger('')
+        handlers = list(logger.handlers)
+        level = logger.level
+        server_cwd = os.getcwd()
+        client_stream = ClientStream(connection_io)
+
+        try:
+            os.chdir(cwd)
+
+            with redirect_stdout(client_stream):
+                Run().run_enrichm(args, command)
+
+            status = {'status':0}
+
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+
+        except BaseException as error:
+
+            if isinstance(error, KeyboardInterrupt):
+                raise
+
+            logging.exception("Job failed")
+            status = {'status':1, 'error':'%s: %s' % (type(error).__name__, error)}
+
+        finally:
+            client_stream.flush()
+
+            for handler in list(logger.handlers):
+
+                if handler not in handlers:
+                    logger.removeHandler(handler)
+                    handler.close()
+
+            logger.setLevel(level)
+            Profiler.stop()
+            os.chdir(server_cwd)
+
+        return status
+
+class Client:
+    '''
+    Submit jobs to an EnrichM server.
+    '''
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path or default_socket_path()
+
+    def _connect(self):
+        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client_socket.connect(self.socket_path)
+
+        return client_socket
+
+    def alive(self):
+        '''
+        Whether a server is listening on the socket.
+        '''
+        try:
+
+            with self._connect() as client_socket, client_socket.makefile('rw') as connection_io:
+                send(connection_io, {'ping':True})
+                return json.loads(connection_io.readline())['status'] == 0
+
+        except (OSError, ValueError):
+            return False
+
+    def submit(self, args, command):
+        '''
+        Run a job on the server, printing its output as it arrives.
+
+        Parameters
+        ----------
+        args    - Namespace. Arguments of the job, parsed as for the command line
+        command - List. The command as typed by the user
+
+        Output
+        ------
+        The exit status of the job
+        '''
+        try:
+            client_socket = self._connect()
+
+        except OSError:
+            raise Exception("Unable to connect to an EnrichM server on %s. Has it been started with 'enrichm serve'?"
+                            % self.socket_path)
+
+        with client_socket, client_socket.makefile('rw') as connection_io:
+            send(connection_io, {'args':vars(args), 'command':command, 'cwd':os.getcwd()})
+
+            for line in connection_io:
+                message = json.loads(line)
+
+                if 'output' in message:
+                    print(message['output'])
+
+                else:
+
+                    if message['status'] != 0:
+                        sys.stderr.write(message['error'] + '\n')
+
+                    return message['status']
+
+        raise Exception("The EnrichM server closed the connection before the job finished")
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+A single file, indexed copy of the database mappings.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import os
+import pickle
+import logging
+import sqlite3
+import tempfile
+import threading
+from collections.abc import Mapping
+###############################################################################
+
+class StoreMapping(Mapping):
+    '''
+    A read-only mapping backed by the DatabaseStore. Looking up a key only
+    reads that entry from the store. The first time the mapping is iterated
+    over, the whole mapping is loaded and used from then on.
+    '''
+
+    def __init__(self, store, name, length):
+        self.store = store
+        self.name = name
+        self.length = length
+        self.looked_up = dict()
+        self.loaded = None
+
+    def _load(self):
+        if self.loaded is None:
+            self.loaded = self.store.load(self.name)
+            self.looked_up = None
+
+        return self.loaded
+
+    def _get(self, key):
+        if key not in self.looked_up:
+            self.looked_up[key] = self.store.get(self.name, key)
+
+        return self.looked_up[key]
+
+    def __getitem__(self, key):
+        if self.loaded is not None:
+            return self.loaded[key]
+
+        found, value = self._get(key)
+
+        if not found:
+            raise KeyError(key)
+
+        return value
+
+    def __contains__(self, key):
+        if self.loaded is not None:
+            return key in self.loaded
+
+        return self._get(key)[0]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return self.length
+
+    def keys(self):
+        return self._load().keys()
+
+    def values(self):
+        return self._load().values()
+
+    def items(self):
+        return self._load().items()
+
+class DatabaseStore:
+    '''
+    The pickled mappings of an EnrichM database (reaction_to_compound,
+    ko_descriptions, etc.) compiled into one SQLite file. Each entry of each
+    mapping is stored separately, indexed by mapping and key, so single keys
+    can be looked up without loading the mapping. The original pickle is kept
+    alongside, so loading a whole mapping is no slower than before.
+    '''
+    FILE_NAME = 'mappings.sqlite'
+    # Entries are looked up by their pickled key, so the protocol is fixed
+    PROTOCOL = 4
+    DICT = 'dict'
+    OBJECT = 'object'
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+
+        connection = self._connect()
+        self.metadata = dict(connection.execute("SELECT key, value FROM metadata"))
+        self.mappings = {name:(kind, entries, size) for name, kind, entries, size
+                         in connection.execute("SELECT name, kind, entries, size FROM mappings")}
+
+    def _connect(self):
+        # Connections can't be used across a fork, so each process opens its own
+        if self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect('file:%s?mode=ro' % self.store_path, uri=True,
+                                              check_same_thread=False)
+            self.connection_pid = os.getpid()
+
+        return self.connection
+
+    @property
+    def pickle_version(self):
+        return self.metadata.get('pickle_version')
+
+    def mapping(self, name):
+        '''
+        Get a mapping from the store.
+
+        Parameters
+        ----------
+        name    - String. Name of the mapping, e.g. reaction_to_compound
+
+        Output
+        ------
+        A StoreMapping, or the stored object if it is not a dictionary, and its
+        size in bytes. None if the mapping is not in the store.
+        '''
+        if name not in self.mappings:
+            return None
+
+        kind, entries, size = self.mappings[name]
+
+        if kind == self.DICT:
+            return StoreMapping(self, name, entries), size
+
+        return self.load(name), size
+
+    def load(self, name):
+        '''
+        Load a whole mapping from the store.
+
+        Parameters
+        ----------
+        name    - String. Name of the mapping
+        '''
+        with self.lock:
+            data, = self._connect().execute("SELECT data FROM mappings WHERE name = ?", (name,)).fetchone()
+
+        return pickle.loads(data)
+
+    def get(self, name, key):
+        '''
+        Look up a single entry of a mapping.
+
+        Parameters
+        ----------
+        name    - String. Name of the mapping
+        key     - Key to look up
+
+        Output
+        ------
+        Whether the key was found, and its value
+        '''
+        with self.lock:
+            row = self._connect().execute("SELECT value FROM entries WHERE mapping = ? AND key = ?",
+                                          (name, pickle.dumps(key, protocol=self.PROTOCOL))).fetchone()
+
+        if row is None:
+            return False, None
+
+        return True, pickle.loads(row[0])
+
+    @staticmethod
+    def compile(database_directory, pickle_version):
+        '''
+        Compile the pickles of a database into a store, written to
+        FILE_NAME in the database directory. The store is written to a
+        temporary file first, so an existing store is only replaced once
+        the new one is complete.
+
+        Parameters
+        ----------
+        database_directory  - String. Directory of the database version
+        pickle_version      - String. Version in the names of the pickles
+
+        Output
+        ------
+        The path to the store
+        '''
+        suffix = '.%s.pickle' % pickle_version
+        store_path = os.path.join(database_directory, DatabaseStore.FILE_NAME)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=database_directory, suffix='.sqlite')
+        os.close(file_descriptor)
+
+        try:
+            connection = sqlite3.connect(temporary_path)
+            connection.executescript('''
+                CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE mappings (name TEXT PRIMARY KEY, kind TEXT, entries INTEGER, size INTEGER, data BLOB);
+                CREATE TABLE entries (mapping TEXT, key BLOB, value BLOB, PRIMARY KEY (mapping, key)) WITHOUT ROWID;
+            ''')
+            connection.execute("INSERT INTO metadata VALUES ('pickle_version', ?)", (pickle_version,))
+
+            for file_name in sorted(os.listdir(database_directory)):
+
+                if not file_name.endswith(suffix):
+                    continue
+
+                name = file_name[:-len(suffix)]
+                logging.info("    - Compiling %s" % name)
+
+                with open(os.path.join(database_directory, file_name), 'rb') as file_io:
+                    data = file_io.read()
+
+                loaded = pickle.loads(data)
+
+                if isinstance(loaded, dict):
+                    kind = DatabaseStore.DICT
+                    connection.executemany("INSERT INTO entries VALUES (?, ?, ?)",
+                                           ((name, pickle.dumps(key, protocol=DatabaseStore.PROTOCOL),
+                                             pickle.dumps(value, protocol=DatabaseStore.PROTOCOL))
+                                            for key, value in loaded.items()))
+                else:
+                    kind = DatabaseStore.OBJECT
+
+                connection.execute("INSERT INTO mappings VALUES (?, ?, ?, ?, ?)",
+                                   (name, kind, len(loaded) if kind == DatabaseStore.DICT else 0,
+                                    len(data), data))
+
+            connection.commit()
+            connection.close()
+            # mkstemp creates the file readable only by its owner
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, store_path)
+
+        finally:
+
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+        logging.info("Compiled database written to %s" % store_path)
+
+        return store_path
@@ -20,9 +20,21 @@ Miscellaneous functions that dont necessarily belong anywhere but are still usef
 #                                                                             #
 ###############################################################################
 
+import io
+import gzip
+import queue
+import shutil
+import signal
 import logging
+import threading
 import subprocess
 
+GZIP_SUFFIX = '.gz'
+ZSTD_SUFFIX = '.zst'
+COMPRESSED_SUFFIXES = (GZIP_SUFFIX, ZSTD_SUFFIX)
+# Size of the decompressed blocks handed from the decompressing thread
+BLOCK_SIZE = 1048576
+
 def list_splitter(input_list, chunk_number, chunk_max):
     """
     An iterator that separates a list into a number of smaller lists
@@ -88,3 +100,218 @@ def get_present_annotations(input_dictionary):
             output_list.append(key)
 
     return output_list
+
+class _ThreadedReader(io.RawIOBase):
+    '''
+    Decompresses a stream in a background thread, a few blocks ahead of the
+    reader. zlib and zstd release the GIL, so parsing and decompression run on
+    separate cores.
+    '''
+    QUEUED_BLOCKS = 8
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.blocks = queue.Queue(self.QUEUED_BLOCKS)
+        self.block = memoryview(b'')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def _decompress(self):
+        try:
+
+            while not self.stopped.is_set():
+                block = self.stream.read(BLOCK_SIZE)
+                self.blocks.put(block)
+
+                if not block:
+                    break
+
+        except BaseException as error:
+            self.blocks.put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+
+        if not self.block:
+            block = self.blocks.get()
+
+            if isinstance(block, BaseException):
+                raise block
+
+            if not block:
+                # Leave the end marker for any later reads
+                self.blocks.put(block)
+                return 0
+
+            self.block = memoryview(block)
+
+        size = min(len(buffer), len(self.block))
+        buffer[:size] = self.block[:size]
+        self.block = self.block[size:]
+
+        return size
+
+    def close(self):
+
+        if not self.closed:
+            self.stopped.set()
+
+            # Unblock the thread if it is waiting on a full queue
+            while self.thread.is_alive():
+
+                try:
+                    self.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+            self.stream.close()
+
+        super().close()
+
+class _ProcessFile(io.RawIOBase):
+    '''
+    Reads the output of, or writes to the input of, a (de)compressing
+    command. Closing it waits for the command, and raises an exception if it
+    failed.
+    '''
+
+    def __init__(self, cmd, path, writing):
+        self.cmd = cmd
+        self.path = path
+        self.writing = writing
+        self.finished = False
+
+        if writing:
+            self.output_io = open(path, 'wb')
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.output_io)
+            self.pipe = self.process.stdin
+        else:
+            self.output_io = None
+            self.process = subprocess.Popen(cmd + [path], stdout=subprocess.PIPE)
+            self.pipe = self.process.stdout
+
+    def readable(self):
+        return not self.writing
+
+    def writable(self):
+        return self.writing
+
+    def readinto(self, buffer):
+        size = self.pipe.readinto(buffer)
+
+        if not size:
+            self.finished = True
+
+        return size
+
+    def write(self, data):
+        return self.pipe.write(data)
+
+    def close(self):
+
+        if not self.closed:
+            # The command may still be writing output that wasn't read. It is
+            # stopped, and dies of SIGPIPE if it writes again before then.
+            stopped = not self.writing and not self.finished
+
+            if stopped and self.process.poll() is None:
+                self.process.terminate()
+
+            self.pipe.close()
+            returncode = self.process.wait()
+
+            if self.output_io is not None:
+                self.output_io.close()
+
+            if stopped and returncode in (-getattr(signal, 'SIGPIPE', signal.SIGTERM), -signal.SIGTERM):
+                returncode = 0
+
+            if returncode != 0:
+                raise Exception("%s failed on %s (exit code %i)" % (' '.join(self.cmd), self.path, returncode))
+
+        super().close()
+
+def strip_compression(path):
+    """
+    A path without the .gz or .zst suffix of a compressed file.
+
+    :param path: Path to the file
+    :type path: str
+    :returns: The path, without the compression suffix
+    :rtype: str
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+
+    return path
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+
+    return zstandard
+
+def open_file(path, mode='r'):
+    """
+    Open a file, compressing or decompressing it if its name ends in .gz or
+    .zst. Compressed files are read through a background thread (or the
+    zstd command, if the zstandard module isn't installed), and written with
+    pigz or zstd on all cores if they are installed.
+
+    :param path: Path to the file
+    :type path: str
+    :param mode: 'r', 'w' (text) or 'rb', 'wb' (binary)
+    :type mode: str
+    :returns: A file object
+    :rtype: file
+    """
+    writing = 'w' in mode
+    binary = 'b' in mode
+
+    if not path.endswith(COMPRESSED_SUFFIXES):
+        return open(path, mode)
+
+    zstandard = _zstandard()
+
+    if path.endswith(GZIP_SUFFIX):
+
+        if writing and shutil.which('pigz'):
+            raw = _ProcessFile(['pigz', '-c'], path, True)
+        elif writing:
+            raw = gzip.open(path, 'wb', compresslevel=6)
+        else:
+            raw = _ThreadedReader(gzip.open(path, 'rb'))
+
+    elif zstandard is not None:
+
+        if writing:
+            raw = zstandard.ZstdCompressor(threads=-1).stream_writer(open(path, 'wb'), closefd=True)
+        else:
+            raw = _ThreadedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True))
+
+    elif shutil.which('zstd'):
+
+        if writing:
+            raw = _ProcessFile(['zstd', '-q', '-T0', '-c'], path, True)
+        else:
+            raw = _ProcessFile(['zstd', '-q', '-d', '-c'], path, False)
+
+    else:
+        raise Exception("Reading or writing %s needs the zstandard python module or the zstd command" % path)
+
+    if writing:
+        stream = io.BufferedWriter(raw, BLOCK_SIZE) if isinstance(raw, io.RawIOBase) else raw
+    else:
+        stream = io.BufferedReader(raw, BLOCK_SIZE) if isinstance(raw, io.RawIOBase) else raw
+
+    if binary:
+        return stream
+
+    return io.TextIOWrapper(stream)
@@ -19,7 +19,6 @@
 from enrichm.writer import Writer
 from enrichm.parser import Parser
 from enrichm.databases import Databases
-from enrichm.enrichment import mannwhitneyu_calc
 from itertools import combinations
 
 import logging
@@ -39,7 +38,7 @@ class Uses:
         self.negative = 'negative'
 
         self.abundace = "frequency_matrix.tsv"
-        self.enrichment = "enrichment_results.tsv"
+        self.enrichment_output = "enrichment_results.tsv"
         self.abundace_header = ["Compound"]
         self.enrichment_header = ["Compound", "Group_1", "Group_2", "group_1_mean", "group_2_mean",
                                   "score", "pvalue", "description"]
@@ -58,6 +57,9 @@ class Uses:
     def uses(self, compound_list, annotations, column_names, count):
         output_lines_abundance = [self.abundace_header + column_names]
         enrichment_tallys = dict()
+        # Gather all annotations present for each column (genome), once
+        present_annotations = {column_header:self.gather_present_annotations(annotations[column_header])
+                               for column_header in column_names}
 
         for compound in compound_list:
 
@@ -70,14 +72,12 @@ class Uses:
                     column_positive_tally = 0
                     column_negative_tally = 0
 
-                    # Gather all annotations present for this column (genome)
-                    present_annotations = self.gather_present_annotations(annotations[column_header])
                     for reaction in self.compound_to_reaction[compound]:
 
                         # If there are more than 0 KOs that carry out the reaction present in
                         # the genome
                         if reaction in self.reaction_to_ko:
-                            overlapping_annotations = present_annotations.intersection(self.reaction_to_ko[reaction])
+                            overlapping_annotations = present_annotations[column_header].intersection(self.reaction_to_ko[reaction])
 
                             if len(overlapping_annotations)>0:
 
@@ -102,6 +102,8 @@ class Uses:
         return output_lines_abundance, enrichment_tallys
 
     def enrichment(self, enrichment_tallys, metadata):
+        # Imported here, as the enrichment module loads scipy
+        from enrichm.enrichment import mannwhitneyu_calc
         output_lines = [self.enrichment_header]
 
         for compound, tallys in enrichment_tallys.items():
@@ -131,6 +133,6 @@ class Uses:
         Writer.write(output_lines_abundance, os.path.join(output, self.abundace))
         logging.info('Calculating enrichment between groups for each compound')
         output_lines_enrichment = self.enrichment(enrichment_tallys, attribute_dict)
-        logging.info('Writing file: %s' % self.enrichment)
-        Writer.write(output_lines_enrichment, os.path.join(output, self.enrichment))
+        logging.info('Writing file: %s' % self.enrichment_output)
+        Writer.write(output_lines_enrichment, os.path.join(output, self.enrichment_output))
         logging.info('Finished the use pipeline')
\ No newline at end of file
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# pylint: disable=line-too-long
+"""
+A single process-wide pool of worker processes.
+"""
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+# Imports
+import sys
+import atexit
+import logging
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+###############################################################################
+
+class WorkerPool:
+    '''
+    A multiprocessing pool shared by every part of EnrichM. The pool is only
+    created the first time work is sent to it, so that it is not started at
+    all for runs that don't need it, and so that the workers are forked after
+    the reference data has been loaded and can share it copy-on-write. The
+    pool is shut down when the interpreter exits.
+    '''
+    pool = None
+    processes = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def _context():
+        # fork lets the workers inherit data loaded by the parent without
+        # pickling it, where the platform supports it
+        if 'fork' in mp.get_all_start_methods():
+            return mp.get_context('fork')
+
+        return mp.get_context()
+
+    @classmethod
+    def get(cls, processes):
+        '''
+        Get the pool, creating it if needed. If a pool of a different size
+        already exists it is replaced.
+
+        Parameters
+        ----------
+        processes   - Integer. Number of worker processes
+        '''
+        processes = max(1, int(processes))
+
+        with cls.lock:
+
+            if cls.pool is not None and cls.processes != processes:
+                cls._shutdown()
+
+            if cls.pool is None:
+                logging.debug("Starting %i worker processes" % processes)
+                cls.pool = cls._context().Pool(processes=processes)
+                cls.processes = processes
+
+            return cls.pool
+
+    @classmethod
+    def map(cls, function, iterable, processes):
+        '''
+        Apply a function to every item of an iterable using the pool. Small
+        jobs are run in this process rather than starting any workers.
+
+        Parameters
+        ----------
+        function    - Function. A module level function to apply
+        iterable    - Iterable. Items to apply the function to
+        processes   - Integer. Number of worker processes
+
+        Output
+        ------
+        A list of the results, in the order of iterable
+        '''
+        items = list(iterable)
+
+        if len(items) <= 1 or int(processes) <= 1:
+            return [function(item) for item in items]
+
+        return cls.get(processes).map(function, items)
+
+    @classmethod
+    def _shutdown(cls):
+        if cls.pool is not None:
+            cls.pool.close()
+            cls.pool.join()
+            cls.pool = None
+            cls.processes = None
+
+    @classmethod
+    def shutdown(cls):
+        '''
+        Stop the worker processes, waiting for any outstanding work.
+        '''
+        with cls.lock:
+            cls._shutdown()
+
+atexit.register(WorkerPool.shutdown)
+
+# SharedMemory takes track=False from Python 3.13. On Python 3.12 and
+# earlier, attaching to shared memory always registers it with the process's
+# resource tracker, and the registration can only be undone through the
+# private resource tracker API, which is kept to the two functions below.
+UNTRACKED_ATTACH = sys.version_info >= (3, 13)
+
+def _tracker():
+    '''
+    The process id of the resource tracker this process reports shared
+    memory to, or None where memory can be attached to untracked.
+    '''
+    if UNTRACKED_ATTACH:
+        return None
+
+    return resource_tracker._resource_tracker._pid
+
+def _attach_untracked(name, tracker):
+    '''
+    Attach to shared memory without leaving it registered with this
+    process's resource tracker. Workers forked before the parent first used
+    shared memory start a tracker of their own, which would otherwise report
+    the memory as leaked at shutdown and try to unlink it after the parent
+    already has. Workers sharing the parent's tracker leave the parent's
+    registration in place.
+
+    Parameters
+    ----------
+    name    - String. Name of the shared memory
+    tracker - Integer. Resource tracker of the process that created it (see _tracker)
+    '''
+    if UNTRACKED_ATTACH:
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    memory = shared_memory.SharedMemory(name=name)
+
+    if _tracker() != tracker:
+        # The tracker knows the memory by its name with the leading slash
+        resource_tracker.unregister(memory._name, 'shared_memory')
+
+    return memory
+
+class SharedArrays:
+    '''
+    Read-only numpy arrays placed in shared memory once by the parent, so
+    that tasks sent to the pool carry only the name, shape and type of each
+    (see descriptors) rather than a pickled copy of the data. Workers attach
+    to them with SharedArrays.attach. The shared memory is released when the
+    with block exits.
+    '''
+    # Shared memory attached to by this process, by name
+    attached = dict()
+
+    def __init__(self, arrays):
+        '''
+        Parameters
+        ----------
+        arrays  - Dict. numpy arrays to share, by key
+        '''
+        self.memory = list()
+        self.descriptors = dict()
+
+        try:
+
+            for key, array in arrays.items():
+                memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self.memory.append(memory)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+                self.descriptors[key] = (memory.name, array.shape, array.dtype.str, _tracker())
+
+        except BaseException:
+            self.release()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @staticmethod
+    def _close(memory):
+        try:
+            memory.close()
+
+        except BufferError:
+            # An array still uses it, it is unmapped once that is collected
+            pass
+
+    def release(self):
+        '''
+        Free the shared memory.
+        '''
+        for memory in self.memory:
+            attached = SharedArrays.attached.pop(memory.name, None)
+
+            if attached is not None:
+                self._close(attached)
+
+            self._close(memory)
+            memory.unlink()
+
+        self.memory = list()
+
+    @staticmethod
+    def attach(descriptors):
+        '''
+        Get shared arrays from their descriptors. Memory attached to for
+        earlier descriptors is let go, so workers only keep the arrays of the
+        current job mapped.
+
+        Parameters
+        ----------
+        descriptors - Dict. The descriptors attribute of a SharedArrays
+
+        Output
+        ------
+        A dictionary of read-only arrays, by key
+        '''
+        names = set(name for name, _, _, _ in descriptors.values())
+
+        for name in list(SharedArrays.attached):
+
+            if name not in names:
+                SharedArrays._close(SharedArrays.attached.pop(name))
+
+        arrays = dict()
+
+        for key, (name, shape, dtype, tracker) in descriptors.items():
+
+            if name not in SharedArrays.attached:
+                SharedArrays.attached[name] = _attach_untracked(name, tracker)
+
+            array = np.ndarray(shape, dtype=dtype, buffer=SharedArrays.attached[name].buf)
+            array.flags.writeable = False
+            arrays[key] = array
+
+        return arrays
@@ -17,10 +17,13 @@
 ###############################################################################
 
 import logging
-import os
+import numpy as np
 from itertools import chain
 from collections import Counter
-from enrichm.databases import Databases
+from enrichm.ids import IdCatalog
+from enrichm.toolbox import open_file
+from enrichm.profiler import Profiler
+from enrichm.matrix import AnnotationMatrix, SparseAnnotationMatrix
 # Local
 ###############################################################################
 class Writer:
@@ -42,7 +45,7 @@ class Writer:
         '''
         logging.info("Writing results to file: %s" % output_path)
 
-        with open(output_path, 'w') as out_io:
+        with open_file(output_path, 'w') as out_io:
 
             for output_line_list in output_lines_list:
                 output_line_string = '\t'.join([str(column_entry) for column_entry in output_line_list]) + '\n'
@@ -100,6 +103,9 @@ class MatrixGenerator:
     CAZY = 'CAZY_IDS.txt'
     HYPOTHETICAL = 'HYPOTHETICAL'
     ORTHOLOG = 'ORTHOLOG'
+    ID_FILES = [KO, EC, PFAM, TIGRFAM, CAZY]
+    # Mostly zeros, so held as a SparseAnnotationMatrix
+    SPARSE = [PFAM, HYPOTHETICAL, ORTHOLOG]
 
     def __init__(self, annotation_type, clusters = None):
         '''
@@ -110,63 +116,77 @@ class MatrixGenerator:
         annotation_type - String.
         '''
         self.annotation_type = annotation_type
-        self.databases = Databases()
-        if self.annotation_type == self.KO:
-            self.annotation_list = [x.strip() for x in open(os.path.join(self.databases.IDS_DIR, self.KO))]
 
-        elif self.annotation_type == self.EC:
-            self.annotation_list = [x.strip() for x in open(os.path.join(self.databases.IDS_DIR, self.EC))]
+        if self.annotation_type in self.ID_FILES:
+            # Shared by every generator of the annotation type
+            self.catalog = IdCatalog.get(self.annotation_type)
 
-        elif self.annotation_type == self.PFAM:
-            self.annotation_list = [x.strip() for x in open(os.path.join(self.databases.IDS_DIR, self.PFAM))]
-
-        elif self.annotation_type == self.TIGRFAM:
-            self.annotation_list = [x.strip() for x in open(os.path.join(self.databases.IDS_DIR, self.TIGRFAM))]
-
-        elif self.annotation_type == self.CAZY:
-            self.annotation_list = [x.strip() for x in open(os.path.join(self.databases.IDS_DIR, self.CAZY))]
-
-        elif self.annotation_type == self.HYPOTHETICAL:
-            self.annotation_list = clusters
-
-        elif self.annotation_type == self.ORTHOLOG:
-            self.annotation_list = clusters
+        elif self.annotation_type in (self.HYPOTHETICAL, self.ORTHOLOG):
+            self.catalog = IdCatalog(clusters)
 
         else:
             raise Exception("Annotation type not found: %s" % (self.annotation_type))
 
-    def write_matrix(self, genomes_list, count_domains, output_path):
+    def generate_matrix(self, genomes_list, count_domains):
         '''
-        Writes a frequency matrix with of each annotation (rows) per sample (columns)
+        Count each annotation (rows) per sample (columns)
 
         Parameters
         ----------
         genomes_list        - list. List of Genome objects
-        output_path         - string. Path to file to which the results are written.
-        '''
+        count_domains       - bool. Count every time an annotation is found, rather than the
+                              number of proteins with that annotation
 
-        logging.info("    - Writing results to file: %s" % output_path)
+        Output
+        ------
+        An AnnotationMatrix of annotation frequencies, or a
+        SparseAnnotationMatrix for the annotation types in SPARSE
+        '''
+        colnames = [genome.name for genome in genomes_list]
+        rownames = list(self.catalog.ids)
+        rows, columns, data = list(), list(), list()
 
-        with open(output_path, 'w') as out_io:
-            colnames = ['ID'] + [genome.name for genome in genomes_list]
-            out_io.write('\t'.join(colnames) + '\n')
+        for column, genome in enumerate(genomes_list):
 
             if count_domains:
-                genome_annotations = {genome.name:Counter(chain(*[sequence.all_annotations() for sequence in genome.sequences.values()]))
-                                      for genome in genomes_list}
+                annotations = Counter(chain(*[sequence.all_annotations() for sequence in genome.sequences.values()]))
             else:
-                genome_annotations = {genome.name:Counter(chain(*[set(sequence.all_annotations()) for sequence in genome.sequences.values()]))
-                                      for genome in genomes_list}
+                annotations = Counter(chain(*[set(sequence.all_annotations()) for sequence in genome.sequences.values()]))
+
+            genome_rows = np.array(self.catalog.rows(annotations.keys()), dtype=np.int64)
+            found = genome_rows >= 0
+            rows.append(genome_rows[found])
+            columns.append(np.full(np.count_nonzero(found), column, dtype=np.int64))
+            data.append(np.fromiter(annotations.values(), dtype=np.int64, count=len(annotations))[found])
+
+        rows, columns, data = [np.concatenate(entries or [np.zeros(0, dtype=np.int64)]) for entries in (rows, columns, data)]
 
-            for annotation in self.annotation_list:
-                output_line = [annotation]
+        if self.annotation_type in self.SPARSE:
+            return SparseAnnotationMatrix(SparseAnnotationMatrix.coo(rows, columns, data, np.int64, (len(rownames), len(colnames))),
+                                          colnames, rownames)
 
-                for genome in genomes_list:
+        counts = np.zeros((len(rownames), len(colnames)), dtype=np.int64)
+        counts[rows, columns] = data
 
-                    if annotation in genome_annotations[genome.name]:
-                        output_line.append(str(genome_annotations[genome.name][annotation]))
+        return AnnotationMatrix(counts, colnames, rownames)
 
-                    else:
-                        output_line.append('0')
+    @Profiler.profile('MatrixGenerator.write_matrix')
+    def write_matrix(self, genomes_list, count_domains, output_path):
+        '''
+        Writes a frequency matrix with of each annotation (rows) per sample (columns)
+
+        Parameters
+        ----------
+        genomes_list        - list. List of Genome objects
+        output_path         - string. Path to file to which the results are written. A binary
+                              copy is written next to it (see AnnotationMatrix.write_binary)
+
+        Output
+        ------
+        The AnnotationMatrix that was written
+        '''
+        matrix = self.generate_matrix(genomes_list, count_domains)
+        matrix.write(output_path)
+        matrix.write_binary(output_path)
 
-                out_io.write( '\t'.join(output_line) + '\n' )
+        return matrix
@@ -0,0 +1,114 @@
+import unittest
+import tempfile
+import pickle
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.data import Data
+from enrichm.databases import Databases
+from enrichm.builder import DatabaseBuilder
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.source_directory = tempfile.mkdtemp()
+        self.database_directory = tempfile.mkdtemp()
+        self.write_source('link_ko_reaction.tsv', 'rn:R00001\tko:K00001\nrn:R00001\tko:K00002\nrn:R00002\tko:K00001\n')
+        self.write_source('link_module_reaction.tsv', 'rn:R00001\tmd:M00001\n')
+        self.write_source('list_compound.tsv', 'cpd:C00001\tH2O; Water\ncpd:C00002\tATP; Adenosine 5\'-triphosphate\n')
+        self.write_source('module', 'ENTRY       M00001            Pathway   Module\n'
+                                    'NAME        Glycolysis\n'
+                                    'DEFINITION  K00001 (K00002,K00003)\n'
+                                    '///\n')
+        self.install_base()
+
+    def install_base(self):
+        # An installed version for the build to be made on top of, with the
+        # files that aren't built from the sources
+        base_directory = os.path.join(self.database_directory, 'base')
+
+        for directory in ['ids', 'databases', 'gtdb']:
+            os.makedirs(os.path.join(base_directory, directory))
+
+        for file_name, text in [('VERSION', 'base\n'), ('ids/KO_IDS.txt', 'K00001\nK00002\n'),
+                                ('databases/ko.hmm', 'HMMER3/f\n'), ('gtdb/gtdb_ko.tsv', 'ID\n'),
+                                ('ko_cutoffs.tsv', ''), ('taxonomy_gtdb.tsv', ''),
+                                ('mappings.sqlite', ''), ('reaction_ids.npz', '')]:
+
+            with open(os.path.join(base_directory, file_name), 'w') as out_io:
+                out_io.write(text)
+
+        artifacts = [artifact for _, _, _, group_artifacts in DatabaseBuilder.GROUPS for artifact in group_artifacts]
+
+        for artifact in artifacts + ['module_to_cpd']:
+
+            with open(os.path.join(base_directory, artifact + '.base.pickle'), 'wb') as out_io:
+                pickle.dump({artifact:['base']}, out_io)
+
+        with open(os.path.join(self.database_directory, 'VERSION'), 'w') as out_io:
+            out_io.write('base.tar.gz\n')
+
+    def write_source(self, file_name, text):
+        with open(os.path.join(self.source_directory, file_name), 'w') as out_io:
+            out_io.write(text)
+
+    def build(self, version):
+        return DatabaseBuilder(self.source_directory, self.database_directory, version, 1).build()
+
+    def test_build(self):
+        built = self.build('test_db')
+        self.assertEqual(sorted(built), ['compound_descriptions', 'ko_to_module', 'ko_to_reaction',
+                                         'module_to_definition', 'reaction_to_module', 'reaction_to_orthology'])
+
+        database_directory = Data.DATABASE_DIR
+        Data.DATABASE_DIR = self.database_directory
+
+        try:
+            databases = Databases()
+            self.assertEqual(databases.DB_VERSION, 'test_db')
+            self.assertEqual(databases.r2k(), {'R00001':['K00001', 'K00002'], 'R00002':['K00001']})
+            self.assertEqual(databases.c(), {'C00001':'H2O', 'C00002':'ATP'})
+            self.assertEqual(databases.m2def(), {'M00001':'K00001 (K00002,K00003)'})
+            self.assertEqual(databases.k2r(), databases._k2r())
+            self.assertEqual(databases.k2m(), databases._k2m())
+            # Files and mappings that weren't built are carried over from the
+            # installed version, except those compiled from the old mappings
+            self.assertEqual(databases.m2c(), {'module_to_cpd':['base']})
+            self.assertEqual(databases.r2c(), {'reaction_to_compound':['base']})
+            self.assertTrue(os.path.isfile(os.path.join(databases.IDS_DIR, 'KO_IDS.txt')))
+            self.assertTrue(os.path.isfile(databases.KO_HMM_DB))
+            self.assertFalse(os.path.exists(databases.STORE))
+            self.assertFalse(os.path.exists(databases.REACTION_IDS))
+        finally:
+            Data.DATABASE_DIR = database_directory
+            Databases.cache.clear()
+
+    def test_incremental(self):
+        self.build('test_db')
+        self.assertEqual(self.build('test_db'), list())
+
+        # Only the mappings built from a changed source are built again
+        self.write_source('link_module_reaction.tsv', 'rn:R00002\tmd:M00002\n')
+        self.assertEqual(sorted(self.build('test_db')), ['ko_to_module', 'reaction_to_module'])
+
+        # A new version reuses the installed version's mappings
+        self.assertEqual(self.build('test_db_2'), list())
+        self.assertTrue(os.path.isfile(os.path.join(self.database_directory, 'test_db_2',
+                                                    'reaction_to_orthology.test_db_2.pickle')))
+
+    def test_incomplete(self):
+        os.remove(os.path.join(self.database_directory, 'base', 'reaction_to_compound.base.pickle'))
+
+        # A mapping without a source or an installed copy stops the build
+        # before it is installed
+        with self.assertRaises(Exception):
+            self.build('test_db')
+
+        with open(os.path.join(self.database_directory, 'VERSION')) as version_io:
+            self.assertEqual(version_io.read(), 'base.tar.gz\n')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+import tempfile
+import pickle
+import threading
+import time
+import os
+import sys
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.checkpoint import Checkpoint
+from enrichm.annotate import Annotate
+from enrichm.genome import Genome, AnnotationParser
+from enrichm.matrix import AnnotationMatrix, SparseAnnotationMatrix
+
+class MatrixSource:
+    '''
+    Stands in for a MatrixGenerator, returning a fixed matrix.
+    '''
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def generate_matrix(self, genomes_list, count_domains):
+        return self.matrix
+
+class Tests(unittest.TestCase):
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, 'genome.faa')
+
+            with open(input_path, 'w') as input_io:
+                input_io.write('>a\nMKL\n')
+
+            stage_directory = os.path.join(tmp, 'stage_b')
+            checkpoint = Checkpoint(tmp, [input_path], {'evalue':1e-05}, False)
+            self.assertTrue(checkpoint.start('a', []))
+            checkpoint.record('a', ['state_a'])
+            self.assertTrue(checkpoint.start('b', []))
+            os.mkdir(stage_directory)
+            # Stage b fails before being recorded
+
+            checkpoint = Checkpoint(tmp, [input_path], {'evalue':1e-05}, True)
+            self.assertFalse(checkpoint.start('a', []))
+            self.assertEqual(checkpoint.load(), ['state_a'])
+            self.assertTrue(checkpoint.start('b', ['stage_b']))
+            self.assertFalse(os.path.isdir(stage_directory))
+            checkpoint.record('b', ['state_b'])
+            checkpoint.finish()
+
+            checkpoint = Checkpoint(tmp, [input_path], {'evalue':1e-05}, True)
+            self.assertTrue(checkpoint.finished)
+
+            with self.assertRaises(Exception):
+                Checkpoint(tmp, [input_path], {'evalue':1}, True)
+
+            with open(input_path, 'a') as input_io:
+                input_io.write('>b\nMKL\n')
+
+            with self.assertRaises(Exception):
+                Checkpoint(tmp, [input_path], {'evalue':1e-05}, True)
+
+    def test_resume_matrices(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            annotate = Annotate.__new__(Annotate)
+            annotate.output_directory = tmp
+            annotate.count_domains = False
+            annotate.write_matrices = False
+            annotate.matrices = dict()
+            values = {'genome_1':{'K00001':1, 'K00002':0}, 'genome_2':{'K00001':0, 'K00002':3}}
+            ko_matrix = AnnotationMatrix(values, ['genome_1', 'genome_2'], ['K00001', 'K00002'])
+            pfam_matrix = SparseAnnotationMatrix(values, ['genome_1', 'genome_2'], ['K00001', 'K00002'])
+            annotate._store_matrix('ko', MatrixSource(ko_matrix), list())
+            annotate._store_matrix('pfam', MatrixSource(pfam_matrix), list())
+            self.assertFalse(os.path.isfile(os.path.join(tmp, Annotate.OUTPUT_KO)))
+
+            # Matrices kept in memory are read back when their stages are skipped
+            annotate.matrices = dict()
+            annotate._load_matrices()
+            self.assertEqual(sorted(annotate.matrices), ['ko', 'pfam'])
+            self.assertEqual(annotate.matrices['ko'].array.tolist(), [[1, 0], [0, 3]])
+            self.assertIsInstance(annotate.matrices['pfam'], SparseAnnotationMatrix)
+            self.assertEqual(annotate.matrices['pfam'].array.toarray().tolist(), [[1, 0], [0, 3]])
+
+    def test_resume_failed_merge(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            genome_paths = list()
+
+            for name in ['genome_1', 'genome_2']:
+                genome_path = os.path.join(tmp, name + '.faa')
+                genome_paths.append(genome_path)
+
+                with open(genome_path, 'w') as genome_io:
+                    genome_io.write('>protein_1\nMKL\n')
+
+            ec_failed = threading.Event()
+            ec_hits = {'genome_1':'protein_1', 'genome_2':'missing_protein'}
+            merged = list()
+
+            def diamond_search(genomes_list, database, output_subdirectory, threads):
+                output_path = os.path.join(tmp, output_subdirectory + '.tsv')
+
+                if database == 'ko':
+                    # Merged once the EC stage has failed
+                    ec_failed.wait(5)
+                    time.sleep(0.05)
+
+                with open(output_path, 'w') as output_io:
+
+                    for genome_name in ['genome_1', 'genome_2']:
+                        protein = ec_hits[genome_name] if database == 'ec' else 'protein_1'
+                        output_io.write('%s~%s\t%s~%s_1\t100\t3\t0\t0\t1\t3\t1\t3\t1e-10\t100\n'
+                                        % (genome_name, protein, database, database))
+
+                return output_path
+
+            def add_diamond_annotations(*args):
+                merged.append(args[0])
+
+                try:
+                    Annotate.add_diamond_annotations(annotate, *args)
+                except KeyError:
+                    ec_failed.set()
+                    raise
+
+            annotate = Annotate.__new__(Annotate)
+            annotate.__dict__.update(output_directory=tmp, resume=False, light=True,
+                                     parallel=2, threads=1, cpu_budget=None, cpus=2,
+                                     evalue=1e-05, bit=0, aln_query=0, aln_reference=0,
+                                     annotate_ko=True, annotate_ec=True, annotate_pfam=False,
+                                     annotate_ko_hmm=False, annotate_tigrfam=False,
+                                     annotate_cazy=False, annotate_cluster=False,
+                                     annotate_ortholog=False, merge_lock=threading.Lock(),
+                                     databases=SimpleNamespace(KO_DB='ko', EC_DB='ec'),
+                                     _parameters=dict, _store_matrix=lambda *args: None,
+                                     _load_matrices=lambda: None,
+                                     diamond_annotation_search=diamond_search,
+                                     add_diamond_annotations=add_diamond_annotations)
+            annotate.parse_genome_inputs = lambda *args: [Genome(True, genome_path, None, None)
+                                                          for genome_path in genome_paths]
+
+            # The EC hits of genome_1 are added before genome_2 fails
+            with self.assertRaises(KeyError), mock.patch('enrichm.annotate.MatrixGenerator'):
+                annotate.annotate_pipeline(None, None, None, genome_paths, False)
+
+            # The KO stage is recorded after the failure, without the EC hits
+            with open(os.path.join(tmp, Checkpoint.STATE), 'rb') as state_io:
+                genomes_list = pickle.load(state_io)
+
+            for genome in genomes_list:
+                self.assertTrue(hasattr(genome, 'ko_dict'))
+                self.assertFalse(hasattr(genome, 'ec_dict'))
+                self.assertEqual([annotation.type for annotation in genome.sequences['protein_1'].annotations],
+                                 [AnnotationParser.KO])
+
+            ec_hits['genome_2'] = 'protein_1'
+            annotate.resume = True
+
+            with mock.patch('enrichm.annotate.MatrixGenerator'):
+                annotate.annotate_pipeline(None, None, None, genome_paths, False)
+
+            # Only the EC stage is run again, on the genomes from the checkpoint
+            self.assertEqual(len(merged), 3)
+
+            for genome in merged[-1]:
+                self.assertEqual(genome.ec_dict, {'ec_1':['protein_1']})
+                self.assertEqual(sorted(annotation.type for annotation in genome.sequences['protein_1'].annotations),
+                                 sorted([AnnotationParser.KO, AnnotationParser.EC]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import tempfile
+import tarfile
+import hashlib
+import threading
+import io
+import os
+import sys
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.data import Data
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''
+    Serves files from memory, supporting Range requests. The first request
+    for a file in drop is cut off half way through.
+    '''
+    files = dict()
+    drop = set()
+    ranges = list()
+
+    def do_GET(self):
+        path = self.path.lstrip('/')
+
+        if path not in self.files:
+            self.send_error(404)
+            return
+
+        content = self.files[path]
+        start = 0
+
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.ranges.append(start)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+
+        if path in self.drop:
+            self.drop.remove(path)
+            self.wfile.write(content[start:len(content) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(content[start:])
+
+    def log_message(self, *args):
+        pass
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        archive_io = io.BytesIO()
+
+        with tarfile.open(fileobj=archive_io, mode='w:gz') as archive:
+
+            for name, content in [('test_db/VERSION', b'01-01-2020\n'),
+                                  ('test_db/data.txt', os.urandom(200000))]:
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                archive.addfile(member, io.BytesIO(content))
+
+        self.archive = archive_io.getvalue()
+        RangeHandler.files = {'VERSION':b'test_db.tar.gz\n',
+                              'test_db.tar.gz':self.archive,
+                              'test_db.tar.gz.sha256':(hashlib.sha256(self.archive).hexdigest() + '  test_db.tar.gz\n').encode()}
+        RangeHandler.drop = set()
+        RangeHandler.ranges = list()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.data = Data()
+        self.data.ftp = 'http://127.0.0.1:%i/' % self.server.server_address[1]
+        self.data.DATABASE_DIR = os.path.join(tempfile.mkdtemp(), 'databases')
+        self.data.RETRY_WAIT = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_install(self):
+        self.data.do(False, False)
+
+        self.assertEqual(sorted(os.listdir(self.data.DATABASE_DIR)), ['VERSION', 'test_db'])
+
+        with open(os.path.join(self.data.DATABASE_DIR, 'VERSION')) as version_io:
+            self.assertEqual(version_io.read(), 'test_db.tar.gz\n')
+
+        self.assertEqual(RangeHandler.ranges, list())
+
+    def test_resume(self):
+        RangeHandler.drop.add('test_db.tar.gz')
+        self.data.do(False, False)
+
+        self.assertEqual(RangeHandler.ranges, [len(self.archive) // 2])
+        self.assertTrue(os.path.isfile(os.path.join(self.data.DATABASE_DIR, 'test_db', 'data.txt')))
+
+    def test_checksum(self):
+        RangeHandler.files['test_db.tar.gz.sha256'] = b'0' * 64
+        os.makedirs(self.data.DATABASE_DIR)
+
+        with open(os.path.join(self.data.DATABASE_DIR, 'VERSION'), 'w') as version_io:
+            version_io.write('old_db.tar.gz\n')
+
+        with self.assertRaises(Exception):
+            self.data.do(False, False)
+
+        # The old database is left as it was, with nothing half installed
+        self.assertEqual(os.listdir(self.data.DATABASE_DIR), ['VERSION'])
+
+        with open(os.path.join(self.data.DATABASE_DIR, 'VERSION')) as version_io:
+            self.assertEqual(version_io.read(), 'old_db.tar.gz\n')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import unittest
+import tempfile
+import pickle
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.data import Data
+from enrichm.databases import DatabaseCache, Databases
+from enrichm.version import __version__
+
+class Tests(unittest.TestCase):
+
+    def test_loaded_once(self):
+        cache = DatabaseCache(100)
+        loaded = list()
+
+        def loader():
+            loaded.append(1)
+            return {'K00001':['R00001']}, 10
+
+        first = cache.get(('db', 'k2r'), loader)
+        second = cache.get(('db', 'k2r'), loader)
+
+        self.assertIs(first, second)
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_eviction(self):
+        cache = DatabaseCache(100)
+        cache.get(('db', 'm2def'), lambda: ('m2def', 40))
+        cache.get(('db', 'r2k'), lambda: ('r2k', 40))
+        # Using m2def makes r2k the least recently used
+        cache.get(('db', 'm2def'), lambda: ('m2def', 40))
+        cache.get(('db', 'r2c'), lambda: ('r2c', 40))
+
+        self.assertIn(('db', 'm2def'), cache)
+        self.assertNotIn(('db', 'r2k'), cache)
+        self.assertIn(('db', 'r2c'), cache)
+        self.assertEqual(cache.size, 80)
+
+        # Versions are cached separately
+        cache.get(('other_db', 'm2def'), lambda: ('other', 40))
+        self.assertEqual(len(cache), 2)
+
+    def test_disabled(self):
+        os.environ[DatabaseCache.MAX_SIZE_VARIABLE] = '0'
+
+        try:
+            cache = DatabaseCache.from_environment()
+        finally:
+            del os.environ[DatabaseCache.MAX_SIZE_VARIABLE]
+
+        self.assertEqual(cache.get(('db', 'm'), lambda: ('m', 1)), 'm')
+        self.assertEqual(len(cache), 0)
+
+    def make_database(self, mappings):
+        Data.DATABASE_DIR = tempfile.mkdtemp()
+        version_directory = os.path.join(Data.DATABASE_DIR, 'test_db')
+        os.mkdir(version_directory)
+
+        with open(os.path.join(Data.DATABASE_DIR, 'VERSION'), 'w') as out_io:
+            out_io.write('test_db.tar.gz\n')
+
+        with open(os.path.join(version_directory, 'VERSION'), 'w') as out_io:
+            out_io.write('01-01-2020\n')
+
+        for name, mapping in mappings.items():
+
+            with open(os.path.join(version_directory, name + '.01-01-2020.pickle'), 'wb') as out_io:
+                pickle.dump(mapping, out_io)
+
+    def test_derived(self):
+        database_directory = Data.DATABASE_DIR
+        self.make_database({'reaction_to_orthology':{'R00001':['K00001', 'K00002'], 'R00002':['K00001']},
+                            'reaction_to_module':{'R00001':['M00001'], 'R00002':['M00002', 'M00001']}})
+
+        try:
+            databases = Databases()
+            k2r = {'K00001':['R00001', 'R00002'], 'K00002':['R00001']}
+            k2m = {'K00001':['M00001', 'M00002'], 'K00002':['M00001']}
+            self.assertEqual(databases.k2r(), k2r)
+            self.assertEqual(databases.k2m(), k2m)
+
+            databases.write_derived()
+            Databases.cache.clear()
+            self.assertTrue(os.path.isfile(databases.pickle_path(databases.K2R)))
+            # There is no module_to_cpd to derive compound_to_module from
+            self.assertFalse(os.path.isfile(databases.pickle_path(databases.C2M)))
+            self.assertEqual(databases.k2r(), k2r)
+            self.assertEqual(databases.k2m(), k2m)
+        finally:
+            Data.DATABASE_DIR = database_directory
+            Databases.cache.clear()
+
+    def test_reaction_ids(self):
+        database_directory = Data.DATABASE_DIR
+        self.make_database({'reaction_to_orthology':{'R00002':['K00001'], 'R00001':['K00001', 'K00002']}})
+
+        try:
+            databases = Databases()
+            reaction_ids = databases.reaction_ids()
+            self.assertEqual(reaction_ids.reactions.ids, ['R00001', 'R00002'])
+            self.assertEqual(reaction_ids.ko_columns('K00001').tolist(), [1, 0])
+            self.assertEqual(reaction_ids.ko_columns('K00002').tolist(), [0])
+            self.assertEqual(reaction_ids.ko_columns('K99999').tolist(), [])
+            self.assertFalse(os.path.isfile(databases.REACTION_IDS))
+
+            # Once written to the database, the numbering is read back from it
+            databases.write_reaction_ids()
+            Databases.cache.clear()
+            os.remove(databases.pickle_path(databases.R2K))
+            loaded = databases.reaction_ids()
+            self.assertIsNot(loaded, reaction_ids)
+            self.assertEqual(loaded.reactions.ids, ['R00001', 'R00002'])
+            self.assertEqual(loaded.kos.ids, ['K00001', 'K00002'])
+            self.assertEqual(loaded.ko_columns('K00001').tolist(), [1, 0])
+            self.assertIs(databases.reaction_ids(), loaded)
+        finally:
+            Data.DATABASE_DIR = database_directory
+            Databases.cache.clear()
+
+    def test_parsed_modules(self):
+        database_directory = Data.DATABASE_DIR
+        self.make_database({'module_to_definition':{'M00001':'K00001 (K00002,K00003)', 'M00611':'M00161 M00165'}})
+
+        try:
+            databases = Databases()
+            databases.USER_CACHE_DIR = os.path.join(Data.DATABASE_DIR, 'cache')
+            parsed_modules = databases.parsed_modules()
+            # Signature modules aren't parsed
+            self.assertEqual(list(parsed_modules), ['M00001'])
+            self.assertEqual(parsed_modules['M00001'].num_covered_steps({'K00001', 'K00003'})[0], 2)
+
+            Databases.cache.clear()
+            saved = [file_name for file_name in os.listdir(databases.CUR_DATABASE_DIR)
+                     if file_name.startswith('parsed_modules')]
+            self.assertEqual(len(saved), 1)
+            # Saved modules are only used by the version of enrichm that parsed them
+            self.assertIn('.%s.' % __version__, saved[0])
+            self.assertEqual(databases.parsed_modules()['M00001'].num_steps(), 2)
+
+            # Custom modules are parsed and saved separately
+            m2def = dict(databases.m2def())
+            m2def['M99999'] = 'K00004'
+            self.assertIn('M99999', databases.parsed_modules(m2def))
+            self.assertNotIn('M99999', databases.parsed_modules())
+            # and only in the user's cache directory
+            saved = [file_name for file_name in os.listdir(databases.CUR_DATABASE_DIR)
+                     if file_name.startswith('parsed_modules')]
+            self.assertEqual(len(saved), 1)
+            self.assertEqual(len(os.listdir(databases.USER_CACHE_DIR)), 1)
+        finally:
+            Data.DATABASE_DIR = database_directory
+            Databases.cache.clear()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import tempfile
+import json
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.dependencies import Dependencies
+
+class Tests(unittest.TestCase):
+
+    def _make_tool(self, directory, name):
+        tool_path = os.path.join(directory, name)
+
+        with open(tool_path, 'w') as tool_io:
+            tool_io.write("#!/bin/sh\necho '%s v1.2.3'\n" % name)
+
+        os.chmod(tool_path, 0o755)
+
+        return tool_path
+
+    def test_fingerprint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            bin_directory = os.path.join(tmp, 'bin')
+            os.mkdir(bin_directory)
+            tool_path = self._make_tool(bin_directory, 'diamond')
+            old_path = os.environ['PATH']
+            os.environ['PATH'] = bin_directory
+
+            try:
+                dependencies = Dependencies(tmp)
+                resolved = dependencies.check(['diamond'])
+                self.assertEqual(resolved['diamond']['path'], tool_path)
+                self.assertEqual(resolved['diamond']['version'], 'diamond v1.2.3')
+
+                with open(dependencies.fingerprint_path) as fingerprint_io:
+                    fingerprint = json.load(fingerprint_io)
+
+                self.assertEqual(fingerprint['PATH'], bin_directory)
+
+                # A cached entry is reused without probing the tool again
+                dependencies.probe_version = lambda tool, path: 'reprobed'
+                self.assertEqual(dependencies.check(['diamond'])['diamond']['version'], 'diamond v1.2.3')
+
+                # Modifying the binary invalidates its entry
+                os.utime(tool_path, (0, 0))
+                self.assertEqual(dependencies.check(['diamond'])['diamond']['version'], 'reprobed')
+            finally:
+                os.environ['PATH'] = old_path
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            old_path = os.environ['PATH']
+            os.environ['PATH'] = tmp
+
+            try:
+                with self.assertRaises(Exception):
+                    Dependencies(tmp).check(['hmmsearch'])
+
+                self.assertEqual(Dependencies(tmp).check([]), dict())
+            finally:
+                os.environ['PATH'] = old_path
+
+if __name__ == "__main__":
+    unittest.main()
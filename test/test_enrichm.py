@@ -20,6 +20,8 @@ import unittest
 import os.path
 import sys
 import subprocess
+import tempfile
+import pickle
 
 ###############################################################################
 
@@ -35,5 +37,48 @@ class Tests(unittest.TestCase):
         cmd = '%s -h > /dev/null' % path_to_script
         subprocess.call(cmd, shell=True)
 
+    def test_uses_imports(self):
+        # uses is run as thousands of short jobs, so must not load scipy to start
+        with tempfile.TemporaryDirectory() as tmp:
+            version_directory = os.path.join(tmp, 'test_db')
+            os.mkdir(version_directory)
+
+            with open(os.path.join(tmp, 'VERSION'), 'w') as out_io:
+                out_io.write('test_db.tar.gz\n')
+
+            with open(os.path.join(version_directory, 'VERSION'), 'w') as out_io:
+                out_io.write('01-01-2020\n')
+
+            mappings = {'reaction_to_orthology':{'R00001':['K00001']},
+                        'compound_to_reaction':{'C00001':['R00001']},
+                        'compound_descriptions':{'C00001':'H2O'}}
+
+            for name, mapping in mappings.items():
+
+                with open(os.path.join(version_directory, name + '.01-01-2020.pickle'), 'wb') as out_io:
+                    pickle.dump(mapping, out_io)
+
+            inputs = {'matrix.tsv':'ID\tgenome_1\tgenome_2\nK00001\t1\t0\n',
+                      'metadata.tsv':'genome_1\tgroup_1\ngenome_2\tgroup_2\n',
+                      'compounds.txt':'C00001\n'}
+
+            for name, content in inputs.items():
+
+                with open(os.path.join(tmp, name), 'w') as out_io:
+                    out_io.write(content)
+
+            output = os.path.join(tmp, 'output')
+            cmd = [sys.executable, path_to_script, 'uses', '--annotation_matrix', os.path.join(tmp, 'matrix.tsv'),
+                   '--metadata', os.path.join(tmp, 'metadata.tsv'), '--compounds_list', os.path.join(tmp, 'compounds.txt'),
+                   '--count', '--profile_imports', '--output', output]
+            subprocess.check_call(cmd, env=dict(os.environ, ENRICHM_DB=tmp), stderr=subprocess.DEVNULL)
+
+            with open(os.path.join(output, 'import_profile.tsv')) as profile_io:
+                heavy_packages = [line.rstrip('\n').split('\t') for line in profile_io
+                                  if line.startswith('heavy_packages')][0]
+
+            self.assertNotIn('scipy', heavy_packages[1].split(','))
+            self.assertTrue(os.path.isfile(os.path.join(output, 'enrichment_results.tsv')))
+
 if __name__ == "__main__":
     unittest.main()
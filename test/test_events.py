@@ -0,0 +1,68 @@
+import unittest
+import tempfile
+import logging
+import json
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.events import Events, EventHandler
+
+class Tests(unittest.TestCase):
+
+    def test_events(self):
+        output_path = tempfile.mktemp(suffix='.jsonl')
+        logger = logging.getLogger('test_events')
+        logger.setLevel(logging.DEBUG)
+        handler = EventHandler(output_path)
+        logger.addHandler(handler)
+
+        try:
+            logger.info('Not an event')
+            logger.info('Started ko', extra=Events.event(Events.STARTED, stage='ko'))
+            logger.debug('Added hits', extra=Events.event(Events.FINISHED, stage='ko', genome='genome_1',
+                                                          hits=10, done=1, total=4))
+            logger.info('Finished ko', extra=Events.event(Events.FINISHED, stage='ko', bytes=100))
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        with open(output_path) as output_io:
+            events = [json.loads(line) for line in output_io]
+
+        self.assertEqual([event['event'] for event in events],
+                         [Events.STARTED, Events.FINISHED, Events.FINISHED])
+        self.assertEqual(events[0]['message'], 'Started ko')
+        self.assertEqual(events[1]['genome'], 'genome_1')
+        self.assertEqual(events[1]['hits'], 10)
+        # Three quarters of the genomes remain, so three times the elapsed time
+        self.assertAlmostEqual(events[1]['eta'], events[1]['elapsed'] * 3, places=2)
+        self.assertIn('elapsed', events[2])
+        self.assertNotIn('eta', events[2])
+
+    def test_size(self):
+        output_directory = tempfile.mkdtemp()
+
+        with open(os.path.join(output_directory, 'results.tsv'), 'w') as output_io:
+            output_io.write('12345')
+
+        self.assertEqual(Events.size(output_directory), 5)
+        self.assertEqual(Events.size(os.path.join(output_directory, 'results.tsv')), 5)
+        self.assertEqual(Events.size(os.path.join(output_directory, 'missing')), 0)
+
+        # Outputs are only measured while events are being written
+        self.assertFalse(Events.enabled())
+        self.assertIsNone(Events.output_size(output_directory))
+        handler = EventHandler(tempfile.mktemp(suffix='.jsonl'))
+
+        try:
+            self.assertEqual(Events.output_size(output_directory, output_directory), 10)
+        finally:
+            handler.close()
+
+        self.assertFalse(Events.enabled())
+
+if __name__ == "__main__":
+    unittest.main()
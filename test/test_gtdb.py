@@ -0,0 +1,36 @@
+import unittest
+import tempfile
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.gtdb import GtdbMatrix
+from enrichm.parser import Parser
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = os.path.join(tempfile.mkdtemp(), 'gtdb_ko.tsv')
+
+        with open(self.matrix, 'w') as out_io:
+            out_io.write('ID\tRS_GCF_1\tGB_GCA_2\tRS_GCF_3\n')
+            out_io.write('K00001\t0\t2\t1\n')
+            out_io.write('K00002\t300\t0\t0\n')
+            out_io.write('K00003\t0\t0\t0\n')
+
+    def test_columnar(self):
+        columns = ['RS_GCF_3', 'RS_GCF_1', 'RS_GCF_4']
+        expected = Parser.filter_large_matrix(columns, self.matrix)
+        self.assertFalse(GtdbMatrix.exists(self.matrix))
+
+        GtdbMatrix.convert(self.matrix)
+        self.assertTrue(GtdbMatrix.exists(self.matrix))
+
+        self.assertEqual(Parser.filter_large_matrix(columns, self.matrix), expected)
+        self.assertEqual(expected, ({'RS_GCF_3':{'K00001':1}, 'RS_GCF_1':{'K00002':300}},
+                                    ['RS_GCF_3', 'RS_GCF_1']))
+
+if __name__ == "__main__":
+    unittest.main()
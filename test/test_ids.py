@@ -0,0 +1,66 @@
+import unittest
+import tempfile
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.data import Data
+from enrichm.ids import IdCatalog
+from enrichm.writer import MatrixGenerator
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.database_directory = tempfile.mkdtemp()
+        self.version_directory = os.path.join(self.database_directory, 'test_db')
+        os.mkdir(self.version_directory)
+
+        with open(os.path.join(self.database_directory, 'VERSION'), 'w') as out_io:
+            out_io.write('test_db.tar.gz\n')
+
+        with open(os.path.join(self.version_directory, 'VERSION'), 'w') as out_io:
+            out_io.write('01-01-2020\n')
+
+    def test_catalog(self):
+        database_directory = Data.DATABASE_DIR
+        Data.DATABASE_DIR = self.database_directory
+        ids_dir = os.path.join(self.version_directory, 'ids')
+        os.mkdir(ids_dir)
+
+        with open(os.path.join(ids_dir, MatrixGenerator.KO), 'w') as out_io:
+            out_io.write('K00002\nK00001\nK00003\n')
+
+        try:
+            IdCatalog.build(ids_dir, MatrixGenerator.KO)
+            self.assertTrue(os.path.isfile(os.path.join(ids_dir, 'KO_IDS.pickle')))
+
+            matrix_generator = MatrixGenerator(MatrixGenerator.KO)
+            self.assertIs(MatrixGenerator(MatrixGenerator.KO).catalog, matrix_generator.catalog)
+            self.assertEqual(matrix_generator.catalog.rows(['K00001', 'K99999']), [1, -1])
+
+            class Sequence:
+                def __init__(self, annotations):
+                    self.annotations = annotations
+                def all_annotations(self):
+                    return self.annotations
+
+            class Genome:
+                def __init__(self, name, sequences):
+                    self.name = name
+                    self.sequences = dict(enumerate(sequences))
+
+            genomes = [Genome('genome_1', [Sequence(['K00001', 'K00001']), Sequence(['K99999'])]),
+                       Genome('genome_2', [Sequence(['K00003'])])]
+            matrix = matrix_generator.generate_matrix(genomes, True)
+            self.assertEqual(matrix.rownames, ['K00002', 'K00001', 'K00003'])
+            self.assertEqual(matrix.values, {'genome_1':{'K00002':0, 'K00001':2, 'K00003':0},
+                                             'genome_2':{'K00002':0, 'K00001':0, 'K00003':1}})
+            self.assertEqual(matrix_generator.generate_matrix(genomes, False).values['genome_1']['K00001'], 1)
+        finally:
+            Data.DATABASE_DIR = database_directory
+            IdCatalog.catalogs.clear()
+
+if __name__ == "__main__":
+    unittest.main()
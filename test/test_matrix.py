@@ -0,0 +1,133 @@
+import unittest
+import numpy as np
+import tempfile
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.matrix import AnnotationMatrix, SparseAnnotationMatrix, TpmMatrix
+from enrichm.parser import Parser
+from enrichm.ids import ReactionIds
+
+class Tests(unittest.TestCase):
+
+    def test_round_trip(self):
+        matrix = AnnotationMatrix({'genome_1':{'K00001':2, 'K00002':0},
+                                   'genome_2':{'K00001':0, 'K00002':1}},
+                                  ['genome_1', 'genome_2'],
+                                  ['K00001', 'K00002'])
+        output_path = tempfile.mktemp(suffix='.tsv')
+        matrix.write(output_path)
+
+        with open(output_path) as output_io:
+            self.assertEqual(output_io.read(), "ID\tgenome_1\tgenome_2\nK00001\t2\t0\nK00002\t0\t1\n")
+
+        parsed = AnnotationMatrix.from_file(output_path)
+        self.assertEqual(parsed.values, matrix.values)
+        self.assertEqual(parsed.colnames, matrix.colnames)
+        self.assertEqual(parsed.rownames, matrix.rownames)
+        self.assertEqual(Parser.parse_simple_matrix(output_path),
+                         Parser.parse_simple_matrix(matrix))
+
+    def test_parse_in_memory(self):
+        matrix = AnnotationMatrix({'genome_1':{'K00001':1}}, ['genome_1'], ['K00001'])
+        values, colnames, rownames = Parser.parse_simple_matrix(matrix)
+        values['genome_2'] = {'K00001':1}
+        colnames.append('genome_2')
+
+        self.assertEqual(list(matrix.values.keys()), ['genome_1'])
+        self.assertEqual(matrix.colnames, ['genome_1'])
+
+    def test_array(self):
+        output_path = tempfile.mktemp(suffix='.tsv')
+
+        with open(output_path, 'w') as out_io:
+            out_io.write("ID\tgenome_1\tgenome_2\nK00001\t1\t0\nK00002\t0\t3\nK00001\t5\t6\n")
+
+        matrix = Parser.parse_matrix(output_path)
+        # A repeated row keeps its first position and its last values
+        self.assertEqual(matrix.rownames, ['K00001', 'K00002'])
+        self.assertEqual(matrix.array.tolist(), [[5.0, 6.0], [0.0, 3.0]])
+        self.assertEqual(matrix.row_index, {'K00001':0, 'K00002':1})
+        self.assertEqual(matrix.column_index, {'genome_1':0, 'genome_2':1})
+        self.assertEqual(matrix.present('genome_1'), ['K00001'])
+        self.assertEqual(dict(matrix.values['genome_2']), {'K00001':6.0, 'K00002':3.0})
+        self.assertIs(Parser.parse_matrix(matrix), matrix)
+
+    def test_binary(self):
+        matrix = AnnotationMatrix({'genome_1':{'K00001':2, 'K00002':0},
+                                   'genome_2':{'K00001':0, 'K00002':1}},
+                                  ['genome_1', 'genome_2'],
+                                  ['K00001', 'K00002'])
+        output_path = tempfile.mktemp(suffix='.tsv')
+        matrix.write(output_path)
+        matrix.write_binary(output_path)
+
+        # The binary copy is mapped, whether asked for or found next to the text
+        for matrix_path in [output_path, output_path.replace('.tsv', '.npy')]:
+            mapped = Parser.parse_matrix(matrix_path)
+            self.assertIsInstance(mapped.array, np.memmap)
+            self.assertEqual(mapped.array.tolist(), [[2, 0], [0, 1]])
+            self.assertEqual((mapped.colnames, mapped.rownames), (matrix.colnames, matrix.rownames))
+            self.assertEqual(Parser.parse_simple_matrix(matrix_path), Parser.parse_simple_matrix(matrix))
+
+    def test_sparse(self):
+        values = {'genome_1':{'K00001':2, 'K00002':0, 'K00003':0},
+                  'genome_2':{'K00001':0, 'K00002':1, 'K00003':4}}
+        colnames, rownames = ['genome_1', 'genome_2'], ['K00001', 'K00002', 'K00003']
+        matrix = SparseAnnotationMatrix(values, colnames, rownames)
+        self.assertEqual(matrix.array.nnz, 3)
+
+        # Written the same as a dense matrix
+        output_path = tempfile.mktemp(suffix='.tsv')
+        dense_path = tempfile.mktemp(suffix='.tsv')
+        matrix.write(output_path)
+        AnnotationMatrix(values, colnames, rownames).write(dense_path)
+
+        with open(output_path) as output_io, open(dense_path) as dense_io:
+            self.assertEqual(output_io.read(), dense_io.read())
+
+        # Columns only hold the annotations a genome has, but give 0 for the rest
+        self.assertEqual(dict(matrix.values['genome_1']), {'K00001':2})
+        self.assertEqual(matrix.values['genome_1']['K00003'], 0)
+        self.assertTrue('K00003' in matrix.values['genome_1'])
+        self.assertEqual(matrix.present('genome_2'), ['K00002', 'K00003'])
+
+        # The sparse copy is read in place of the text matrix next to it
+        matrix.save(SparseAnnotationMatrix.npz_path(output_path))
+        loaded = Parser.parse_matrix(output_path)
+        self.assertIsInstance(loaded, SparseAnnotationMatrix)
+        self.assertEqual(loaded.array.toarray().tolist(), [[2, 0], [0, 1], [0, 4]])
+        self.assertEqual((loaded.colnames, loaded.rownames), (colnames, rownames))
+
+        parsed = SparseAnnotationMatrix.from_file(dense_path)
+        self.assertEqual(parsed.array.toarray().tolist(), [[2.0, 0.0], [0.0, 1.0], [0.0, 4.0]])
+
+    def test_tpm(self):
+        reaction_ids = ReactionIds.from_k2r({'K00001':['R00001', 'R00002'], 'K00002':['R00002'],
+                                             'K00004':['R00003']})
+        tpm_path = tempfile.mktemp(suffix='.tsv')
+        rows = [('GCF_1_gene1', '2.5', 'K00001,K00002', 'sample_1'),
+                ('GCF_1_gene2', '1.0', 'K00002', 'sample_1'),
+                ('GCF_2_gene1', '4.0', 'K00003', 'sample_1'),
+                ('GCF_2_gene2', '3.0', 'K00001', 'sample_2')]
+
+        with open(tpm_path, 'w') as out_io:
+            out_io.write('\t'.join('column_%i' % index for index in range(15)) + '\n')
+
+            for gene, tpm, annotation, sample in rows:
+                out_io.write('\t'.join([gene] + ['0'] * 9 + [tpm, '0', '0', annotation, sample]) + '\n')
+
+        matrix = TpmMatrix.from_file(tpm_path, reaction_ids)
+        self.assertEqual((matrix.samples, matrix.genomes, matrix.reactions),
+                         (['sample_1', 'sample_2'], ['GCF_1', 'GCF_2'], ['R00001', 'R00002', 'R00003']))
+        # The columns are those of the database's numbering of the reactions
+        self.assertIs(matrix.reaction_index, reaction_ids.reactions.index)
+        # The TPM of a gene counts once for each KO carrying out a reaction
+        self.assertEqual(matrix.sample('sample_1').toarray().tolist(), [[2.5, 6.0, 0.0], [0.0, 0.0, 0.0]])
+        self.assertEqual(matrix.sample('sample_2').toarray().tolist(), [[0.0, 0.0, 0.0], [3.0, 3.0, 0.0]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+import json
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.profiler import Profiler
+
+@Profiler.profile('square')
+def square(value):
+    return value * value
+
+class Tests(unittest.TestCase):
+
+    def test_profile(self):
+        Profiler.enabled = False
+        self.assertEqual(square(2), 4)
+        self.assertEqual(Profiler.records, dict())
+
+        Profiler.start()
+
+        try:
+            for value in range(3):
+                self.assertEqual(square(value), value * value)
+
+            with Profiler.stage('block'):
+                sum(range(1000))
+
+            output_path = tempfile.mktemp(suffix='.json')
+            Profiler.write(output_path, ['enrichm', 'annotate'])
+
+            with open(output_path) as report_io:
+                report = json.load(report_io)
+        finally:
+            Profiler.enabled = False
+
+        self.assertEqual(report['stages']['square']['calls'], 3)
+        self.assertEqual(report['stages']['block']['calls'], 1)
+        self.assertEqual(report['command'], 'enrichm annotate')
+
+        for key in [Profiler.WALL_TIME, Profiler.CPU_TIME, Profiler.PEAK_RSS,
+                    Profiler.CHILD_USER_TIME, Profiler.CHILD_SYSTEM_TIME]:
+            self.assertIn(key, report['total'])
+            self.assertGreaterEqual(report['stages']['square'][key], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import unittest
+import threading
+import tempfile
+import time
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.scheduler import Scheduler, Threads, ParallelJobs, plan_cpus
+from enrichm.annotate import Annotate
+
+class Tests(unittest.TestCase):
+
+    def test_dependencies(self):
+        order = list()
+        lock = threading.Lock()
+
+        def task(name):
+            time.sleep(0.05)
+
+            with lock:
+                order.append(name)
+
+            return name
+
+        scheduler = Scheduler(4)
+        scheduler.add('ko_hmm', task, ('ko_hmm',), 1, ['ko'])
+        scheduler.add('ko', task, ('ko',), 1)
+        scheduler.add('pfam', task, ('pfam',), 1, ['not_scheduled'])
+        results = scheduler.run()
+
+        self.assertEqual(results, {'ko':'ko', 'ko_hmm':'ko_hmm', 'pfam':'pfam'})
+        self.assertLess(order.index('ko'), order.index('ko_hmm'))
+
+    def test_budget(self):
+        running = list()
+        peak = list()
+        lock = threading.Lock()
+
+        def task():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+
+            time.sleep(0.05)
+
+            with lock:
+                running.pop()
+
+        scheduler = Scheduler(4)
+
+        for _ in range(6):
+            scheduler.add('task_%i' % _, task, cpus=2)
+
+        # Larger than the budget, so run on its own
+        scheduler.add('large', task, cpus=16)
+        scheduler.run()
+
+        self.assertEqual(max(peak), 2)
+
+    def test_failure(self):
+        started = list()
+
+        def fail():
+            raise ValueError("failed")
+
+        scheduler = Scheduler(1)
+        scheduler.add('fail', fail)
+        scheduler.add('after', started.append, ('after',))
+
+        with self.assertRaises(ValueError):
+            scheduler.run()
+
+        self.assertEqual(started, list())
+
+    def test_resize(self):
+        short_finished = threading.Event()
+        seen = list()
+
+        def short():
+            time.sleep(0.05)
+            short_finished.set()
+
+        def long(jobs):
+            seen.append(jobs.jobs)
+            short_finished.wait()
+
+            # Offered the CPUs of the short task once it has finished
+            for _ in range(100):
+
+                if jobs.jobs == 4:
+                    break
+
+                time.sleep(0.01)
+
+            seen.append(jobs.jobs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            threads = Threads(8)
+            jobs = ParallelJobs(os.path.join(tmp, 'jobs'), 8, 1)
+            scheduler = Scheduler(4)
+            scheduler.add('short', short, (), 1, max_cpus=threads.planned, resize=threads.resize)
+            scheduler.add('long', long, (jobs,), 1, max_cpus=8, resize=jobs.resize)
+            scheduler.run()
+
+            with open(jobs.path) as jobs_io:
+                self.assertEqual(jobs_io.read().strip(), '4')
+
+        # Threads are fixed when the task starts
+        self.assertEqual(threads.threads, 2)
+        self.assertEqual(seen, [2, 4])
+
+    def test_plan_cpus(self):
+        # Tools that scale poorly with threads are given more jobs
+        self.assertEqual(plan_cpus(16, 100, 'prodigal'), (16, 1))
+        self.assertEqual(plan_cpus(16, 100, 'hmmsearch'), (16, 1))
+        self.assertEqual(plan_cpus(16, 2, 'hmmsearch'), (2, 4))
+        self.assertEqual(plan_cpus(16, 1, 'hmmsearch'), (1, 4))
+        # Others are run as a single job with every thread
+        self.assertEqual(plan_cpus(16, 100, 'diamond'), (1, 16))
+        self.assertEqual(plan_cpus(0, 100, 'diamond'), (1, 1))
+
+    def test_annotate_overlap(self):
+        # Without --cpus, independent stages share --parallel x --threads
+        running = list()
+        peak = list()
+        lock = threading.Lock()
+
+        def stage(*args):
+            with lock:
+                running.append(args[2])
+                peak.append(len(running))
+
+            time.sleep(0.1)
+
+            with lock:
+                running.remove(args[2])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            annotate = Annotate.__new__(Annotate)
+            annotate.__dict__.update(output_directory=tmp, resume=False, light=True,
+                                     parallel=2, threads=2, cpu_budget=None, cpus=4,
+                                     annotate_ko=True, annotate_pfam=True, annotate_ko_hmm=False,
+                                     annotate_ec=False, annotate_tigrfam=False, annotate_cazy=False,
+                                     annotate_cluster=False, annotate_ortholog=False,
+                                     databases=SimpleNamespace(KO_DB='ko', PFAM_DB='pfam'),
+                                     _parameters=dict, _diamond_stage=stage, _hmmsearch_stage=stage)
+            genomes = [SimpleNamespace(sequences={'protein':SimpleNamespace()}) for _ in range(2)]
+            annotate.parse_genome_inputs = lambda *args: genomes
+            annotate.annotate_pipeline(None, tmp, None, None, False)
+
+        self.assertEqual(max(peak), 2)
+
+    def test_annotate_grow(self):
+        # An hmmsearch stage takes the whole budget once it runs on its own
+        ko_finished = threading.Event()
+        seen = list()
+
+        def diamond_stage(*args):
+            time.sleep(0.05)
+            ko_finished.set()
+
+        def hmmsearch_stage(*args):
+            jobs = args[-1]
+
+            with open(jobs.path) as jobs_io:
+                seen.append(jobs_io.read().strip())
+
+            ko_finished.wait()
+
+            for _ in range(100):
+
+                if jobs.jobs == 5:
+                    break
+
+                time.sleep(0.01)
+
+            with open(jobs.path) as jobs_io:
+                seen.append(jobs_io.read().strip())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            annotate = Annotate.__new__(Annotate)
+            annotate.__dict__.update(output_directory=tmp, resume=False, light=True,
+                                     parallel=5, threads=1, cpu_budget=None, cpus=5,
+                                     annotate_ko=True, annotate_pfam=True, annotate_ko_hmm=False,
+                                     annotate_ec=False, annotate_tigrfam=False, annotate_cazy=False,
+                                     annotate_cluster=False, annotate_ortholog=False,
+                                     databases=SimpleNamespace(KO_DB='ko', PFAM_DB='pfam'),
+                                     _parameters=dict, _diamond_stage=diamond_stage,
+                                     _hmmsearch_stage=hmmsearch_stage)
+            genomes = [SimpleNamespace(sequences={'protein':SimpleNamespace()}) for _ in range(5)]
+            annotate.parse_genome_inputs = lambda *args: genomes
+            annotate.annotate_pipeline(None, tmp, None, None, False)
+
+        self.assertEqual(seen, ['4', '5'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import tempfile
+import threading
+import socket
+import json
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.server import Server, Client, ClientStream, send
+
+class Tests(unittest.TestCase):
+
+    def request(self, message):
+        server_socket, client_socket = socket.socketpair()
+
+        with server_socket, client_socket, \
+             server_socket.makefile('rw') as server_io, client_socket.makefile('rw') as client_io:
+            send(client_io, message)
+            thread = threading.Thread(target=Server(None).handle, args=(server_io,))
+            thread.start()
+            thread.join()
+
+            return json.loads(client_io.readline())
+
+    def test_ping(self):
+        self.assertEqual(self.request({'ping':True}), {'status':0})
+
+    def test_rejected_job(self):
+        response = self.request({'args':{'subparser_name':'annotate'}, 'command':['enrichm', 'annotate'],
+                                 'cwd':os.getcwd()})
+        self.assertEqual(response['status'], 1)
+        self.assertIn('annotate', response['error'])
+
+    def test_client_stream(self):
+        server_socket, client_socket = socket.socketpair()
+
+        with server_socket, client_socket, \
+             server_socket.makefile('rw') as server_io, client_socket.makefile('rw') as client_io:
+            stream = ClientStream(server_io)
+            stream.write('first line\nsecond ')
+            stream.write('line\nunfinished')
+            stream.flush()
+
+            self.assertEqual([json.loads(client_io.readline())['output'] for _ in range(3)],
+                             ['first line', 'second line', 'unfinished'])
+
+    def test_no_server(self):
+        client = Client(os.path.join(tempfile.mkdtemp(), 'missing.sock'))
+        self.assertFalse(client.alive())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import tempfile
+import pickle
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.data import Data
+from enrichm.databases import Databases
+from enrichm.store import DatabaseStore, StoreMapping
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.database_directory = tempfile.mkdtemp()
+        self.version_directory = os.path.join(self.database_directory, 'test_db')
+        os.mkdir(self.version_directory)
+
+        with open(os.path.join(self.database_directory, 'VERSION'), 'w') as out_io:
+            out_io.write('test_db.tar.gz\n')
+
+        with open(os.path.join(self.version_directory, 'VERSION'), 'w') as out_io:
+            out_io.write('01-01-2020\n')
+
+        self.mappings = {'compound_to_reaction':{'C00001':['R00001', 'R00002'], 'C00002':['R00003']},
+                         'compound_descriptions':{'C00001':'H2O', 'C00002':'ATP'}}
+
+        for name, mapping in self.mappings.items():
+
+            with open(os.path.join(self.version_directory, name + '.01-01-2020.pickle'), 'wb') as out_io:
+                pickle.dump(mapping, out_io)
+
+    def test_store(self):
+        store_path = DatabaseStore.compile(self.version_directory, '01-01-2020')
+        store = DatabaseStore(store_path)
+        mapping, _ = store.mapping('compound_to_reaction')
+
+        self.assertIsInstance(mapping, StoreMapping)
+        self.assertEqual(mapping['C00001'], ['R00001', 'R00002'])
+        self.assertNotIn('C00003', mapping)
+        self.assertIsNone(mapping.loaded)
+        self.assertEqual(len(mapping), 2)
+        self.assertEqual(dict(mapping), self.mappings['compound_to_reaction'])
+        self.assertIsNone(store.mapping('missing'))
+        self.assertEqual(store.get('compound_descriptions', 'C00002'), (True, 'ATP'))
+        self.assertEqual(store.get('compound_descriptions', 'C00003'), (False, None))
+
+    def test_databases(self):
+        database_directory = Data.DATABASE_DIR
+        Data.DATABASE_DIR = self.database_directory
+
+        try:
+            databases = Databases()
+            DatabaseStore.compile(databases.CUR_DATABASE_DIR, databases.PICKLE_VERSION)
+            self.assertIsNotNone(databases.store())
+            self.assertEqual(databases.c()['C00002'], 'ATP')
+            self.assertNotIn('C00003', databases.c())
+            self.assertEqual(dict(databases.c2r()), self.mappings['compound_to_reaction'])
+        finally:
+            Data.DATABASE_DIR = database_directory
+            Databases.cache.clear()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -76,31 +76,23 @@ class Tests(unittest.TestCase):
         self.assertEqual(test_instance_2[0], self.simple_test_object.PA)
         self.assertEqual(test_instance_2[1], stats.norm.cdf)
 
-    def test_count(self):
+    def test_frequencies(self):
         '''
         test both frequency and presence absence counting in Test.
         '''
-        
-        self.assertEqual(self.simple_test_object.count("K00001", "group_1", False), (1,0))
-        self.assertEqual(self.simple_test_object.count("K00001", "group_1", True), ([1],0))
-        self.assertEqual(self.simple_test_object.count("K00001", "group_2", False), (1,1))
-        self.assertEqual(self.simple_test_object.count("K00001", "group_2", True), ([0, 5], 0))
-        self.assertEqual(self.simple_test_object.count("K00003", "group_2", False), (2, 0))
-        self.assertEqual(self.simple_test_object.count("K00003", "group_2", True), ([1, 5], 0))
-
-    def test_gene_frequencies(self):
         expect_1 = [['K00002', 'group_1', 'group_2', [[2], 0], [[0, 4], 0]],
                     ['K00003', 'group_1', 'group_2', [[0], 0], [[1, 5], 0]],
                     ['K00001', 'group_1', 'group_2', [[1], 0], [[0, 5], 0]]]
         expect_2 = [['K00002', 'group_1', 'group_2', [1, 0], [1, 1]],
                     ['K00003', 'group_1', 'group_2', [0, 1], [2, 0]],
                     ['K00001', 'group_1', 'group_2', [1, 0], [1, 1]]]
-        for result in self.simple_test_object.gene_frequencies("group_1", "group_2", True):
+        # list as the calculation returns the counts each test is given
+        for result in self.simple_test_object.test_frequencies(list, "group_1", "group_2", True):
             if result in expect_1:
                 expect_1.pop(expect_1.index(result))
         self.assertEqual(expect_1, list())
         
-        for result in self.simple_test_object.gene_frequencies("group_1", "group_2", False):
+        for result in self.simple_test_object.test_frequencies(list, "group_1", "group_2", False):
             if result in expect_2:
                 expect_2.pop(expect_2.index(result))
         self.assertEqual(expect_2, list())
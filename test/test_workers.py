@@ -0,0 +1,74 @@
+import unittest
+import subprocess
+import os
+import sys
+import numpy as np
+
+sys.path = [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), '..', )]+sys.path
+
+from enrichm.workers import WorkerPool, SharedArrays
+
+def row_sums(task):
+    descriptors, start, end = task
+    return SharedArrays.attach(descriptors)['counts'][start:end].sum(axis=1).tolist()
+
+class Tests(unittest.TestCase):
+
+    def tearDown(self):
+        WorkerPool.shutdown()
+
+    def test_inline(self):
+        # Nothing to parallelise, so no workers are started
+        self.assertEqual(WorkerPool.map(abs, [-1, -2], 1), [1, 2])
+        self.assertEqual(WorkerPool.map(abs, [-1], 4), [1])
+        self.assertIsNone(WorkerPool.pool)
+
+    def test_shared(self):
+        self.assertEqual(WorkerPool.map(abs, [-1, -2, 3], 2), [1, 2, 3])
+        pool = WorkerPool.pool
+        self.assertEqual(WorkerPool.map(abs, [-4, 5], 2), [4, 5])
+        self.assertIs(WorkerPool.pool, pool)
+
+        # A different size replaces the pool
+        self.assertEqual(WorkerPool.map(abs, [-4, 5], 3), [4, 5])
+        self.assertEqual(WorkerPool.processes, 3)
+
+        WorkerPool.shutdown()
+        self.assertIsNone(WorkerPool.pool)
+
+    def test_shared_arrays(self):
+        counts = np.arange(12).reshape(4, 3)
+
+        with SharedArrays({'counts':counts}) as shared:
+            tasks = [(shared.descriptors, 0, 2), (shared.descriptors, 2, 4)]
+            self.assertEqual(WorkerPool.map(row_sums, tasks, 2), [[3, 12], [21, 30]])
+            self.assertFalse(SharedArrays.attach(shared.descriptors)['counts'].flags.writeable)
+
+        self.assertEqual(SharedArrays.attached, dict())
+
+    def test_shared_arrays_forked_first(self):
+        # Workers forked before the parent first uses shared memory start
+        # resource trackers of their own, which must not report it as leaked
+        script = '''
+import sys
+import numpy as np
+sys.path.insert(0, %r)
+sys.path.insert(0, %r)
+from enrichm.workers import WorkerPool, SharedArrays
+from test_workers import row_sums
+WorkerPool.map(abs, [-1, -2, -3], 2)
+with SharedArrays({'counts':np.arange(12).reshape(4, 3)}) as shared:
+    tasks = [(shared.descriptors, 0, 2), (shared.descriptors, 2, 4)]
+    assert WorkerPool.map(row_sums, tasks, 2) == [[3, 12], [21, 30]]
+WorkerPool.shutdown()
+''' % (os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'),
+       os.path.dirname(os.path.realpath(__file__)))
+        result = subprocess.run([sys.executable, '-c', script], stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn('leaked', result.stderr)
+        self.assertNotIn('FileNotFoundError', result.stderr)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,11 +3,15 @@ import filecmp
 import tempfile
 import os
 import sys
+import shutil
+from unittest import mock
 
 sys.path = [os.path.join(os.path.dirname(
     os.path.realpath(__file__)), '..', )]+sys.path
 
 from enrichm.writer import Writer
+from enrichm.parser import Parser
+from enrichm.toolbox import open_file, _zstandard
 
 class Tests(unittest.TestCase):
 
@@ -24,5 +28,46 @@ class Tests(unittest.TestCase):
                 
             self.assertEqual(idx+1, len(expected_list))
 
+    def test_write_compressed(self):
+        output_lines = [["ID", "genome_1"], ["K00001", 2], ["K00002", 0]]
+        suffixes = ['.gz']
+
+        if _zstandard() is not None or shutil.which('zstd'):
+            suffixes.append('.zst')
+
+        for suffix in suffixes:
+            output_file = tempfile.mktemp(suffix='.tsv' + suffix)
+            Writer.write(output_lines, output_file)
+
+            with open(output_file, 'rb') as output_io:
+                self.assertNotEqual(output_io.read(3), b'ID\t')
+
+            with open_file(output_file) as output_io:
+                self.assertEqual(output_io.read(), "ID\tgenome_1\nK00001\t2\nK00002\t0\n")
+
+            self.assertEqual(Parser.parse_simple_matrix(output_file)[0], {'genome_1':{'K00001':2.0, 'K00002':0.0}})
+
+    @unittest.skipUnless(shutil.which('zstd'), 'needs the zstd command')
+    def test_partial_read_command(self):
+        output_lines = [["ID", "genome_1"]] + [["K%05i" % idx, idx] for idx in range(200000)]
+        output_file = tempfile.mktemp(suffix='.tsv.zst')
+
+        with mock.patch('enrichm.toolbox._zstandard', return_value=None):
+            Writer.write(output_lines, output_file)
+
+            # Closing before the end stops the zstd command without an error.
+            # Whether it is killed by SIGPIPE or SIGTERM is a race, so repeat.
+            for _ in range(50):
+                output_io = open_file(output_file)
+                self.assertEqual(output_io.readline(), "ID\tgenome_1\n")
+                output_io.close()
+
+            # An error inside the with block is the one raised
+            with self.assertRaises(KeyError):
+
+                with open_file(output_file) as output_io:
+                    output_io.readline()
+                    raise KeyError('K00001')
+
 if __name__ == "__main__":
     unittest.main()